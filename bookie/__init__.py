@@ -8,6 +8,7 @@ from pyramid.renderers import JSONP
 
 from bookie.lib.access import RequestWithUserAttribute
 from bookie.models import initialize_sql
+from bookie.models import auth
 from bookie.models.auth import UserMgr
 from bookie.routes import build_routes
 
@@ -32,6 +33,8 @@ def main(global_config, **settings):
     settings['app_root'] = abspath(dirname(dirname(__file__)))
 
     initialize_sql(settings)
+    auth.USER_CACHE.ttl = int(
+        settings.get('auth.user_cache_ttl', auth.USER_CACHE_TTL))
 
     authn_policy = AuthTktAuthenticationPolicy(
         settings.get('auth.secret'),
@@ -7,21 +7,28 @@ from bookie.bcelery.celery import celery
 
 
 import transaction
-try:
-    from whoosh.store import LockError
-except ImportError:
-    from whoosh.index import LockError
-from whoosh.writing import IndexingError
+from datetime import datetime
+from redis import StrictRedis
+from uuid import uuid4
+from sqlalchemy.sql import or_
+from sqlalchemy.orm import joinedload
 
 from bookie.lib.importer import Importer
+from bookie.lib.readable import ContentFetcher
 from bookie.lib.readable import ReadUrl
+from bookie.lib.readable import STATUS_CODES
 from bookie.lib.social_utils import get_url_title
+from bookie.lib.utils import suggest_content_tags
 from bookie.models import initialize_sql
 from bookie.models import Bmark
 from bookie.models import BmarkMgr
+from bookie.models import Hashed
 from bookie.models import Readable
+from bookie.models import ReadableMgr
 from bookie.models.auth import UserMgr
-from bookie.models.fulltext import get_fulltext_handler
+from bookie.models.fulltext import index_bookmarks
+from bookie.models.fulltext import rebuild_index
+from bookie.models.fulltext import reconcile_index
 from bookie.models.social import SocialMgr
 from bookie.models.stats import StatBookmarkMgr
 from bookie.models.queue import ImportQueueMgr
@@ -33,6 +40,21 @@ initialize_sql(INI)
 
 logger = get_task_logger(__name__)
 
+# Fulltext updates are written in batches of this many bookmarks, or this many
+# seconds after the first update comes in, whichever comes first.
+FULLTEXT_BATCH_SIZE = int(INI.get('fulltext.batch_size', 100))
+FULLTEXT_BATCH_WAIT = int(INI.get('fulltext.batch_wait', 5))
+# Unfetched bookmark content is downloaded in batches of this size by a pool
+# of workers, with no more than per_host downloads from one host at a time.
+FETCH_BATCH_SIZE = int(INI.get('fetch.batch_size', 100))
+FETCH_WORKERS = int(INI.get('fetch.workers', 10))
+FETCH_PER_HOST = int(INI.get('fetch.per_host', 2))
+FETCH_TIMEOUT = float(INI.get('fetch.timeout', 10))
+# Pages are cut off after this many bytes so one huge url can't eat a worker.
+FETCH_MAX_BYTES = int(INI.get('fetch.max_bytes', 2 * 1024 * 1024))
+# One run of fetch_unfetched_bmark_content fetches at most this many batches.
+FETCH_MAX_BATCHES = int(INI.get('fetch.max_batches', 20))
+
 
 @celery.task(ignore_result=True)
 def hourly_stats():
@@ -161,6 +183,10 @@ def importer_process_worker(import_id):
             import_job.username)
         importer.process()
 
+        # Fetch the content of the new bookmarks now instead of waiting for
+        # the beat to get to them.
+        fetch_unfetched_bmark_content.delay()
+
         # Processing kills off our transaction so we need to start a new one
         # to update that our import is complete.
         trans = transaction.begin()
@@ -237,78 +263,200 @@ def email_signup_user(email, msg, settings, message_data):
         trans.commit()
 
 
-class BookmarkNotFoundException(Exception):
-    pass
+class FulltextQueue(object):
+    """The bookmarks waiting to be written to the fulltext index
+
+    This lives in redis next to the celery broker so all of the workers share
+    it. Only the bids are queued, the batch reads what to index from the db.
+    A set coalesces repeat updates of a bookmark into one, and a list keeps
+    the bids in the order they came in.
 
+    """
+    PENDING = 'bookie:fulltext:pending_bids'
+    ORDER = 'bookie:fulltext:order'
+    SCHEDULED = 'bookie:fulltext:scheduled'
+
+    def __init__(self):
+        self.redis = StrictRedis.from_url(INI.get('celery_broker'))
+
+    def push(self, bids):
+        """Queue up a list of bids to index
+
+        Returns (the number of bookmarks added, the number now waiting).
+
+        """
+        pipe = self.redis.pipeline()
+        for bid in bids:
+            pipe.sadd(self.PENDING, bid)
+        added = pipe.execute()
+
+        # Only bids that weren't waiting already go on the end of the line.
+        for bid, is_new in zip(bids, added):
+            if is_new:
+                pipe.rpush(self.ORDER, bid)
+        pipe.scard(self.PENDING)
+        return sum(added), pipe.execute()[-1]
+
+    def pop(self, count):
+        """Take the oldest count bids off the queue"""
+        pipe = self.redis.pipeline()
+        pipe.lrange(self.ORDER, 0, count - 1)
+        pipe.ltrim(self.ORDER, count, -1)
+        bids = pipe.execute()[0]
+        if not bids:
+            return []
+
+        self.redis.srem(self.PENDING, *bids)
+        return [int(bid) for bid in bids]
+
+    def schedule(self):
+        """Claim the next timed batch, False if one is already scheduled"""
+        return self.redis.set(
+            self.SCHEDULED, 1, ex=FULLTEXT_BATCH_WAIT + 60, nx=True)
+
+    def unschedule(self):
+        self.redis.delete(self.SCHEDULED)
+
+
+def queue_fulltext_index(bids):
+    """Queue bookmarks for the next fulltext batch"""
+    queue = FulltextQueue()
+    added, waiting = queue.push(bids)
+
+    # Kick off a batch right away every time another full batch is waiting,
+    # and make sure one runs soon for whatever is left over.
+    full_batches = waiting // FULLTEXT_BATCH_SIZE
+    if full_batches > (waiting - added) // FULLTEXT_BATCH_SIZE:
+        fulltext_index_batch.delay()
+    if queue.schedule():
+        fulltext_index_batch.apply_async(countdown=FULLTEXT_BATCH_WAIT)
 
-@celery.task(ignore_result=True, default_retry_delay=30)
-def fulltext_index_bookmark(bid, content):
-    """Insert bookmark data into the fulltext index."""
-    b = Bmark.query.get(bid)
 
-    if not b:
-        logger.error('Could not load bookmark to fulltext index: ' + str(bid))
-        fulltext_index_bookmark.retry(exc=BookmarkNotFoundException())
-    else:
-        from bookie.models.fulltext import get_writer
-        logger.debug('getting writer')
-        writer = get_writer()
-
-        if content:
-            found_content = content
-        elif b.readable:
-            found_content = b.readable.clean_content
-        else:
-            found_content = u""
+@celery.task(ignore_result=True)
+def fulltext_index_bookmark(bid, content=None):
+    """Queue a bookmark to be inserted into the fulltext index.
+
+    The content is ignored, the stored readable content is indexed. This is
+    only kept around for messages sent before fulltext_index_bookmarks.
+
+    """
+    queue_fulltext_index([bid])
+
+
+@celery.task(ignore_result=True)
+def fulltext_index_bookmarks(bids):
+    """Queue bookmarks to be inserted into the fulltext index.
+
+    The models send the bookmarks a transaction changed here once it commits,
+    see bookie.models.index_after_commit. Writing to the index a bookmark at
+    a time means thousands of commits fighting over the index lock after an
+    import, so the updates are batched up by fulltext_index_batch.
+
+    """
+    queue_fulltext_index(bids)
+
+
+@celery.task(ignore_result=True, default_retry_delay=60)
+def fulltext_index_batch():
+    """Write the queued bookmarks into the fulltext index.
+
+    Each batch of FULLTEXT_BATCH_SIZE bookmarks gets one writer and one
+    commit. We keep going while full batches are waiting.
+
+    """
+    queue = FulltextQueue()
+    # Anything queued from here on schedules its own batch.
+    queue.unschedule()
+
+    while True:
+        bids = queue.pop(FULLTEXT_BATCH_SIZE)
+        if not bids:
+            break
 
         try:
-            writer.update_document(
-                bid=unicode(b.bid),
-                description=b.description if b.description else u"",
-                extended=b.extended if b.extended else u"",
-                tags=b.tag_str if b.tag_str else u"",
-                readable=found_content,
-                username=b.username,
-                is_private=b.is_private,
-            )
-            writer.commit()
-            logger.debug('writer commit')
-        except (IndexingError, LockError), exc:
-            # There was an issue saving into the index.
-            logger.error(exc)
+            # The database fulltext engine writes to the db.
+            trans = transaction.begin()
+            missing = index_bookmarks(bids)
+            trans.commit()
+            logger.debug('indexed {0} bookmarks'.format(len(bids)))
+        except Exception, exc:
+            # Whatever went wrong, the bookmarks can't be lost off the queue.
+            transaction.abort()
+            logger.exception(exc)
             logger.warning('sending back to the queue')
-            # This should send the work over to a celery task that will try
-            # again in that space.
-            writer.cancel()
-            fulltext_index_bookmark.retry(exc=exc, countdown=60)
+            queue.push(bids)
+            raise fulltext_index_batch.retry(exc=exc)
+
+        for bid in missing:
+            logger.debug(
+                'Removed deleted bookmark from fulltext index: ' + str(bid))
+
+        if len(bids) < FULLTEXT_BATCH_SIZE:
+            break
+
+
+def rebuild_fulltext_index(procs=1, sync=False, progress=None):
+    """Build a fresh fulltext index and swap it in, see rebuild_index
+
+    Bookmarks changed while the rebuild was running are reindexed on top of
+    the new index, right away if sync or else through the queue.
+
+    """
+    started = rebuild_index(procs=procs, progress=progress)
+
+    changed = Bmark.query.outerjoin(Readable, Bmark.readable).\
+        with_entities(Bmark.bid).\
+        filter(or_(
+            Bmark.stored >= started,
+            Bmark.updated >= started,
+            Readable.imported >= started))
+    bids = [bid for (bid,) in changed]
+
+    if bids and sync:
+        index_bookmarks(bids)
+    elif bids:
+        queue_fulltext_index(bids)
+
+
+def log_reindex_progress(done, total):
+    logger.info('Reindexed {0} of {1} bookmarks'.format(done, total))
 
 
 @celery.task(ignore_result=True)
 def reindex_fulltext_allbookmarks(sync=False):
-    """Rebuild the fulltext index with all bookmarks."""
-    logger.debug("Starting freshen of fulltext index.")
+    """Rebuild the fulltext index with all bookmarks.
 
-    bookmarks = Bmark.query.all()
+    The new index is built next to the live one, which keeps serving searches
+    until the new one is swapped in. Celery workers can't fork extra writer
+    processes, scripts/admin/fulltext_index_reload.py can build with several.
 
-    for b in bookmarks:
-        if sync:
-            fulltext_index_bookmark(b.bid, None)
-        else:
-            fulltext_index_bookmark.delay(b.bid, None)
+    """
+    logger.debug("Starting rebuild of fulltext index.")
+    trans = transaction.begin()
+    rebuild_fulltext_index(sync=sync, progress=log_reindex_progress)
+    trans.commit()
 
 
 @celery.task(ignore_result=True)
 def missing_fulltext_index(sync=False):
-    """Find and add fulltext for bookmarks missing from fulltext."""
+    """Find and add fulltext for bookmarks missing from fulltext.
+
+    Documents left in the index for deleted bookmarks are queued up as well,
+    indexing a bookmark that's gone removes it from the index.
+
+    """
     logger.debug("Searching for missing fulltext bookmarks")
-    bookmarks = Bmark.query.limit(500).all()
-    searcher = get_fulltext_handler(None)
+    missing, stale = reconcile_index()
+    if stale:
+        logger.debug('{0} deleted bookmarks in fulltext'.format(len(stale)))
 
-    for bmark in bookmarks:
-        if searcher.findByID(bmark.bid):
-            continue
-        else:
-            fulltext_index_bookmark.delay(bmark.bid, None)
+    bids = missing + stale
+    if bids and sync:
+        trans = transaction.begin()
+        index_bookmarks(bids)
+        trans.commit()
+    elif bids:
+        queue_fulltext_index(bids)
 
 
 @celery.task(ignore_result=True)
@@ -320,22 +468,151 @@ def process_twitter_connections(username=None):
         create_twitter_api(connection)
 
 
+class FetchRun(object):
+    """Keep track of the runs of fetch_unfetched_bmark_content
+
+    This lives in redis next to the celery broker so all of the workers share
+    it. The lock keeps more than one run from going at once. It expires in
+    case the worker holding it dies, so it's renewed after every batch. The
+    last bookmark fetched is kept so the next run picks up from there.
+
+    """
+    LOCK = 'bookie:fetch:running'
+    LAST = 'bookie:fetch:last_bid'
+    LOCK_TTL = 10 * 60
+
+    def __init__(self):
+        self.redis = StrictRedis.from_url(INI.get('celery_broker'))
+        self.token = str(uuid4())
+
+    def acquire(self):
+        return self.redis.set(self.LOCK, self.token, ex=self.LOCK_TTL, nx=True)
+
+    def renew(self):
+        self.redis.expire(self.LOCK, self.LOCK_TTL)
+
+    def release(self):
+        # Once it's expired another run could hold it, leave theirs alone.
+        if self.redis.get(self.LOCK) == self.token:
+            self.redis.delete(self.LOCK)
+
+    def last_bid(self):
+        return int(self.redis.get(self.LAST) or 0)
+
+    def save(self, last):
+        """Note the last bookmark fetched, None starts over from the top"""
+        if last is None:
+            self.redis.delete(self.LAST)
+        else:
+            self.redis.set(self.LAST, last)
+        self.renew()
+
+
+def fetch_unfetched_batches(last=0, max_batches=None, progress=None):
+    """Fetch the content of the unfetched bookmarks after bid last
+
+    :param max_batches: stop after this many batches
+    :param progress: called with the bid of the last bookmark of each batch
+
+    The bookmarks are fetched FETCH_BATCH_SIZE at a time by a ContentFetcher
+    and each batch is stored in one transaction. We don't keep a transaction
+    open while we wait on the network.
+
+    A url is only fetched once per batch, and not at all if we've already
+    fetched it for another bookmark.
+
+    Returns the bid of the last bookmark fetched if it stopped with more
+    waiting, otherwise None.
+
+    """
+    if max_batches is None:
+        max_batches = FETCH_MAX_BATCHES
+    fetcher = ContentFetcher(
+        workers=FETCH_WORKERS,
+        per_host=FETCH_PER_HOST,
+        timeout=FETCH_TIMEOUT,
+        max_bytes=FETCH_MAX_BYTES)
+
+    for count in range(max_batches + 1):
+        trans = transaction.begin()
+        batch = Bmark.query.outerjoin(Readable, Bmark.readable).\
+            join(Bmark.hashed).\
+            with_entities(Bmark.bid, Bmark.hash_id, Hashed.url).\
+            filter(Readable.imported.is_(None)).\
+            filter(Bmark.bid > last).\
+            order_by(Bmark.bid).\
+            limit(FETCH_BATCH_SIZE).\
+            all()
+        trans.commit()
+        if not batch:
+            return None
+        if count == max_batches:
+            return last
+        last = batch[-1][0]
+
+        trans = transaction.begin()
+        shared = ReadableMgr.fetched_by_hash(
+            [hash_id for bid, hash_id, url in batch])
+        urls = dict((hash_id, url) for bid, hash_id, url in batch
+                    if hash_id not in shared)
+        trans.commit()
+
+        hash_ids = sorted(urls)
+        reads = dict(zip(
+            hash_ids, fetcher.fetch([urls[h] for h in hash_ids])))
+
+        trans = transaction.begin()
+        shared = ReadableMgr.fetched_by_hash(shared.keys())
+        bmarks = Bmark.query.options(joinedload('readable')).filter(
+            Bmark.bid.in_([bid for bid, hash_id, url in batch]))
+        for bmark in bmarks:
+            if bmark.hash_id in reads:
+                store_readable(bmark, reads[bmark.hash_id])
+            elif bmark.hash_id in shared:
+                share_readable(bmark, shared[bmark.hash_id])
+        trans.commit()
+        logger.debug('fetched {0} urls for {1} bookmarks'.format(
+            len(reads), len(batch)))
+        if progress:
+            progress(last)
+
+
 @celery.task(ignore_result=True)
 def fetch_unfetched_bmark_content(ignore_result=True):
-    """Check the db for any unfetched content. Fetch and index."""
+    """Check the db for any unfetched content. Fetch and index.
+
+    Only one of these runs at a time, anything started while one is going
+    is dropped. A run stops after FETCH_MAX_BATCHES batches and starts a new
+    task to carry on from there, so the beat can't pile runs up behind a
+    backlog. See fetch_unfetched_batches.
+
+    """
     logger.info("Checking for unfetched bookmarks")
+    run = FetchRun()
+    if not run.acquire():
+        logger.info("Unfetched bookmarks are already being fetched")
+        return
 
-    url_list = Bmark.query.outerjoin(
-        Readable, Bmark.readable).\
-        filter(Readable.imported.is_(None)).all()
+    try:
+        last = fetch_unfetched_batches(
+            last=run.last_bid(),
+            progress=run.save)
+        run.save(last)
+    finally:
+        run.release()
 
-    for bmark in url_list:
-        fetch_bmark_content.delay(bmark.bid)
+    if last is not None:
+        fetch_unfetched_bmark_content.delay()
 
 
 @celery.task(ignore_result=True)
 def fetch_bmark_content(bid):
-    """Given a bookmark, fetch its content and index it."""
+    """Given a bookmark, fetch its content and index it.
+
+    If we already have the page for this url, from this bookmark or another
+    one, we only fetch it again if the server says it changed.
+
+    """
     trans = transaction.begin()
 
     if not bid:
@@ -345,8 +622,23 @@ def fetch_bmark_content(bid):
         raise Exception('Bookmark not found: ' + str(bid))
     hashed = bmark.hashed
 
+    last = bmark.readable
+    if not last or last.status_code != 200 or last.content is None:
+        shared = ReadableMgr.fetched_by_hash([bmark.hash_id])
+        if bmark.hash_id in shared:
+            share_readable(bmark, shared[bmark.hash_id])
+            trans.commit()
+            return
+        last = None
+
     try:
-        read = ReadUrl.parse(hashed.url)
+        read = ReadUrl.parse(
+            hashed.url,
+            timeout=FETCH_TIMEOUT,
+            max_bytes=FETCH_MAX_BYTES,
+            etag=last.etag if last else None,
+            last_modified=last.last_modified if last else None,
+            digest=last.content_digest if last else None)
     except ValueError:
         # We hit this where urllib2 choked trying to get the protocol type of
         # this url to fetch it.
@@ -354,7 +646,27 @@ def fetch_bmark_content(bid):
         logger.error('exc')
         read = None
 
-    if read:
+    store_readable(bmark, read)
+    trans.commit()
+
+
+def store_readable(bmark, read):
+    """Save what we read from the bookmark's url onto its readable
+
+    :param read: the Readable from ReadUrl, None if we couldn't read the url
+
+    Saving the readable queues up the bookmark to be fulltext indexed. The
+    tags suggested by the page are worked out here too, so the edit page
+    doesn't have to.
+
+    """
+    hashed = bmark.hashed
+    if read and read.is_unchanged() and bmark.readable:
+        # What we have is still good, just note that we checked.
+        bmark.readable.imported = datetime.utcnow()
+        bmark.readable.etag = read.etag
+        bmark.readable.last_modified = read.last_modified
+    elif read:
         logger.debug(read)
         logger.debug(read.content)
 
@@ -365,36 +677,49 @@ def fetch_bmark_content(bid):
             read.is_error(),
             read.status_message))
 
-        if not read.is_image():
-            if not bmark.readable:
-                bmark.readable = Readable()
+        if not bmark.readable:
+            bmark.readable = Readable()
 
+        if not read.is_image():
             bmark.readable.content = read.content
+            bmark.readable.clean_content = read.clean_content
+            bmark.readable.tag_suggestions = u' '.join(
+                suggest_content_tags(read.clean_content))
         else:
-            if not bmark.readable:
-                bmark.readable = Readable()
             bmark.readable.content = None
+            bmark.readable.clean_content = None
+            bmark.readable.tag_suggestions = u''
 
         # set some of the extra metadata
         bmark.readable.content_type = read.content_type
         bmark.readable.status_code = read.status
         bmark.readable.status_message = read.status_message
-        trans.commit()
-        fulltext_index_bookmark.delay(
-            bid,
-            read.content if read else None)
+        bmark.readable.etag = read.etag
+        bmark.readable.last_modified = read.last_modified
+        bmark.readable.content_digest = read.digest
+        bmark.readable.imported = datetime.utcnow()
     else:
         logger.error(
-            'No readable record for bookmark: ',
-            str(bid), str(bmark.hashed.url))
+            'No readable record for bookmark: ' +
+            str(bmark.bid) + ' ' + str(hashed.url))
 
         # There was a failure reading the thing.
         bmark.readable = Readable()
-        bmark.readable.status = '900'
+        bmark.readable.status_code = STATUS_CODES['900']
         bmark.readable.status_message = (
             'No readable record '
             'during existing processing')
-        trans.commit()
+
+
+def share_readable(bmark, source):
+    """Give the bookmark a copy of the page another bookmark already read"""
+    if not bmark.readable:
+        bmark.readable = Readable()
+
+    for attr in ('content', 'clean_content', 'content_type', 'status_code',
+                 'status_message', 'etag', 'last_modified', 'content_digest',
+                 'tag_suggestions', 'imported'):
+        setattr(bmark.readable, attr, getattr(source, attr))
 
 
 @celery.task(ignore_result=True)
@@ -0,0 +1,131 @@
+"""Exporters for bookmarks
+
+Exports can be huge, so they're written out as they're read. The bookmarks
+come from BmarkMgr.user_dump a chunk at a time and each exporter yields its
+format piece by piece, which is handed to the server as the response's
+app_iter.
+
+"""
+import json
+import time
+import transaction
+import zlib
+
+from markupsafe import escape
+
+# How much of the export to build up before handing it to the server.
+WRITE_SIZE = 64 * 1024
+
+NETSCAPE_HEADER = u"""<!DOCTYPE NETSCAPE-Bookmark-file-1>
+<META HTTP-EQUIV="Content-Type" CONTENT="text/html; charset=UTF-8">
+<!-- This is an automatically generated file.
+  It will be read and overwritten.
+  Do Not Edit! -->
+<TITLE>Bookmarks</TITLE>
+<H1>Bookmarks</H1>
+<DL><p>
+"""
+NETSCAPE_FOOTER = u"""</DL><p>
+"""
+
+
+def json_export(bmarks, date):
+    """Write the bookmarks out as the json of the api export
+
+    :param bmarks: iterable of the Bmarks to export
+    :param date: when the export was made
+
+    """
+    yield u'{"bmarks": ['
+    count = 0
+    for bmark in bmarks:
+        bmark_dict = dict(bmark)
+        bmark_dict['hashed'] = dict(bmark.hashed)
+        if count:
+            yield u', '
+        yield json.dumps(bmark_dict)
+        count += 1
+    yield u'], "count": {0}, "date": {1}}}'.format(
+        count, json.dumps(str(date)))
+
+
+def netscape_export(bmarks):
+    """Write the bookmarks out as a Netscape bookmarks file
+
+    This is the html format browsers import and export bookmarks in.
+
+    """
+    yield NETSCAPE_HEADER
+    for bmark in bmarks:
+        url = escape(bmark.hashed.url)
+        yield u'    <DT><A HREF="{0}" LAST_VISIT="" ADD_DATE="{1}" ' \
+            u'TAGS="{2}"{3}>{4}</A>\n'.format(
+                url,
+                time.mktime(bmark.stored.timetuple()),
+                escape(u','.join(bmark.tags)),
+                u' PRIVATE="1"' if bmark.is_private else u'',
+                escape(bmark.description) if bmark.description else url)
+        if bmark.extended:
+            yield u'    <DD>{0}\n'.format(escape(bmark.extended))
+    yield NETSCAPE_FOOTER
+
+
+def _buffered(pieces, size=WRITE_SIZE):
+    """Join the unicode pieces into utf-8 blocks of about size bytes"""
+    block = []
+    length = 0
+    for piece in pieces:
+        piece = piece.encode('utf-8')
+        block.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield ''.join(block)
+            block = []
+            length = 0
+    if block:
+        yield ''.join(block)
+
+
+def _gzipped(blocks):
+    """Compress the blocks into one gzip stream as they go by"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for block in blocks:
+        compressed = compressor.compress(block)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def _finish_transaction(blocks):
+    """End the transaction the export is read in once it's written out
+
+    pyramid_tm has finished the request's transaction before the server
+    gets to the app_iter, so the queries of the export run in a new one
+    that's ours to clean up.
+
+    """
+    try:
+        for block in blocks:
+            yield block
+    finally:
+        transaction.abort()
+
+
+def stream_response(request, pieces, content_type):
+    """Send the export pieces out as the body of the request's response
+
+    The body is gzipped on the way out when the client accepts that.
+
+    """
+    response = request.response
+    response.content_type = content_type
+    response.charset = 'utf-8'
+    response.vary = ('Accept-Encoding', )
+
+    blocks = _buffered(pieces)
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        response.content_encoding = 'gzip'
+        blocks = _gzipped(blocks)
+
+    response.app_iter = _finish_transaction(blocks)
+    return response
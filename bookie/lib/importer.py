@@ -1,26 +1,50 @@
-"""Importers for bookmarks"""
-import json
+"""Importers for bookmarks
+
+The import files can be huge, so none of the importers load the whole file.
+The format is sniffed from the first few KB and each importer then streams the
+file, handing its bookmarks to Importer.bulk_load a chunk at a time.
+
+"""
+import codecs
 import os
 import random
+import re
+import shutil
 import string
-import time
 import transaction
 from datetime import datetime
+from json.decoder import scanstring
+from urlparse import urlparse
 from dateutil import parser as dateparser
-from BeautifulSoup import BeautifulSoup
 from lxml import etree
-from lxml.etree import XMLSyntaxError
 from HTMLParser import HTMLParser
-from bookie.lib.urlhash import generate_hash
 from bookie.models import (
     BmarkMgr,
-    DBSession,
-    InvalidBookmark,
+    HashedMgr,
+    TagMgr,
+    index_after_commit,
 )
+from bookie.models import fulltext
 
 
 IMPORTED = u"importer"
-COMMIT_SIZE = 25
+COMMIT_SIZE = 1000
+# How much of the file we look at to figure out the format. The doctype or
+# root element has to show up in this much of it.
+SNIFF_SIZE = 4096
+READ_SIZE = 64 * 1024
+
+NETSCAPE_DOCTYPE = u'<!DOCTYPE NETSCAPE-BOOKMARK-FILE-1'
+# The <posts> root of a Delicious export, after any xml declaration,
+# comments and doctype.
+POSTS_RE = re.compile(
+    r'^(<\?xml[^>]*\?>\s*)?'
+    r'(<!--.*?-->\s*|<!DOCTYPE[^>\[]*(\[.*?\])?\s*>\s*)*'
+    r'<posts[\s>/]',
+    re.DOTALL)
+JSON_TOKEN_RE = re.compile(
+    r'[\s,:]*(?:([\[\]{}])|(")|([-+0-9.eE]+)|(true|false|null))')
+JSON_LITERALS = {u'true': True, u'false': False, u'null': None}
 
 
 def store_import_file(storage_dir, username, files):
@@ -38,12 +62,274 @@ def store_import_file(storage_dir, username, files):
     out_fname = "{0}/{1}.{2}".format(
         out_dir, username, files.filename)
     out = open(out_fname, 'w')
-    out.write(files.file.read())
+    shutil.copyfileobj(files.file, out, READ_SIZE)
     out.close()
 
     return out_fname
 
 
+def sniff(file_io):
+    """Get the start of the file as unicode so we can check its format
+
+    The file is left rewound so it can be sniffed again or processed.
+
+    """
+    if file_io.closed:
+        file_io = open(file_io.name)
+
+    file_io.seek(0)
+    head = file_io.read(SNIFF_SIZE)
+    file_io.seek(0)
+
+    if isinstance(head, str):
+        head = head.decode('utf-8', 'replace')
+    return head.lstrip(u'\ufeff \t\r\n')
+
+
+def has_headings(file_io):
+    """Check if a bookmarks html file has any <h3> headings in it
+
+    Google Bookmarks files each link under a heading for each of its tags,
+    Delicious doesn't use headings at all. Unlike sniff this looks through
+    the whole file, a block at a time, since a Delicious file has no heading
+    to stop at. The file is left rewound.
+
+    """
+    if file_io.closed:
+        file_io = open(file_io.name)
+
+    file_io.seek(0)
+    found = False
+    tail = u''
+    for text in _iter_decoded(file_io):
+        text = tail + text.lower()
+        if u'<h3' in text:
+            found = True
+            break
+        # Keep the end in case a tag is split across blocks.
+        tail = text[-2:]
+    file_io.seek(0)
+    return found
+
+
+def _iter_decoded(file_handle):
+    """Read the file in chunks of unicode text"""
+    decoder = codecs.getincrementaldecoder('utf-8-sig')('replace')
+    while True:
+        chunk = file_handle.read(READ_SIZE)
+        if isinstance(chunk, unicode):
+            text = chunk
+        else:
+            text = decoder.decode(chunk, final=not chunk)
+
+        if text:
+            yield text
+        if not chunk:
+            break
+
+
+def _iter_json_tokens(file_handle):
+    """Tokenize a JSON document without reading all of it into memory
+
+    Yields (token, value) pairs. The token is one of the brackets, or
+    'value' for strings, numbers and literals. Commas and colons are skipped,
+    which has the nice side effect of ignoring the trailing comma Firefox
+    leaves at the end of its arrays.
+
+    """
+    chunks = _iter_decoded(file_handle)
+    buf = u''
+    pos = 0
+    eof = False
+
+    while True:
+        match = JSON_TOKEN_RE.match(buf, pos)
+        needs_more = False
+
+        if match is None:
+            if not buf[pos:].strip(u' \t\r\n,:'):
+                if eof:
+                    return
+            elif eof:
+                raise ValueError('Invalid JSON near: ' + repr(buf[pos:]))
+            needs_more = True
+        elif match.group(1):
+            yield match.group(1), None
+            pos = match.end()
+        elif match.group(2):
+            try:
+                value, pos = scanstring(buf, match.end(), None, False)
+                yield 'value', value
+            except ValueError:
+                # The string carries on into the next chunk.
+                if eof:
+                    raise
+                needs_more = True
+        elif match.end() == len(buf) and not eof:
+            # Numbers and literals might be cut off at the end of the chunk.
+            needs_more = True
+        elif match.group(3):
+            number = match.group(3)
+            if u'.' in number or u'e' in number or u'E' in number:
+                yield 'value', float(number)
+            else:
+                yield 'value', int(number)
+            pos = match.end()
+        else:
+            yield 'value', JSON_LITERALS[match.group(4)]
+            pos = match.end()
+
+        if needs_more:
+            try:
+                buf = buf[pos:] + chunks.next()
+            except StopIteration:
+                buf = buf[pos:]
+                eof = True
+            pos = 0
+
+
+def _iter_json_children(file_handle):
+    """Stream the objects found in "children" arrays of a JSON document
+
+    Yields (child, parents) where parents is the list of objects enclosing
+    the child, outermost first. The children arrays are never built up so
+    only the current branch of the tree is held in memory. This relies on
+    the rest of an object's keys coming before its children.
+
+    """
+    # Each frame is [container, pending key, streams its children]
+    stack = []
+    for token, value in _iter_json_tokens(file_handle):
+        if token == '{':
+            stack.append([{}, None, False])
+            continue
+        elif token == '[':
+            streams = bool(stack) and stack[-1][1] == u'children'
+            stack.append([[], None, streams])
+            continue
+        elif token in ('}', ']'):
+            value = stack.pop()[0]
+            if not stack:
+                continue
+        elif isinstance(stack[-1][0], dict) and stack[-1][1] is None:
+            stack[-1][1] = value
+            continue
+
+        container, key, streams = stack[-1]
+        if isinstance(container, dict):
+            container[key] = value
+            stack[-1][1] = None
+        elif streams:
+            yield value, [frame[0] for frame in stack
+                          if isinstance(frame[0], dict)]
+        else:
+            container.append(value)
+
+
+class NetscapeParser(HTMLParser):
+    """Event based parser for the Netscape bookmark file format
+
+    Delicious and Google both export this format, which is a long run of
+    unclosed <DT> tags. Tree builders either choke on the nesting or have to
+    hold the whole file, so we just track the few tags we care about as they
+    go by. Finished links are collected in links until the caller takes them.
+
+    Each link is a dict of the anchor attributes plus the link text, the
+    extended description from a following <DD>, and the list of folder
+    headings the link is filed under.
+
+    """
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.links = []
+        # the headings of the <DL> folders we're nested in
+        self.folders = []
+        self.heading = None
+        self.pending = None
+        # the text we're collecting and the pending key it belongs in
+        self.text = None
+        self.target = None
+
+    def _end_text(self):
+        """Store the text we've been collecting where it belongs"""
+        if self.text is not None:
+            text = self.unescape(u"".join(self.text)).strip()
+            if self.target == 'heading':
+                self.heading = text
+            elif self.pending is not None:
+                self.pending[self.target] = text
+        self.text = None
+
+    def _flush(self):
+        """The pending link can't get any more content, finish it"""
+        self._end_text()
+        if self.pending is not None:
+            self.links.append(self.pending)
+            self.pending = None
+
+    def _start_text(self, target):
+        self.text = []
+        self.target = target
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('a', 'dt', 'dl', 'h3'):
+            self._flush()
+
+        if tag == 'a':
+            self.pending = dict(attrs)
+            self.pending.update({
+                'text': u"",
+                'extended': u"",
+                'folders': [f for f in self.folders if f],
+            })
+            self._start_text('text')
+        elif tag == 'dd' and self.pending is not None:
+            self._end_text()
+            self._start_text('extended')
+        elif tag == 'h3':
+            self._start_text('heading')
+        elif tag == 'dl':
+            self.folders.append(self.heading)
+            self.heading = None
+
+    def handle_endtag(self, tag):
+        if tag in ('a', 'h3'):
+            self._end_text()
+        elif tag == 'dl':
+            self._flush()
+            if self.folders:
+                self.folders.pop()
+
+    def handle_data(self, data):
+        if self.text is not None:
+            self.text.append(data)
+
+    def handle_charref(self, name):
+        self.handle_data(u"&#{0};".format(name))
+
+    def handle_entityref(self, name):
+        self.handle_data(u"&{0};".format(name))
+
+    def close(self):
+        HTMLParser.close(self)
+        self._flush()
+
+
+def iter_netscape_links(file_handle):
+    """Stream the links out of a Netscape bookmark file"""
+    parser = NetscapeParser()
+    for text in _iter_decoded(file_handle):
+        parser.feed(text)
+        for link in parser.links:
+            yield link
+        parser.links = []
+
+    parser.close()
+    for link in parser.links:
+        yield link
+
+
 class Importer(object):
     """The actual factory object we use for handling imports"""
 
@@ -56,6 +342,9 @@ class Importer(object):
         self.hash_list = set([b[0] for b in
                              BmarkMgr.hash_list(username=username)])
 
+        # name: Tag map of the tags resolved so far in this import
+        self.tag_map = {}
+
     def __new__(cls, *args, **kwargs):
         """Overriding new we return a subclass based on the file content"""
         if DelImporter.can_handle(args[0]):
@@ -81,289 +370,177 @@ class Importer(object):
         """Meant to be implemented in subclasses"""
         raise NotImplementedError("Please implement this in your importer")
 
-    def save_bookmark(self, url, desc, ext, tags, dt=None, is_private=False):
-        """Save the bookmark to the db
-
-        :param url: bookmark url
-        :param desc: one line description
-        :param ext: extended description/notes
-        :param tags: The string of tags to store with this bmark
-        :param mark: Instance of Bmark that we're storing to db
-
-        """
-        # If a bookmark has the tag "private" then we ignore it to prevent
-        # leaking user data.
-        if tags and 'private' in tags.lower().split(' '):
-            return None
-
-        check_hash = generate_hash(url)
-
-        # We should make sure that this url isn't already bookmarked before
-        # adding it...if the hash matches, you must skip!
-        if check_hash not in self.hash_list:
-            bmark = BmarkMgr.store(
-                url,
-                self.username,
-                desc,
-                ext,
-                tags,
-                dt=dt,
-                inserted_by=IMPORTED,
-                is_private=is_private,
-            )
-
-            # Add this hash to the list so that we can skip dupes in the
-            # same import set.
-            self.hash_list.add(check_hash)
-            return bmark
-
-        # If we don't store a bookmark then just return None back to the
-        # importer.
-        return None
+    def open(self):
+        """Get the import file ready to be read from the start"""
+        if self.file_handle.closed:
+            self.file_handle = open(self.file_handle.name)
+        self.file_handle.seek(0)
+        return self.file_handle
 
+    def bulk_load(self, rows):
+        """Save all of the parsed bookmarks to the db
 
-class DelImporter(Importer):
-    """Process a delicious html file"""
-
-    @staticmethod
-    def _is_delicious_format(soup, can_handle, delicious_doctype):
-        """A check for if this import files is a delicious format compat file
+        :param rows: iterable of (url, desc, ext, tags, dt, is_private) tuples
+            parsed out of the import file
 
-        Very fragile currently, it makes sure the first line is the doctype.
-        Any blank lines before it will cause it to fail
+        Bookmarks tagged private, with invalid urls, or that we've already got
+        are skipped. The rest are stored COMMIT_SIZE at a time with a few
+        multi-row inserts per chunk instead of a round trip per bookmark.
+        Rows are consumed as they come so a generator keeps memory down.
 
         """
-        if (soup.contents and
-                soup.contents[0] == delicious_doctype and
-                not soup.find('h3')):
-            can_handle = True
+        chunk = []
+        for row in rows:
+            url, desc, ext, tags, dt, is_private = row
 
-        return can_handle
-
-    @staticmethod
-    def can_handle(file_io):
-        """Check if this file is a google bookmarks format file
-
-        In order to check the file we have to read it and check it's content
-        type.
-
-        Google Bookmarks and Delicious both have the same content type, but
-        they use different formats. We use the fact that Google Bookmarks
-        uses <h3> tags and Delicious does not in order to differentiate these
-        two formats.
-        """
-        delicious_doctype = u'DOCTYPE NETSCAPE-Bookmark-file-1'
-
-        soup = BeautifulSoup(file_io)
-        can_handle = False
-        can_handle = DelImporter._is_delicious_format(soup,
-                                                      can_handle,
-                                                      delicious_doctype)
-
-        # make sure we reset the file_io object so that we can use it again
-        file_io.seek(0)
-        return can_handle
-
-    def process(self):
-        """Given a file, process it"""
-        soup = BeautifulSoup(self.file_handle)
-        htmlParser = HTMLParser()
-        count = 0
-
-        ids = []
-        for tag in soup.findAll('dt'):
-            if 'javascript:' in str(tag):
+            # If a bookmark has the tag "private" then we ignore it to prevent
+            # leaking user data.
+            if tags and 'private' in tags.lower().split(' '):
                 continue
 
-            # if we have a dd as next sibling, get it's content
-            if tag.nextSibling and tag.nextSibling.name == 'dd':
-                extended = tag.nextSibling.text
-            else:
-                extended = u""
-
-            link = tag.a
-
-            is_private = False
-            if link.has_key('private'):  # noqa
-                is_private = True
-
-            import_add_date = float(link['add_date'])
+            if not urlparse(url).netloc:
+                continue
 
-            if import_add_date > 9999999999:
-                # Remove microseconds from the timestamp
-                import_add_date = import_add_date / 1000
-            add_date = datetime.fromtimestamp(import_add_date)
+            # We should make sure that this url isn't already bookmarked
+            # before adding it...if the hash matches, you must skip! Add new
+            # ones to the list so that we skip dupes in the same import set.
+            check_hash = HashedMgr.hash_url(url)
+            if check_hash in self.hash_list:
+                continue
+            self.hash_list.add(check_hash)
 
-            try:
-                bmark = self.save_bookmark(
-                    unicode(link['href']),
-                    unicode(htmlParser.unescape(link.text)),
-                    unicode(extended),
-                    u" ".join(unicode(link.get('tags', '')).split(u',')),
-                    dt=add_date,
-                    is_private=is_private)
-                count = count + 1
-                DBSession.flush()
-            except InvalidBookmark:
-                bmark = None
-
-            if bmark:
-                ids.append(bmark.bid)
-
-            if count % COMMIT_SIZE == 0:
-                transaction.commit()
-
-        # Commit any that are left since the last commit performed.
-        transaction.commit()
+            chunk.append(row)
+            if len(chunk) == COMMIT_SIZE:
+                self._store_chunk(chunk)
+                chunk = []
 
-        from bookie.bcelery import tasks
-        # For each bookmark in this set that we saved, sign up to
-        # fetch its content.
-        for bid in ids:
-            tasks.fetch_bmark_content.delay(bid)
+        if chunk:
+            self._store_chunk(chunk)
 
         # Start a new transaction for the next grouping.
         transaction.begin()
 
+    def _store_chunk(self, rows):
+        """Store and commit one chunk of new bookmarks"""
+        names = set()
+        for row in rows:
+            names.update((row[3] or u"").lower().split(u" "))
+        self.tag_map.update(
+            TagMgr.resolve(names.difference(self.tag_map)))
+
+        ids = BmarkMgr.bulk_store(
+            rows,
+            self.username,
+            inserted_by=IMPORTED,
+            tag_map=self.tag_map)
+
+        # The bulk inserts skip the Bmark events, so index each new bookmark.
+        # Their content is left for fetch_unfetched_bmark_content, which
+        # fetches it in batches without hammering any one host.
+        if fulltext.indexed_in_database():
+            fulltext.index_bookmarks(ids)
+        else:
+            for bid in ids:
+                index_after_commit(bid)
+        transaction.commit()
 
-class DelXMLImporter(Importer):
-    """Process a delicious xml export file"""
-
-    @staticmethod
-    def _is_delicious_format(parsed, can_handle):
-        """A check for if this import files is a delicious xml format compat
-
-        The root xml element will be 'posts' if this is the case.
 
-        """
-        if parsed.docinfo and parsed.docinfo.root_name == 'posts':
-            can_handle = True
-        return can_handle
+class DelImporter(Importer):
+    """Process a delicious html file"""
 
     @staticmethod
     def can_handle(file_io):
-        """Check if this file is a google bookmarks format file
-
-        In order to check the file we have to read it and check it's content
-        type.
+        """Check if this file is a delicious bookmarks format file
 
         Google Bookmarks and Delicious both have the same content type, but
         they use different formats. We use the fact that Google Bookmarks
         uses <h3> tags and Delicious does not in order to differentiate these
-        two formats.
-        """
+        two formats, see has_headings.
 
-        try:
-            file_io.seek(0)
-            parsed = etree.parse(file_io)
-        except XMLSyntaxError:
-            # IF etree can't parse it, it's not our file.
-            return False
-        can_handle = False
-        can_handle = DelXMLImporter._is_delicious_format(parsed,
-                                                         can_handle)
+        """
+        head = sniff(file_io)
+        return (head.upper().startswith(NETSCAPE_DOCTYPE) and
+                not has_headings(file_io))
+
+    def _iter_rows(self):
+        for link in iter_netscape_links(self.open()):
+            href = link.get('href') or u""
+            if 'javascript:' in href:
+                continue
 
-        # make sure we reset the file_io object so that we can use it again
-        return can_handle
+            add_date = None
+            if link.get('add_date'):
+                import_add_date = float(link['add_date'])
+                if import_add_date > 9999999999:
+                    # Remove microseconds from the timestamp
+                    import_add_date = import_add_date / 1000
+                add_date = datetime.fromtimestamp(import_add_date)
+
+            yield (
+                unicode(href),
+                link['text'],
+                link['extended'],
+                u" ".join(unicode(link.get('tags') or u'').split(u',')),
+                add_date,
+                'private' in link)
 
     def process(self):
         """Given a file, process it"""
-        if self.file_handle.closed:
-            self.file_handle = open(self.file_handle.name)
+        self.bulk_load(self._iter_rows())
 
-        self.file_handle.seek(0)
-        parsed = etree.parse(self.file_handle)
-        count = 0
 
-        ids = []
-        for post in parsed.findall('post'):
-            if 'javascript:' in post.get('href'):
-                continue
+class DelXMLImporter(Importer):
+    """Process a delicious xml export file"""
 
-            add_date = dateparser.parse(post.get('time'))
+    @staticmethod
+    def can_handle(file_io):
+        """Check if this file is a delicious xml export
 
-            if post.get('private') == "no":
-                is_private = False
-            elif post.get('private') == "yes":
-                is_private = True
+        The root xml element will be 'posts' if this is the case.
 
-            try:
-                bmark = self.save_bookmark(
-                    unicode(post.get('href')),
+        """
+        return POSTS_RE.match(sniff(file_io)) is not None
+
+    def _iter_rows(self):
+        posts = etree.iterparse(self.open(), events=('end',), tag='post')
+        for event, post in posts:
+            href = post.get('href')
+            if 'javascript:' not in href:
+                add_date = dateparser.parse(post.get('time'))
+                yield (
+                    unicode(href),
                     unicode(post.get('description')),
                     unicode(post.get('extended')),
                     unicode(post.get('tag')),
-                    dt=add_date,
-                    is_private=is_private)
-                count = count + 1
-                if bmark:
-                    bmark.stored = bmark.stored.replace(tzinfo=None)
-                    DBSession.flush()
-            except InvalidBookmark:
-                bmark = None
-
-            if bmark:
-                ids.append(bmark.bid)
-
-            if count % COMMIT_SIZE == 0:
-                transaction.commit()
-
-        # Commit any that are left since the last commit performed.
-        transaction.commit()
+                    add_date.replace(tzinfo=None),
+                    post.get('private') == "yes")
 
-        from bookie.bcelery import tasks
-        # For each bookmark in this set that we saved, sign up to
-        # fetch its content.
-        for bid in ids:
-            tasks.fetch_bmark_content.delay(bid)
+            # Drop the posts we're done with so the tree doesn't grow.
+            post.clear()
+            while post.getprevious() is not None:
+                del post.getparent()[0]
 
-        # Start a new transaction for the next grouping.
-        transaction.begin()
+    def process(self):
+        """Given a file, process it"""
+        self.bulk_load(self._iter_rows())
 
 
 class GBookmarkImporter(Importer):
     """Process a Google Bookmark export html file"""
 
-    @staticmethod
-    def _is_google_format(soup, gbookmark_doctype, can_handle):
-        """Verify that this import file is in the google export format
-
-        Google only puts one tag at a time and needs to be looped through to
-        get them all. See the sample files in the test_importer directory
-
-        """
-        if (soup.contents and
-                soup.contents[0] == gbookmark_doctype and
-                soup.find('h3')):
-            can_handle = True
-
-        return can_handle
-
     @staticmethod
     def can_handle(file_io):
         """Check if this file is a google bookmarks format file
 
-        In order to check the file we have to read it and check it's content
-        type
-
         Google Bookmarks and Delicious both have the same content type, but
         they use different formats. We use the fact that Google Bookmarks
         uses <h3> tags and Delicious does not in order to differentiate these
-        two formats.
+        two formats, see has_headings.
+
         """
-        if (file_io.closed):
-            file_io = open(file_io.name)
-        file_io.seek(0)
-        soup = BeautifulSoup(file_io)
-        can_handle = False
-        gbookmark_doctype = "DOCTYPE NETSCAPE-Bookmark-file-1"
-        can_handle = GBookmarkImporter._is_google_format(soup,
-                                                         gbookmark_doctype,
-                                                         can_handle)
-
-        # make sure we reset the file_io object so that we can use it again
-        file_io.seek(0)
-        return can_handle
+        head = sniff(file_io)
+        return (head.upper().startswith(NETSCAPE_DOCTYPE) and
+                has_headings(file_io))
 
     def process(self):
         """Process an html google bookmarks export and import them into bookie
@@ -371,233 +548,131 @@ class GBookmarkImporter(Importer):
         under that heading. If a url has N tags, it will appear N times, once
         under each heading.
         """
-        count = 0
-        if (self.file_handle.closed):
-            self.file_handle = open(self.file_handle.name)
-        soup = BeautifulSoup(self.file_handle)
-        if not soup.contents[0] == "DOCTYPE NETSCAPE-Bookmark-file-1":
-            raise Exception("File is not a google bookmarks file")
-
-        htmlParser = HTMLParser()
+        # A url's tags are spread over the whole file, so we have to collect
+        # every url before we can save any of them.
         urls = dict()  # url:url_metadata
 
-        # we don't want to just import all the available urls, since each url
-        # occurs once per tag. loop through and aggregate the tags for each url
-        for tag in soup.findAll('h3'):
-            links = tag.findNextSibling('dl')
-
-            if links is not None:
-                links = links.findAll("a")
-
-                for link in links:
-                    url = link["href"]
-                    if url.startswith('javascript:'):
-                        continue
-                    tag_text = tag.text.replace(" ", "-")
-                    if url in urls:
-                        urls[url]['tags'].append(tag_text)
-                    else:
-                        tags = [tag_text] if tag_text != 'Unlabeled' else []
-
-                        # get extended description
-                        has_extended = (
-                            link.parent.nextSibling and
-                            link.parent.nextSibling.name == 'dd')
-                        if has_extended:
-                            extended = link.parent.nextSibling.text
-                        else:
-                            extended = ""
-
-                        # Must use has_key here due to the link coming from
-                        # the parser and it's not a true dict.
-                        if link.has_key('add_date'):  # noqa
-                            if int(link['add_date']) < 9999999999:
-                                timestamp_added = int(link['add_date'])
-                            else:
-                                timestamp_added = float(link['add_date']) / 1e6
-                        else:
-                            link['add_date'] = time.time()
-
-                        urls[url] = {
-                            'description': htmlParser.unescape(link.text),
-                            'tags': tags,
-                            'extended': extended,
-                            'date_added': datetime.fromtimestamp(
-                                timestamp_added),
-                        }
+        for link in iter_netscape_links(self.open()):
+            # Only links filed under a heading get imported.
+            if not link['folders']:
+                continue
 
-        # save the bookmarks
-        ids = []
-        for url, metadata in urls.items():
-            try:
-                bmark = self.save_bookmark(
-                    unicode(url),
-                    unicode(metadata['description']),
-                    unicode(metadata['extended']),
-                    u" ".join(metadata['tags']),
-                    dt=metadata['date_added'])
-                DBSession.flush()
-            except InvalidBookmark:
-                bmark = None
-            if bmark:
-                ids.append(bmark.bid)
-            if count % COMMIT_SIZE == 0:
-                transaction.commit()
-                # Start a new transaction for the next grouping.
-                transaction.begin()
-
-        # Commit any that are left since the last commit performed.
-        transaction.commit()
+            url = link.get('href') or u""
+            if url.startswith('javascript:'):
+                continue
 
-        from bookie.bcelery import tasks
-        # For each bookmark in this set that we saved, sign up to
-        # fetch its content.
-        for bid in ids:
-            tasks.fetch_bmark_content.delay(bid)
+            tags = [folder.replace(" ", "-") for folder in link['folders']
+                    if folder != 'Unlabeled']
+            if url in urls:
+                urls[url]['tags'].extend(tags)
+                continue
+
+            date_added = None
+            if link.get('add_date'):
+                if int(link['add_date']) < 9999999999:
+                    timestamp_added = int(link['add_date'])
+                else:
+                    timestamp_added = float(link['add_date']) / 1e6
+                date_added = datetime.fromtimestamp(timestamp_added)
+
+            urls[url] = {
+                'description': link['text'],
+                'tags': tags,
+                'extended': link['extended'],
+                'date_added': date_added,
+            }
+
+        # save the bookmarks
+        self.bulk_load((
+            unicode(url),
+            metadata['description'],
+            metadata['extended'],
+            u" ".join(metadata['tags']),
+            metadata['date_added'],
+            False) for url, metadata in urls.iteritems())
 
 
 class FBookmarkImporter(Importer):
     """Process a FireFox backup export json file"""
     MOZ_CONTAINER = "text/x-moz-place-container"
+    MOZ_PLACE = "text/x-moz-place"
+    UNWANTED_SCHEME = ("data", "place", "javascript")
 
     @staticmethod
-    def _is_firefox_format(json, can_handle):
-        """Verify that this import file is in the firefox backup
-        export format
+    def can_handle(file_io):
+        """Check if this file is a Firefox bookmarks format file
+
+        The backup is one json object whose "type" is
+        "text/x-moz-place-container". The type comes before the children so
+        it shows up in the start of the file.
 
-        Firefox json file has a variable "type" which is equal to
-        "text/x-moz-place-container"
         """
-        if json['type'] == FBookmarkImporter.MOZ_CONTAINER:
-            can_handle = True
+        head = sniff(file_io)
+        return (head.startswith(u'{') and
+                FBookmarkImporter.MOZ_CONTAINER in head)
 
-        return can_handle
+    def _is_good(self, child):
+        """Check if the child is a bookmark we want to import
 
-    @staticmethod
-    def can_handle(file_io):
-        """Check if this file is a Firefox bookmarks format file
+        Places with a "data", "place", "javascript" uri are skipped.
 
-        In order to check the file we have to read it and check it's content
-        has a variable "type" which is equal to "text/x-moz-place-container"
         """
-        if (file_io.closed):
-            file_io = open(file_io.name)
-        file_io.seek(0)
-        can_handle = False
-        try:
-            backup_json = json.load(file_io)
-        except:
-            file_io.seek(0)
-            return can_handle
-
-        can_handle = FBookmarkImporter._is_firefox_format(backup_json,
-                                                          can_handle)
-
-        # make sure we reset the file_io object so that we can use it again
-        file_io.seek(0)
-        return can_handle
-
-    def bmap_add(self, bmark, bmap):
-        if bmark["uri"] not in bmap:
-            bmap[bmark["uri"]] = bmark
+        return (child.get("type") == self.MOZ_PLACE and
+                child.get("uri") and
+                not child["uri"].split(":", 1)[0] in self.UNWANTED_SCHEME)
 
     def process(self):
         """Process an json firefox bookmarks export and import them into bookie
-        """
-        MOZ_PLACE = "text/x-moz-place"
-        UNWANTED_SCHEME = ("data", "place", "javascript")
 
-        count = 0
-        if (self.file_handle.closed):
-            self.file_handle = open(self.file_handle.name)
-
-        content = self.file_handle.read().decode("UTF-8")
-        # HACK: Firefox' JSON writer leaves a trailing comma
-        # HACK: at the end of the array, which no parser accepts
-        if content.endswith(u"}]},]}"):
-            content = content[:-6] + u"}]}]}"
-        root = json.loads(content)
+        The places under each of the top level folders are bookmarks. The
+        places in the tags folder hold the tags for them, the name of the
+        folder they're in is the tag. Folders nested in the top level folders
+        count as tags for their places as well.
 
-        # make a dictionary of unique bookmarks
+        """
+        # make a dictionary of unique bookmarks, the tags folder tends to be
+        # at the end so we have to collect everything before saving.
         bmap = {}
 
-        # check if uri of child starts with "data", "place", "javascript"
-        def is_good(child):
-            return not child["uri"].split(":", 1)[0] in UNWANTED_SCHEME
-
-        # find toplevel subfolders and tag folders
-        folders = []
-        tagfolders = []
-        for child in root["children"]:
-            if child.get("root") == "tagsFolder":
-                tagfolders.extend(child["children"])
-            elif child.get("root"):
-                folders.append(child)
-
-        # visit all subfolders recursively
-        visited = set()
-        while folders:
-            next = folders.pop()
-            if next["id"] in visited:
+        for child, parents in _iter_json_children(self.open()):
+            if len(parents) < 2 or not self._is_good(child):
                 continue
-            for child in next["children"]:
-                if child["type"] == self.MOZ_CONTAINER:
-                    folders.append(child)
-                    tagfolders.append(child)
-                elif child["type"] == MOZ_PLACE and \
-                        child.get("uri") and \
-                        is_good(child):
-                    self.bmap_add(child, bmap)
-            visited.add(next["id"])
-
-        # visit all tag folders
-        for tag in tagfolders:
-            for bmark in tag["children"]:
-                if bmark["type"] == MOZ_PLACE and \
-                        bmark.get("uri") and \
-                        is_good(bmark):
-                    self.bmap_add(bmark, bmap)
-                    if "tags" not in bmap[bmark["uri"]]:
-                        bmap[bmark["uri"]]["tags"] = []
-                    bmap[bmark["uri"]]["tags"].append(
-                        tag["title"].replace(" ", "-"))
 
-        # save the bookmarks
-        # annos has the information about the url like name, flags, expires,
-        # value, type etc
-        ids = []
-        for url, metadata in bmap.items():
-            if metadata.get('annos') is not None:
-                if metadata.get('annos')[0].get('value') is None:
-                    metadata['annos'][0]['value'] = ''
-            else:
-                metadata['annos'] = [{}]
-                metadata['annos'][0]['value'] = ''
-            if metadata.get('tags') is None:
-                metadata['tags'] = ''
-            try:
-                bookmark = self.save_bookmark(
-                    unicode(url),
-                    unicode(metadata['title']),
-                    unicode(metadata['annos'][0]['value']),
-                    u" ".join(metadata['tags']),
-                    dt=datetime.fromtimestamp(
-                        metadata['dateAdded']/1e6))
-                DBSession.flush()
-            except InvalidBookmark:
-                bookmark = None
-            if bookmark:
-                ids.append(bookmark.bid)
-            if count % COMMIT_SIZE == 0:
-                transaction.commit()
-                # Start a new transaction for the next grouping.
-                transaction.begin()
-
-        # Commit any that are left since the last commit performed.
-        transaction.commit()
+            root = parents[1].get("root")
+            if not root:
+                continue
+
+            tag = None
+            if root == "tagsFolder":
+                if len(parents) != 3:
+                    continue
+                tag = parents[2]["title"]
+            elif len(parents) > 2:
+                tag = parents[-1]["title"]
+
+            # The copy of the place in the tags folder is only there to tag
+            # it, the details we want come from the copy in a real folder.
+            in_tags = root == "tagsFolder"
+            metadata = bmap.get(child["uri"])
+            if metadata is None or (metadata['in_tags'] and not in_tags):
+                # annos has the information about the url like name, flags,
+                # expires, value, type etc
+                annos = child.get("annos") or [{}]
+                bmap[child["uri"]] = {
+                    'title': child.get("title"),
+                    'extended': annos[0].get("value") or u"",
+                    'dateAdded': child["dateAdded"],
+                    'in_tags': in_tags,
+                    'tags': metadata['tags'] if metadata else [],
+                }
+            if tag:
+                bmap[child["uri"]]['tags'].append(tag.replace(" ", "-"))
 
-        from bookie.bcelery import tasks
-        # For each bookmark in this set that we saved, sign up to
-        # fetch its content.
-        for bid in ids:
-            tasks.fetch_bmark_content.delay(bid)
+        # save the bookmarks
+        self.bulk_load((
+            unicode(url),
+            unicode(metadata['title']),
+            unicode(metadata['extended']),
+            u" ".join(metadata['tags']),
+            datetime.fromtimestamp(metadata['dateAdded'] / 1e6),
+            False) for url, metadata in bmap.iteritems())
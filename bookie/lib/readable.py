@@ -1,18 +1,45 @@
 """Handle processing and setting web content into Readability/cleaned
 
 """
+import hashlib
 import httplib
+import itertools
 import logging
 import lxml
+import lxml.etree
+import lxml.html
+import requests
 import socket
+import threading
 import urllib2
 
 from BaseHTTPServer import BaseHTTPRequestHandler as HTTPH
 from breadability.readable import Article
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.exceptions import DecodeError
+from requests.packages.urllib3.exceptions import HTTPError as Urllib3Error
+from requests.packages.urllib3.exceptions import LocationParseError
 from urlparse import urlparse
 
 LOG = logging.getLogger(__name__)
 
+# Seconds to wait on connecting and on each read before giving up on a url.
+FETCH_TIMEOUT = 10
+# How many urls a ContentFetcher downloads at once, and at most how many of
+# those can be from the same host.
+FETCH_WORKERS = 10
+FETCH_PER_HOST = 2
+# The most bytes of a page we'll download, anything past that is cut off.
+FETCH_MAX_BYTES = 2 * 1024 * 1024
+# Bytes read off the response at a time, the first chunk is sniffed.
+READ_CHUNK_SIZE = 16 * 1024
+# Process wide http sessions so connections to a host get reused, one for
+# each (workers, per_host) the connection pools are sized for.
+SESSIONS = {}
+SESSIONS_LOCK = threading.Lock()
+
 
 class DictObj(dict):
     def __getattr__(self, name):
@@ -30,6 +57,7 @@ USER_AGENT = 'bookie / ({url})'.format(
 STATUS_CODES = DictObj({
     '1': 1,    # used for manual parsed
     '200': 200,
+    '304': 304,   # the page hasn't changed since we last read it
     '404': 404,
     '403': 403,
     '429': 429,   # wtf, 429 doesn't exist...
@@ -38,7 +66,7 @@ STATUS_CODES = DictObj({
     '900': 900,   # used for unparseable
     '901': 901,   # url is not parseable/usable
     '902': 902,   # socket.error during download
-    '903': 903,   # httplib.IncompleteRead error
+    '903': 903,   # httplib.IncompleteRead or a body we couldn't decode
     '904': 904,   # lxml error about document is empty
     '905': 905,   # httplib.BadStatusLine
 })
@@ -51,14 +79,99 @@ IMAGE_TYPES = DictObj({
 })
 
 
+# Content types we parse the readable content out of.
+HTML_TYPES = ('text/html', 'application/xhtml+xml')
+# Content types servers send with just about anything, html included, so
+# the body has to tell us what it is.
+VAGUE_TYPES = ('text/plain', 'application/octet-stream')
+
+# Leading bytes of the common non-html files people bookmark.
+MAGIC_TYPES = (
+    ('%PDF', 'application/pdf'),
+    ('\x89PNG', 'image/png'),
+    ('GIF8', 'image/gif'),
+    ('\xff\xd8\xff', 'image/jpeg'),
+    ('PK\x03\x04', 'application/zip'),
+    ('\x1f\x8b', 'application/x-gzip'),
+    ('ID3', 'audio/mpeg'),
+    ('OggS', 'application/ogg'),
+    ('\x1a\x45\xdf\xa3', 'video/webm'),
+)
+HTML_MARKERS = ('<!doctype html', '<html', '<head', '<body')
+TEXT_PARSER = lxml.html.HTMLParser(encoding='utf-8')
+
+
+def sniff_content_type(head):
+    """Guess the content type from the first bytes of a body
+
+    Returns None when the bytes don't give it away.
+
+    """
+    for magic, content_type in MAGIC_TYPES:
+        if head.startswith(magic):
+            return content_type
+    if head[4:8] == 'ftyp':
+        return 'video/mp4'
+
+    start = head.lstrip('\xef\xbb\xbf \t\r\n').lower()
+    if start.startswith(HTML_MARKERS) or '<html' in start:
+        return 'text/html'
+    return None
+
+
+def clean_text(content):
+    """Pull the plain text out of some html for the fulltext index
+
+    Scripts, styles and comments aren't text anyone searches for, so they're
+    dropped.
+
+    """
+    if not content:
+        return u''
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+
+    try:
+        tree = lxml.html.fromstring(content, parser=TEXT_PARSER)
+    except lxml.etree.ParserError:
+        # Nothing but whitespace, there's no document.
+        return u''
+    lxml.etree.strip_elements(
+        tree, lxml.etree.Comment, 'script', 'style', with_tail=False)
+    return u' '.join(tree.itertext())
+
+
+def read_capped(chunks, max_bytes):
+    """Read the chunks of a body until there are max_bytes of them
+
+    :param chunks: iterable of the strings making up the body
+
+    Returns the body and whether it was cut off at max_bytes.
+
+    """
+    body = []
+    size = 0
+    for chunk in chunks:
+        body.append(chunk)
+        size += len(chunk)
+        if size >= max_bytes:
+            return ''.join(body)[:max_bytes], size > max_bytes
+    return ''.join(body), False
+
+
 class Readable(object):
     """Understand the base concept of making readable"""
     is_error = False
+    clean_content = None
     content = None
     content_type = None
+    digest = None
+    etag = None
     headers = None
+    last_modified = None
     status_message = None
     status = None
+    truncated = False
     url = None
 
     def error(self, code, msg):
@@ -73,6 +186,10 @@ class Readable(object):
         else:
             return False
 
+    def is_unchanged(self):
+        """Check if the page is the same as the last time we read it"""
+        return self.status == STATUS_CODES['304']
+
     def is_image(self):
         """Check if the current object is an image"""
         # we can only get this if we have headers
@@ -84,13 +201,39 @@ class Readable(object):
         else:
             return False
 
+    def is_html(self):
+        """Check if the content type is one we can parse"""
+        return (self.content_type is not None and
+                self.content_type.lower() in HTML_TYPES)
+
     def set_content(self, content, content_type=None):
         """assign the content and potentially content type header"""
         self.content = content
+        self.clean_content = clean_text(content)
         if content_type:
             self.content_type = content_type
 
 
+def get_session(workers=FETCH_WORKERS, per_host=FETCH_PER_HOST):
+    """The requests session used to fetch urls, created on first use
+
+    It's created lazily so that each forked celery worker gets its own
+    connection pools. They're sized to keep a connection open to each host
+    the workers fetch from, and per_host connections to each of them.
+
+    """
+    with SESSIONS_LOCK:
+        if (workers, per_host) not in SESSIONS:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=workers,
+                pool_maxsize=per_host)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            SESSIONS[(workers, per_host)] = session
+        return SESSIONS[(workers, per_host)]
+
+
 class ReadContent(object):
     """Handle some given content and parse the readable out of it"""
 
@@ -113,9 +256,28 @@ class ReadUrl(object):
     """Fetch a url and read some content out of it"""
 
     @staticmethod
-    def parse(url):
-        """Fetch the given url and parse out a Readable Obj for the content"""
+    def parse(url, session=None, timeout=FETCH_TIMEOUT, etag=None,
+              last_modified=None, digest=None, max_bytes=FETCH_MAX_BYTES):
+        """Fetch the given url and parse out a Readable Obj for the content
+
+        :param session: the requests session to fetch with, see get_session
+        :param timeout: seconds to wait on connecting and on each read
+        :param max_bytes: most of the page to download, the rest is cut off
+        :param etag: the ETag from the last time we read the url
+        :param last_modified: the Last-Modified from the last time
+        :param digest: the digest of the page from the last time
+
+        When the server says the page hasn't changed, or it has the same
+        digest, the status is 304 and the page isn't parsed again.
+
+        Only html is parsed. The content type comes from the headers and,
+        when they're vague or wrong, the first chunk of the body. Anything
+        else is left without downloading the rest of it.
+
+        """
         read = Readable()
+        if session is None:
+            session = get_session()
 
         if not isinstance(url, unicode):
             url = url.decode('utf-8')
@@ -152,22 +314,49 @@ class ReadUrl(object):
                 parsed[4],
                 query=query)
 
+        fh = None
         try:
             LOG.debug('Readable Parsed: ' + clean_url)
-            request = urllib2.Request(clean_url.encode('utf-8'))
-            request.add_header('User-Agent', USER_AGENT)
-            opener = urllib2.build_opener()
-            fh = opener.open(request)
+            if clean_url.startswith(u'ftp'):
+                request = urllib2.Request(clean_url.encode('utf-8'))
+                fh = urllib2.urlopen(request, timeout=timeout)
+                read.headers = fh.info()
+                read.content_type = read.headers.gettype()
+                chunks = iter(lambda: fh.read(READ_CHUNK_SIZE), '')
+            else:
+                headers = {'User-Agent': USER_AGENT}
+                if etag:
+                    headers['If-None-Match'] = etag
+                if last_modified:
+                    headers['If-Modified-Since'] = last_modified
+
+                fh = session.get(
+                    clean_url.encode('utf-8'),
+                    headers=headers,
+                    timeout=timeout,
+                    stream=True)
+                if fh.status_code >= 400:
+                    raise urllib2.HTTPError(
+                        clean_url, fh.status_code, fh.reason, fh.headers,
+                        None)
+                read.headers = fh.headers
+                read.content_type = fh.headers.get(
+                    'content-type', 'text/plain').split(';')[0].strip().lower()
+                read.etag = fh.headers.get('etag')
+                read.last_modified = fh.headers.get('last-modified')
+                chunks = fh.iter_content(READ_CHUNK_SIZE)
 
             # if it works, then we default to a 200 request
             # it's ok, promise :)
             read.status = 200
-            read.headers = fh.info()
-            read.content_type = read.headers.gettype()
+            if getattr(fh, 'status_code', None) == 304:
+                read.status = STATUS_CODES['304']
+                # There's no body, reading it frees up the connection.
+                fh.content
 
         except urllib2.HTTPError, exc:
             # for some reason getting a code 429 from a server
-            if exc.code not in [429]:
+            if exc.code in HTTPH.responses and exc.code not in [429]:
                 read.error(exc.code, HTTPH.responses[exc.code])
             else:
                 read.error(exc.code, unicode(exc.code) + ': ' + clean_url)
@@ -181,28 +370,140 @@ class ReadUrl(object):
         except httplib.BadStatusLine, exc:
             read.error(STATUS_CODES['905'], str(exc))
 
-        except socket.error, exc:
+        except (socket.error, requests.exceptions.Timeout), exc:
             read.error(STATUS_CODES['902'], str(exc))
 
+        except (requests.exceptions.ConnectionError,
+                LocationParseError,
+                requests.exceptions.InvalidURL,
+                requests.exceptions.InvalidSchema,
+                requests.exceptions.TooManyRedirects), exc:
+            read.error(STATUS_CODES['901'], str(exc))
+
         LOG.debug('is error?')
         LOG.debug(read.status)
 
         # let's check to make sure we should be parsing this
-        # for example: don't parse images
-        if not read.is_error() and not read.is_image():
+        # for example: don't parse images or pdfs
+        should_read = read.is_html() or read.content_type in VAGUE_TYPES
+        if not read.is_error() and should_read:
             try:
-                document = Article(fh.read(), url=clean_url)
-                if not document.readable:
-                    read.error(STATUS_CODES['900'],
-                               "Could not parse document.")
-                else:
-                    read.set_content(document.readable)
-
-            except socket.error, exc:
-                read.error(STATUS_CODES['902'], str(exc))
-            except httplib.IncompleteRead, exc:
+                head = next(chunks, '')
+                sniffed = sniff_content_type(head)
+                if sniffed is not None:
+                    read.content_type = sniffed
+
+                if read.is_html():
+                    body, read.truncated = read_capped(
+                        itertools.chain([head], chunks), max_bytes)
+                    if read.truncated:
+                        LOG.debug('Readable truncated: ' + clean_url)
+                    read.digest = hashlib.sha1(body).hexdigest()
+                    if digest and read.digest == digest:
+                        # Same page as last time, no need to parse it again.
+                        read.status = STATUS_CODES['304']
+                    else:
+                        document = Article(body, url=clean_url)
+                        if not document.readable:
+                            read.error(STATUS_CODES['900'],
+                                       "Could not parse document.")
+                        else:
+                            read.set_content(document.readable)
+
+            except (httplib.IncompleteRead, DecodeError), exc:
                 read.error(STATUS_CODES['903'], str(exc))
+            except (socket.error,
+                    requests.exceptions.RequestException,
+                    Urllib3Error), exc:
+                # The connection broke or timed out partway through.
+                read.error(STATUS_CODES['902'], str(exc))
             except lxml.etree.ParserError, exc:
                 read.error(STATUS_CODES['904'], str(exc))
 
+        if fh is not None:
+            close_response(fh)
         return read
+
+
+def close_response(fh):
+    """Hand the connection back to the pool for the next url
+
+    This version of requests pools the connection even when we didn't read
+    the whole body, which breaks the next request on it. Those connections
+    are closed so the pool reconnects instead.
+
+    """
+    raw = getattr(fh, 'raw', None)
+    if raw is not None and not fh._content_consumed and raw._connection:
+        raw._connection.close()
+    fh.close()
+
+
+class ContentFetcher(object):
+    """Fetch the readable content of many urls at once
+
+    The urls are downloaded by a pool of worker threads sharing one session,
+    so connections to a host are reused. No more than per_host downloads hit
+    the same host at once.
+
+    """
+
+    def __init__(self, workers=FETCH_WORKERS, per_host=FETCH_PER_HOST,
+                 timeout=FETCH_TIMEOUT, max_bytes=FETCH_MAX_BYTES):
+        self.workers = workers
+        self.per_host = per_host
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.session = get_session(workers, per_host)
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def _host_slot(self, url):
+        """The semaphore limiting downloads from the host of url"""
+        host = urlparse(url).netloc.lower()
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = threading.BoundedSemaphore(self.per_host)
+            return self.hosts[host]
+
+    def _fetch(self, url):
+        with self._host_slot(url):
+            try:
+                return ReadUrl.parse(
+                    url,
+                    session=self.session,
+                    timeout=self.timeout,
+                    max_bytes=self.max_bytes)
+            except Exception, exc:
+                LOG.error('Could not fetch url: ' + url)
+                LOG.exception(exc)
+                return None
+
+    def fetch(self, urls):
+        """Fetch all of the urls, returning their Readables in the same order
+
+        A url that blew up while fetching gets None.
+
+        """
+        # Spread each host's urls out so the workers aren't all stuck
+        # waiting on the same host.
+        by_host = defaultdict(list)
+        for idx, url in enumerate(urls):
+            by_host[urlparse(url).netloc.lower()].append(idx)
+        order = []
+        queues = by_host.values()
+        while queues:
+            order.extend(queue.pop(0) for queue in queues)
+            queues = [queue for queue in queues if queue]
+
+        pool = ThreadPool(min(self.workers, len(urls)) or 1)
+        try:
+            found = pool.map(self._fetch, [urls[idx] for idx in order])
+        finally:
+            pool.close()
+            pool.join()
+
+        results = [None] * len(urls)
+        for idx, read in zip(order, found):
+            results[idx] = read
+        return results
@@ -1,8 +1,64 @@
 """Generic and small utilities that are used in Bookie"""
 import re
+import threading
+import time
+
+from collections import OrderedDict
 from urlparse import urlparse
 from urllib import quote
 from textblob import TextBlob
+from topia.termextract import extract
+
+# How many title and url suggestions to hold onto.
+SUGGEST_CACHE_SIZE = 1000
+
+TERM_EXTRACTOR = None
+TERM_EXTRACTOR_LOCK = threading.Lock()
+
+
+class LRUCache(object):
+    """Hold onto the values of the size most recently used keys
+
+    :param ttl: seconds a value is good for, None to keep it until it's
+        pushed out
+
+    """
+
+    def __init__(self, size, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+            # Move it to the end, the least recently used go first.
+            value, expires = self.items[key] = self.items.pop(key)
+            if expires is not None and expires < time.time():
+                del self.items[key]
+                return default
+            return value
+
+    def set(self, key, value):
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (value, expires)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+SUGGEST_CACHE = LRUCache(SUGGEST_CACHE_SIZE)
 
 
 def _generate_nouns_from_url(string):
@@ -12,6 +68,8 @@ def _generate_nouns_from_url(string):
         words = re.findall(r"[\w]+", string)
 
         clean_path = " ".join(words)
+        # Every TextBlob shares the one noun phrase extractor, so it's only
+        # trained the first time.
         path_tokens = TextBlob(clean_path)
         title_nouns = path_tokens.noun_phrases
         for result in title_nouns:
@@ -22,10 +80,25 @@ def _generate_nouns_from_url(string):
 
 
 def suggest_tags(data):
-    """Suggest tags based on the content string `data`"""
-    tag_set = set()
+    """Suggest tags based on the content string `data`
+
+    The suggestions for recent titles and urls are cached, each caller gets
+    its own copy of the set.
+
+    """
     if not data:
-        return tag_set
+        return set()
+
+    tag_set = SUGGEST_CACHE.get(data)
+    if tag_set is None:
+        tag_set = frozenset(_suggest_tags(data))
+        SUGGEST_CACHE.set(data, tag_set)
+    return set(tag_set)
+
+
+def _suggest_tags(data):
+    """Pull the nouns out of `data` for suggest_tags"""
+    tag_set = set()
 
     # The string might be a url that needs some cleanup before we parse for
     # suggestions
@@ -42,6 +115,39 @@ def suggest_tags(data):
     return tag_set
 
 
+def _term_extractor():
+    """The TermExtractor, it loads its lexicon the first time it's needed"""
+    global TERM_EXTRACTOR
+    with TERM_EXTRACTOR_LOCK:
+        if TERM_EXTRACTOR is None:
+            TERM_EXTRACTOR = extract.TermExtractor()
+    return TERM_EXTRACTOR
+
+
+def suggest_content_tags(text):
+    """Suggest tags from the text of a page, the most used terms first
+
+    Returns a list of lower cased words at least 3 chars long, pure numbers
+    are left out.
+
+    """
+    tags = []
+    if not text:
+        return tags
+
+    if isinstance(text, unicode):
+        text = text.encode('ascii', 'ignore')
+    terms = sorted(_term_extractor()(text),
+                   key=lambda term: term[1],
+                   reverse=True)
+    for term in terms:
+        # If it has a space in it, split it.
+        for tag in term[0].lower().split():
+            if tag not in tags and len(tag) > 2 and not tag.isdigit():
+                tags.append(tag)
+    return tags
+
+
 def url_fix(url, charset='UTF-8'):
     """Normalize the URL if it contains Non-ASCII chars"""
     if isinstance(url, unicode):
@@ -1,13 +1,19 @@
 """Sqlalchemy Models for objects stored with Bookie"""
 import logging
+import transaction
+import weakref
 
-from topia.termextract import extract
-from BeautifulSoup import BeautifulSoup
+from bookie.lib.readable import clean_text
 from bookie.lib.urlhash import generate_hash
+from bookie.lib.utils import suggest_content_tags
 
+from base64 import urlsafe_b64decode
+from base64 import urlsafe_b64encode
+from collections import defaultdict
 from datetime import datetime
 
 from sqlalchemy import engine_from_config
+from sqlalchemy import inspect
 from sqlalchemy import event
 from sqlalchemy import Boolean
 from sqlalchemy import Column
@@ -15,7 +21,9 @@ from sqlalchemy import DateTime
 from sqlalchemy import Integer
 from sqlalchemy import Unicode
 from sqlalchemy import UnicodeText
+from sqlalchemy import UniqueConstraint
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
 from sqlalchemy import Table
 from sqlalchemy import select
 from unidecode import unidecode
@@ -35,13 +43,25 @@ from sqlalchemy.orm.exc import NoResultFound  # noqa
 from sqlalchemy.orm.collections import attribute_mapped_collection
 from sqlalchemy.sql import func
 from sqlalchemy.sql import and_
+from sqlalchemy.sql import case
+from sqlalchemy.sql import null
+from sqlalchemy.sql import or_
 
+from zope.sqlalchemy import mark_changed
 from zope.sqlalchemy import ZopeTransactionExtension
 
 DBSession = scoped_session(sessionmaker(extension=ZopeTransactionExtension()))
 Base = declarative_base()
 
 LOG = logging.getLogger(__name__)
+CURSOR_DATE_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+TAG_CHUNK_SIZE = 400
+# Stay under SQLite's default limit of 999 bind params per statement.
+BULK_BIND_LIMIT = 900
+# How many bookmarks an export loads at a time.
+DUMP_CHUNK_SIZE = 500
+# The bids each open transaction has changed, to fulltext index after commit.
+PENDING_INDEX = weakref.WeakKeyDictionary()
 
 
 def initialize_sql(settings):
@@ -63,23 +83,42 @@ def initialize_sql(settings):
                               backref="bmark")
 
 
-def todict(self):
-    """Method to turn an SA instance into a dict so we can output to json"""
+# The (name, is a datetime) of the columns of each model todict has seen.
+TODICT_COLUMNS = {}
 
-    def convert_datetime(value):
-        """We need to treat datetime's special to get them to json"""
-        if value:
-            return value.strftime("%Y-%m-%d %H:%M:%S")
-        else:
-            return ""
 
-    for col in self.__table__.columns:
-        if isinstance(col.type, DateTime):
-            value = convert_datetime(getattr(self, col.name))
-        else:
-            value = getattr(self, col.name)
+def _todict_columns(cls):
+    """Work out the columns to output for the model cls once"""
+    columns = TODICT_COLUMNS.get(cls)
+    if columns is None:
+        columns = TODICT_COLUMNS[cls] = tuple(
+            (col.name, isinstance(col.type, DateTime))
+            for col in cls.__table__.columns)
+    return columns
 
-        yield(col.name, value)
+
+def _format_datetime(value):
+    """We need to treat datetime's special to get them to json"""
+    if not value:
+        return ""
+    # Quite a bit quicker than strftime for every row.
+    return '%04d-%02d-%02d %02d:%02d:%02d' % (
+        value.year, value.month, value.day,
+        value.hour, value.minute, value.second)
+
+
+def todict(self):
+    """Method to turn an SA instance into a dict so we can output to json"""
+    # Loaded values are read straight from the instance, getattr is only
+    # needed to load the rest.
+    loaded = self.__dict__
+    items = []
+    for name, is_datetime in _todict_columns(type(self)):
+        value = loaded[name] if name in loaded else getattr(self, name)
+        if is_datetime:
+            value = _format_datetime(value)
+        items.append((name, value))
+    return items
 
 
 def iterfunc(self):
@@ -87,7 +126,7 @@ def iterfunc(self):
         so we can do dict(sa_instance)
 
     """
-    return self.__todict__()
+    return iter(self.__todict__())
 
 
 def fromdict(self, values):
@@ -110,7 +149,9 @@ Base.fromdict = fromdict
 bmarks_tags = Table(
     'bmark_tags', Base.metadata,
     Column('bmark_id', Integer, ForeignKey('bmarks.bid'), primary_key=True),
-    Column('tag_id', Integer, ForeignKey('tags.tid'), primary_key=True)
+    Column('tag_id', Integer, ForeignKey('tags.tid'), primary_key=True),
+    # Finding the bookmarks with a tag starts from the tag.
+    Index('ix_bmark_tags_tag_id', 'tag_id', 'bmark_id'),
 )
 
 
@@ -118,6 +159,17 @@ class InvalidBookmark(Exception):
     """Exception class for erroring when a bookmark is not a valid one."""
 
 
+def _chunks(items, size):
+    """Split a list into lists of up to size items
+
+    Used to keep IN clauses and multi-row inserts under the bind parameter
+    limits of the database.
+
+    """
+    for start in xrange(0, len(items), size):
+        yield items[start:start + size]
+
+
 class TagMgr(object):
     """Handle all non-instance related tags functions"""
 
@@ -145,8 +197,53 @@ class TagMgr(object):
         return tag_objects
 
     @staticmethod
-    def find(order_by=None, tags=None, username=None):
-        """Find all of the tags in the system"""
+    def resolve(tag_names):
+        """Get a Tag for every name in tag_names in as few queries as we can
+
+        Existing tags are loaded in chunks and the missing ones are created
+        with a multi-row insert. This is meant for imports where the same tags
+        show up on thousands of bookmarks.
+
+        The Tags in the returned dict of name: Tag are detached from the
+        session so they outlive any commits. Hand the dict to
+        BmarkMgr.bulk_store as its tag_map to use them.
+
+        """
+        names = set([name.lower().strip() for name in tag_names])
+        names.discard(u"")
+        names = sorted(names)
+        tag_map = {}
+
+        def load(chunk):
+            for tag in Tag.query.filter(Tag.name.in_(chunk)):
+                tag_map[tag.name] = tag
+
+        for chunk in _chunks(names, TAG_CHUNK_SIZE):
+            load(chunk)
+
+        missing = [name for name in names if name not in tag_map]
+        for chunk in _chunks(missing, TAG_CHUNK_SIZE):
+            DBSession.execute(
+                Tag.__table__.insert().values([{'name': n} for n in chunk]))
+            load(chunk)
+
+        if missing:
+            # The inserts bypass the ORM, so the transaction doesn't know to
+            # commit them unless we tell it.
+            mark_changed(DBSession())
+
+        for tag in tag_map.itervalues():
+            DBSession.expunge(tag)
+
+        return tag_map
+
+    @staticmethod
+    def find(order_by=None, tags=None, username=None, page=0, limit=None):
+        """Find all of the tags in the system
+
+        :param limit: how many tags to a page, all of them if None
+
+        """
         qry = Tag.query
 
         if tags:
@@ -165,12 +262,15 @@ class TagMgr(object):
         else:
             qry = qry.order_by(Tag.name)
 
+        if limit:
+            qry = qry.offset(page * limit).limit(limit)
+
         return qry.all()
 
     @staticmethod
     def complete(prefix, current=None, limit=5, username=None,
                  requested_by=None):
-        """Find all of the tags that begin with prefix
+        """Find the names of the tags that begin with prefix
 
         :param current: a list of current tags to compare with
 
@@ -179,67 +279,37 @@ class TagMgr(object):
         way when filtering tags we only complete things that make sense to
         complete
 
-        """
-        prefix = prefix.lower()
-        if current is None:
-            qry = Tag.query.filter(Tag.name.startswith(prefix))
-
-            # if we have a username limit to only bookmarks of that user
-            if username:
-                qry = qry.filter(Tag.bmark.any(username=username))
-                # If username == requested_by, we want all the bookmarks so,
-                # no need to filter on is_private.
-                # If username != requested_by, we want to limit to only
-                # public bookmarks.
-                if username != requested_by:
-                    bmark = aliased(Bmark)
-                    qry = qry.join((bmark, Tag.bmark)).\
-                        filter(bmark.is_private == False)   # noqa
-            else:
-                bmark = aliased(Bmark)
-                qry = qry.join((bmark, Tag.bmark)).\
-                    filter(bmark.is_private == False)   # noqa
+        The tags come out of memory, see bookie.models.tagindex, the most used
+        first.
 
-            qry = qry.order_by(Tag.name).limit(limit)
-            return qry.all()
-
-        else:
-            # things get a bit more complicated
-            """
-                SELECT DISTINCT(tag_id), tags.name
-                FROM bmark_tags
-                JOIN tags ON bmark_tags.tag_id = tags.tid
-                WHERE bmark_id IN (
-                    SELECT bmark_id FROM bmark_tags WHERE tag_id IN (
-                        SELECT DISTINCT(t.tid) FROM tags t
-                            WHERE t.name in ('vagrant', 'tips')
-                    )
-                )
-                AND tags.name LIKE ('ub%');
-            """
-            current_tags = DBSession.query(Tag.tid).\
-                filter(Tag.name.in_(current)).group_by(Tag.tid)
-
-            good_bmarks = DBSession.query(Bmark.bid)
-
-            if username:
-                good_bmarks = good_bmarks.filter(Bmark.username == username)
-                if username != requested_by:
-                    good_bmarks = good_bmarks.\
-                        filter(Bmark.is_private == False)   # noqa
-            else:
-                good_bmarks = good_bmarks.\
-                    filter(Bmark.is_private == False)   # noqa
+        """
+        from bookie.models import tagindex
+        # If username == requested_by, we want all the bookmarks so,
+        # no need to filter on is_private.
+        # If username != requested_by, we want to limit to only
+        # public bookmarks.
+        return tagindex.complete(
+            prefix,
+            limit=limit,
+            username=username,
+            private=(username is not None and
+                     username == requested_by),
+            current=current)
 
-            good_bmarks = good_bmarks.\
-                filter(Bmark.tags.any(Tag.tid.in_(current_tags))).\
-                group_by(Bmark.bid)
+    @staticmethod
+    def related(tags, limit=10, username=None, requested_by=None):
+        """Find the tags used most on the same bookmarks as tags
 
-            query = DBSession.query(Tag.name.distinct().label('name')).\
-                filter(Tag.name.startswith(prefix)).\
-                filter(Tag.bmark.any(Bmark.bid.in_(good_bmarks)))
+        Returns a list of (name, count) with how many bookmarks have both.
 
-            return DBSession.execute(query)
+        """
+        from bookie.models import tagindex
+        return tagindex.related(
+            tags,
+            limit=limit,
+            username=username,
+            private=(username is not None and
+                     username == requested_by))
 
     @staticmethod
     def suggestions(bmark=None, url=None, username=None):
@@ -250,42 +320,26 @@ class TagMgr(object):
             that the user is editing. New Bookmarks won't end up here.
 
         """
-        tag_suggest = []
-        tag_list = []
-
         #  If url is None return empty tags
         if url is None:
-            return tag_list
-        else:
-            bmark = BmarkMgr.get_by_url(url)
-            # If bmark is not parsed return empty tag list
-            if bmark.readable is None:
-                return tag_list
-            # Some times parsing may fail and we cannot parse the webpage
-            # then satus_code will be set to 900
-            elif bmark.readable.status_code == '900':
-                return tag_list
-            else:
-                content = bmark.readable.content
-                # Remove unicode character while printing
-                clean_content = (
-                    "".join(
-                        BeautifulSoup(content).findAll(text=True)).encode(
-                        'ascii', 'ignore'))
-                get_tags = extract.TermExtractor()
-                tag_suggest = get_tags(clean_content)
-                tag_suggest = sorted(tag_suggest, key=lambda tag_suggest:
-                                     tag_suggest[1], reverse=True)
-                for result in tag_suggest:
-                    # If it has a space in it, split it.
-                    tags = result[0].split()
-                    for tag in tags:
-                        # Require at least 3 chars long and ignore pure
-                        # numbers.
-                        if tag not in tag_list and tag not in bmark.tags:
-                            if len(tag) > 2 and not tag.isdigit():
-                                tag_list.append(tag.lower())
-                return tag_list
+            return []
+
+        bmark = BmarkMgr.get_by_url(url)
+        readable = bmark.readable
+        # If bmark is not parsed return empty tag list
+        if readable is None:
+            return []
+
+        # The terms are pulled out of the page once and kept until the
+        # content changes.
+        if readable.tag_suggestions is None:
+            content = readable.clean_content
+            if content is None:
+                content = clean_text(readable.content)
+            readable.tag_suggestions = u' '.join(
+                suggest_content_tags(content))
+        return [tag for tag in readable.tag_suggestions.split()
+                if tag not in bmark.tags]
 
     @staticmethod
     def count():
@@ -304,9 +358,176 @@ class Tag(Base):
         self.name = tag_name.lower()
 
 
+class UserTagMgr(object):
+    """Handle the per user tag counts kept in user_tags"""
+
+    @staticmethod
+    def update_counts(connection, changes):
+        """Add the changes to the tag counts of users
+
+        :param changes: dict of (username, tid): (count change, public count
+            change, when the tag was last added to a bookmark or None)
+
+        Rows for tags a user no longer uses are removed.
+
+        """
+        table = UserTag.__table__
+        for (username, tid), (change, public, used) in sorted(
+                changes.items()):
+            if not change and not public and used is None:
+                continue
+            where = and_(table.c.username == username, table.c.tid == tid)
+            values = {
+                'count': table.c.count + change,
+                'public_count': table.c.public_count + public,
+            }
+            if used is not None:
+                values['last_used'] = case(
+                    [(or_(table.c.last_used == None,   # noqa
+                          table.c.last_used < used), used)],
+                    else_=table.c.last_used)
+
+            res = connection.execute(
+                table.update().where(where).values(**values))
+            if not res.rowcount and change > 0:
+                connection.execute(table.insert().values(
+                    username=username,
+                    tid=tid,
+                    count=change,
+                    public_count=public,
+                    last_used=used))
+            elif change < 0:
+                connection.execute(
+                    table.delete().where(and_(where, table.c.count <= 0)))
+
+    @staticmethod
+    def clear(username):
+        """Forget the tag counts of a user whose bookmarks are all gone"""
+        DBSession.execute(UserTag.__table__.delete().where(
+            UserTag.__table__.c.username == username))
+
+    @staticmethod
+    def _query(username=None, public=False):
+        qry = UserTag.query.options(joinedload('tag'))
+        if username:
+            qry = qry.filter(UserTag.username == username)
+        if public:
+            qry = qry.filter(UserTag.public_count > 0)
+        return qry
+
+    @staticmethod
+    def find(username, page=0, limit=None, public=False):
+        """The UserTags of a user in order of the tag names
+
+        :param public: only the tags of public bookmarks
+
+        """
+        qry = UserTagMgr._query(username, public).join(UserTag.tag).\
+            order_by(Tag.name)
+        if limit:
+            qry = qry.offset(page * limit).limit(limit)
+        return qry.all()
+
+    @staticmethod
+    def count(username, public=False):
+        """How many different tags the user has"""
+        return UserTagMgr._query(username, public).count()
+
+    @staticmethod
+    def cloud(username=None, page=0, limit=50, public=True):
+        """The most used tags, a page at a time
+
+        :param username: the user to count for, None for all users
+        :param public: only count the public bookmarks
+
+        Returns a list of (name, count, last_used). last_used is kept for all
+        of the bookmarks, so it's None when public, it would tell when a tag
+        was last used on a private bookmark.
+
+        """
+        if public:
+            counted = UserTag.public_count
+            last_used = null()
+        else:
+            counted = UserTag.count
+            last_used = func.max(UserTag.last_used)
+
+        total = func.sum(counted).label('total')
+        qry = DBSession.query(Tag.name, total, last_used).\
+            join(UserTag, UserTag.tid == Tag.tid).\
+            filter(counted > 0)
+        if username:
+            qry = qry.filter(UserTag.username == username)
+        return qry.group_by(Tag.name).\
+            order_by(total.desc(), Tag.name).\
+            offset(page * limit).\
+            limit(limit).\
+            all()
+
+
+class UserTag(Base):
+    """How many of a user's bookmarks have a tag
+
+    Kept up to date as bookmarks change, see record_user_tag_changes, so
+    tag lists and clouds don't have to count up bmark_tags.
+
+    """
+    __tablename__ = 'user_tags'
+
+    username = Column(Unicode(255),
+                      ForeignKey('users.username'),
+                      primary_key=True)
+    tid = Column(Integer, ForeignKey('tags.tid'), primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+    public_count = Column(Integer, nullable=False, default=0)
+    last_used = Column(DateTime)
+
+    tag = relation(Tag)
+
+    @property
+    def name(self):
+        return self.tag.name
+
+
 class ReadableMgr(object):
     """Handle non-instance model issues for readable"""
-    pass
+
+    @staticmethod
+    def fetched_by_hash(hash_ids):
+        """The newest successfully fetched readable for each url
+
+        Bookmarks of the same url can share the page we already fetched and
+        parsed instead of each fetching it again.
+
+        :param hash_ids: the hash_ids of the urls
+
+        Returns a dict of hash_id: Readable.
+
+        """
+        found = {}
+        hash_ids = list(set(hash_ids))
+        for chunk in _chunks(hash_ids, BULK_BIND_LIMIT):
+            # Only the newest page of each url is loaded, not the content of
+            # every bookmark that has it.
+            newest = DBSession.query(
+                Bmark.hash_id,
+                func.max(Readable.imported).label('imported')).\
+                join(Readable, Readable.bid == Bmark.bid).\
+                filter(Bmark.hash_id.in_(chunk)).\
+                filter(Readable.status_code == 200).\
+                filter(Readable.content.isnot(None)).\
+                group_by(Bmark.hash_id).\
+                subquery()
+            qry = Readable.query.join(Bmark, Bmark.bid == Readable.bid).\
+                join(newest, and_(
+                    newest.c.hash_id == Bmark.hash_id,
+                    newest.c.imported == Readable.imported)).\
+                add_columns(Bmark.hash_id).\
+                filter(Readable.status_code == 200).\
+                filter(Readable.content.isnot(None))
+            for readable, hash_id in qry:
+                found[hash_id] = readable
+        return found
 
 
 class Readable(Base):
@@ -325,22 +546,29 @@ class Readable(Base):
     content_type = Column(Unicode(255))
     status_code = Column(Integer)
     status_message = Column(Unicode(255))
+    # What we need to ask the server if the page changed since we fetched it.
+    etag = Column(Unicode(255))
+    last_modified = Column(Unicode(255))
+    content_digest = Column(Unicode(40))
+    # Space separated tags suggested by the content, the best first. None
+    # until they're worked out.
+    tag_suggestions = Column(UnicodeText)
 
 
 def sync_readable_content(mapper, connection, target):
-    def _clean_content(content):
-        if content:
-            return u' '.join(BeautifulSoup(content).findAll(text=True))
-        else:
-            return u""
+    """Index the new content of a bookmark's page
+
+    The clean_content is pulled out of the page when it's fetched, see
+    bookie.lib.readable.clean_text, so there's no parsing to do in the
+    flush.
 
-    target.clean_content = _clean_content(target.content)
+    """
+    import bookie.models.fulltext as ft
+    if ft.indexed_in_database():
+        ft.DatabaseFulltext(connection).index(connection, [target.bid])
+        return
 
-    # Background the process of fulltext indexing this bookmark's content.
-    from bookie.bcelery import tasks
-    tasks.fulltext_index_bookmark.delay(
-        target.bmark.bid,
-        target.clean_content)
+    index_after_commit(target.bid)
 
 
 event.listen(Readable, 'after_insert', sync_readable_content)
@@ -350,16 +578,27 @@ event.listen(Readable, 'after_update', sync_readable_content)
 class HashedMgr(object):
     """Manage non-instance methods of Hashed objects"""
 
+    @staticmethod
+    def hash_url(url):
+        """Generate the hash_id we store the url under"""
+        cleaned_url = str(unidecode(url))
+        return unicode(generate_hash(cleaned_url))
+
     def count():
         """Count how many unique hashed urls we've got."""
         return Hashed.query.count()
 
     @staticmethod
     def get_by_url(url):
-        """Return a hashed object for the url specified"""
-        res = Hashed.query.filter(Hashed.url == url).all()
-        if res:
-            return res[0]
+        """Return a hashed object for the url specified
+
+        It's looked up by the hash of the url, the url is only compared in
+        case another url has the same hash.
+
+        """
+        res = Hashed.query.get(HashedMgr.hash_url(url))
+        if res is not None and res.url == url:
+            return res
         else:
             return False
 
@@ -374,8 +613,7 @@ class Hashed(Base):
 
     def __init__(self, url):
         """We'll auto hash the id for them and set this up"""
-        cleaned_url = str(unidecode(url))
-        self.hash_id = unicode(generate_hash(cleaned_url))
+        self.hash_id = HashedMgr.hash_url(url)
         self.url = url
 
 
@@ -388,8 +626,11 @@ class BmarkMgr(object):
         # normalize the url
         clean_url = BmarkTools.normalize_url(url)
 
+        # The hash finds the row, the url makes sure it's not another url
+        # with the same hash.
         qry = Bmark.query.join(Bmark.hashed).\
             options(contains_eager(Bmark.hashed)).\
+            filter(Bmark.hash_id == HashedMgr.hash_url(clean_url)).\
             filter(Hashed.url == clean_url)
 
         if username:
@@ -412,13 +653,32 @@ class BmarkMgr(object):
 
     @staticmethod
     def find(limit=50, order_by=None, page=0, tags=None, username=None,
-             with_content=False, with_tags=True, requested_by=None):
-        """Search for specific sets of bookmarks"""
+             with_content=False, with_tags=True, requested_by=None,
+             cursor=None):
+        """Search for specific sets of bookmarks
+
+        :param cursor: an opaque cursor from BmarkTools.encode_cursor. When
+            provided we page by seeking past the (stored, bid) of the last
+            bookmark seen instead of using an offset, so deep pages cost the
+            same as the first one. The page param and any custom order_by are
+            ignored in this mode.
+
+        """
         qry = Bmark.query
         qry = qry.join(Bmark.hashed).\
             options(contains_eager(Bmark.hashed))
 
         offset = limit * page
+        seek_filter = None
+
+        if cursor is not None:
+            stored, bid = BmarkTools.decode_cursor(cursor)
+            seek_filter = or_(
+                Bmark.stored < stored,
+                and_(Bmark.stored == stored, Bmark.bid < bid)
+            )
+            offset = 0
+            order_by = None
 
         # If noqa is not used here the below error occurs with make lint.
         # comparison to False should be 'if cond is False:'
@@ -431,11 +691,18 @@ class BmarkMgr(object):
         if username:
             qry = qry.filter(Bmark.username == username)
 
+        # The bid is a tie breaker so that the order is stable for bookmarks
+        # stored in the same instant, which the cursor depends on.
         if order_by is None:
-            order_by = Bmark.stored.desc()
+            order_by = (Bmark.stored.desc(), Bmark.bid.desc())
+        else:
+            order_by = (order_by, )
+
+        if seek_filter is not None:
+            qry = qry.filter(seek_filter)
 
         if not tags:
-            qry = qry.order_by(order_by).\
+            qry = qry.order_by(*order_by).\
                 limit(limit).\
                 offset(offset).\
                 from_self()
@@ -447,7 +714,7 @@ class BmarkMgr(object):
 
             if isinstance(tags, str):
                 qry = qry.filter(Tag.name == tags)
-                qry = qry.order_by(order_by).\
+                qry = qry.order_by(*order_by).\
                     limit(limit).\
                     offset(offset).\
                     from_self()
@@ -460,6 +727,9 @@ class BmarkMgr(object):
                 else:
                     good_filter = (Bmark.bid == bmarks_tags.c.bmark_id)
 
+                if seek_filter is not None:
+                    good_filter = and_(good_filter, seek_filter)
+
                 bids_we_want = select(
                     [bmarks_tags.c.bmark_id.label('good_bmark_id')],
                     from_obj=[
@@ -475,7 +745,10 @@ class BmarkMgr(object):
                     group_by(bmarks_tags.c.bmark_id, Bmark.stored).\
                     having(
                         func.count(bmarks_tags.c.tag_id) >= len(tags)
-                    ).order_by(Bmark.stored.desc())
+                    ).order_by(
+                        Bmark.stored.desc(),
+                        bmarks_tags.c.bmark_id.desc()
+                    )
 
                 qry = qry.join(
                     (
@@ -495,29 +768,40 @@ class BmarkMgr(object):
                 options(contains_eager(Bmark.readable))
 
         qry = qry.options(joinedload('hashed'))
-        return qry.order_by(order_by).all()
+        return qry.order_by(*order_by).all()
 
     @staticmethod
-    def user_dump(username, requested_by):
-        """Get a list of all of the user's bookmarks for an export dump usually
+    def user_dump(username, requested_by, chunk_size=DUMP_CHUNK_SIZE):
+        """Iterate over all of the user's bookmarks for an export dump usually
+
+        Only the bids are read up front, the bookmarks themselves are loaded
+        chunk_size at a time so a big account never has to fit in memory at
+        once. They come newest first.
 
         """
-        qry = Bmark.query.outerjoin(Bmark.tags).\
-            options(
-                contains_eager(Bmark.tags)
-            ).\
-            join(Bmark.hashed).\
-            options(
-                contains_eager(Bmark.hashed)
-            ).\
+        qry = DBSession.query(Bmark.bid).\
             filter(Bmark.username == username)
 
         if requested_by != username:
             qry = qry.filter(Bmark.is_private == False)  # noqa
 
-        qry = qry.order_by(Bmark.stored.desc())
-
-        return qry.all()
+        qry = qry.order_by(Bmark.stored.desc(), Bmark.bid.desc())
+        bids = [bid for (bid,) in qry]
+
+        for chunk in _chunks(bids, chunk_size):
+            qry = Bmark.query.outerjoin(Bmark.tags).\
+                options(
+                    contains_eager(Bmark.tags)
+                ).\
+                join(Bmark.hashed).\
+                options(
+                    contains_eager(Bmark.hashed)
+                ).\
+                filter(Bmark.bid.in_(chunk))
+            found = dict((bmark.bid, bmark) for bmark in qry)
+            for bid in chunk:
+                if bid in found:
+                    yield found[bid]
 
     @staticmethod
     def popular(limit=50, page=0, with_tags=False):
@@ -577,6 +861,115 @@ class BmarkMgr(object):
 
         return mark
 
+    @staticmethod
+    def bulk_store(rows, username, inserted_by=None, tag_map=None):
+        """Store a whole set of new bookmarks with multi-row inserts
+
+        :param rows: list of (url, desc, ext, tags, dt, is_private) tuples
+            where tags is a space separated string and dt may be None
+        :param username: the user the bookmarks belong to
+        :param inserted_by: what's adding the bookmarks
+        :param tag_map: preloaded tags from TagMgr.resolve
+
+        The rows must be valid urls the user hasn't bookmarked yet, see
+        Importer.bulk_load. The Bmark ORM events don't fire for these, so the
+        caller is responsible for getting them fulltext indexed, see
+        fulltext.index_bookmarks.
+
+        Returns the bids of the new bookmarks in row order.
+
+        """
+        if not rows:
+            return []
+
+        marks = []
+        for url, desc, ext, tags, dt, is_private in rows:
+            tag_names = []
+            for name in (tags or u"").split(u" "):
+                name = name.lower().strip()
+                if name and name not in tag_names:
+                    tag_names.append(name)
+
+            marks.append({
+                'hash_id': HashedMgr.hash_url(url),
+                'url': url,
+                'description': desc,
+                'extended': ext,
+                'stored': dt if dt is not None else datetime.utcnow(),
+                'is_private': is_private,
+                'tag_names': tag_names,
+            })
+
+        if tag_map is None:
+            tag_map = TagMgr.resolve(
+                name for mark in marks for name in mark['tag_names'])
+
+        # Only the urls nobody has bookmarked yet need a url_hash row.
+        hash_ids = sorted(set(mark['hash_id'] for mark in marks))
+        known = set()
+        for chunk in _chunks(hash_ids, BULK_BIND_LIMIT):
+            qry = DBSession.query(Hashed.hash_id).\
+                filter(Hashed.hash_id.in_(chunk))
+            known.update(hash_id for (hash_id,) in qry)
+
+        new_hashes = {}
+        for mark in marks:
+            if mark['hash_id'] not in known:
+                new_hashes[mark['hash_id']] = {
+                    'hash_id': mark['hash_id'],
+                    'url': mark['url'],
+                    'clicks': 0,
+                }
+
+        # Multi-row inserts don't fill in python side column defaults, so
+        # every value has to be given.
+        hash_rows = sorted(new_hashes.values(), key=lambda h: h['hash_id'])
+        for chunk in _chunks(hash_rows, BULK_BIND_LIMIT // 3):
+            DBSession.execute(Hashed.__table__.insert().values(chunk))
+
+        bmark_rows = [{
+            'hash_id': mark['hash_id'],
+            'username': username,
+            'description': mark['description'],
+            'extended': mark['extended'],
+            'stored': mark['stored'],
+            'clicks': 0,
+            'is_private': mark['is_private'],
+            'inserted_by': inserted_by,
+            'tag_str': u" ".join(mark['tag_names']),
+        } for mark in marks]
+        for chunk in _chunks(bmark_rows, BULK_BIND_LIMIT // 9):
+            DBSession.execute(Bmark.__table__.insert().values(chunk))
+
+        # Read the new ids back so we can link up the tags.
+        bids = {}
+        for chunk in _chunks(hash_ids, BULK_BIND_LIMIT):
+            qry = DBSession.query(Bmark.hash_id, Bmark.bid).\
+                filter(Bmark.username == username).\
+                filter(Bmark.hash_id.in_(chunk))
+            bids.update(qry)
+
+        tag_rows = [{
+            'bmark_id': bids[mark['hash_id']],
+            'tag_id': tag_map[name].tid,
+        } for mark in marks for name in mark['tag_names']]
+        for chunk in _chunks(tag_rows, BULK_BIND_LIMIT // 2):
+            DBSession.execute(bmarks_tags.insert().values(chunk))
+
+        # The ORM events don't keep user_tags up to date for these either.
+        counts = defaultdict(lambda: [0, 0, None])
+        for mark in marks:
+            for name in mark['tag_names']:
+                count = counts[(username, tag_map[name].tid)]
+                count[0] += 1
+                count[1] += 0 if mark['is_private'] else 1
+                if count[2] is None or count[2] < mark['stored']:
+                    count[2] = mark['stored']
+        UserTagMgr.update_counts(DBSession.connection(), counts)
+
+        mark_changed(DBSession())
+        return [bids[mark['hash_id']] for mark in marks]
+
     @staticmethod
     def hash_list(username=None):
         """Get a list of the hash_ids we have stored"""
@@ -620,6 +1013,8 @@ class BmarkMgr(object):
             )
             DBSession.execute(deltags)
             Bmark.query.filter(Bmark.username == username).delete()
+            bulk_fulltext_delete([i[0] for i in bids])
+            UserTagMgr.clear(username)
             return len(bids)
         else:
             return None
@@ -641,13 +1036,46 @@ class BmarkTools(object):
         # url = url.strip().strip('/')
         return url
 
+    @staticmethod
+    def encode_cursor(bmark):
+        """Build an opaque paging cursor that points just past this bookmark
+
+        The cursor is the (stored, bid) pair the find query seeks on, base64
+        encoded so clients treat it as a token and don't build their own.
+
+        """
+        key = u"{0}|{1}".format(
+            bmark.stored.strftime(CURSOR_DATE_FORMAT),
+            bmark.bid)
+        return urlsafe_b64encode(key.encode('utf-8'))
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """Turn a cursor back into the (stored, bid) pair it was built from
+
+        Raises a ValueError if the cursor isn't one we generated.
+
+        """
+        try:
+            key = urlsafe_b64decode(str(cursor)).decode('utf-8')
+            stored, bid = key.split(u'|')
+            return datetime.strptime(stored, CURSOR_DATE_FORMAT), int(bid)
+        except (TypeError, UnicodeError, ValueError):
+            raise ValueError('Invalid paging cursor: ' + repr(cursor))
+
 
 class Bmark(Base):
     """Basic bookmark table object"""
     __tablename__ = "bmarks"
+    __table_args__ = (
+        UniqueConstraint('username', 'hash_id'),
+        # The bookmarks are listed newest first, a user's or everyone's.
+        Index('ix_bmarks_username_stored', 'username', 'stored', 'bid'),
+        Index('ix_bmarks_stored', 'stored', 'bid'),
+    )
 
     bid = Column(Integer, autoincrement=True, primary_key=True)
-    hash_id = Column(Unicode(22), ForeignKey('url_hash.hash_id'))
+    hash_id = Column(Unicode(22), ForeignKey('url_hash.hash_id'), index=True)
     description = Column(UnicodeText())
     extended = Column(UnicodeText())
     stored = Column(DateTime, default=datetime.utcnow)
@@ -746,17 +1174,139 @@ event.listen(Bmark, 'before_insert', bmark_fulltext_tag_str_update)
 event.listen(Bmark, 'before_update', bmark_fulltext_tag_str_update)
 
 
+def index_after_commit(bid):
+    """Fulltext index the bookmark once the current transaction commits
+
+    Every bookmark changed in a transaction goes out in one message after the
+    commit, however many times it was flushed. Nothing is sent if the
+    transaction is aborted.
+
+    """
+    txn = transaction.get()
+    bids = PENDING_INDEX.get(txn)
+    if bids is None:
+        bids = PENDING_INDEX[txn] = set()
+        txn.addAfterCommitHook(_send_index_updates, (bids,))
+    bids.add(bid)
+
+
+def _send_index_updates(committed, bids):
+    """After commit hook queueing the bids of the transaction for indexing"""
+    if committed and bids:
+        # Only the ids go over the broker, the content is read from the db
+        # when the batch is indexed.
+        from bookie.bcelery import tasks
+        tasks.fulltext_index_bookmarks.delay(sorted(bids))
+
+
 def bmark_fulltext_insert_update(mapper, connection, target):
     """Update things before insert/update for the fulltext needs
 
     """
-    content = u""
-    if target.readable and target.readable.clean_content:
-        content = target.readable.clean_content
+    import bookie.models.fulltext as ft
+    if ft.indexed_in_database():
+        ft.DatabaseFulltext(connection).index(connection, [target.bid])
+        return
 
-    # Background the process of fulltext indexing this bookmark's content.
-    from bookie.bcelery import tasks
-    tasks.fulltext_index_bookmark.delay(target.bid, content)
+    index_after_commit(target.bid)
 
 event.listen(Bmark, 'after_insert', bmark_fulltext_insert_update)
 event.listen(Bmark, 'after_update', bmark_fulltext_insert_update)
+
+
+def bmark_fulltext_delete(mapper, connection, target):
+    """Remove a deleted bookmark from a fulltext index in the database
+
+    The whoosh index is cleaned up by tasks.missing_fulltext_index.
+
+    """
+    import bookie.models.fulltext as ft
+    if ft.indexed_in_database():
+        ft.DatabaseFulltext(connection).delete(connection, [target.bid])
+
+event.listen(Bmark, 'after_delete', bmark_fulltext_delete)
+
+
+def bulk_fulltext_delete(bids):
+    """Remove bookmarks deleted with a bulk delete from a database index
+
+    Query.delete() skips the after_delete event, so bmark_fulltext_delete
+    never sees them. The whoosh index is cleaned up like it is for any other
+    delete.
+
+    """
+    import bookie.models.fulltext as ft
+    if ft.indexed_in_database():
+        connection = DBSession.connection()
+        ft.DatabaseFulltext(connection).delete(connection, bids)
+
+
+def bmark_tag_changes(bmark, deleted=False):
+    """The tags bmark had and has now, since the last flush
+
+    Returns ((was private, old tags), (is private, new tags)). The tags it
+    kept are in both.
+
+    """
+    state = inspect(bmark)
+    was_private = state.attrs.is_private.history.deleted
+    is_private = bool(bmark.is_private)
+    was_private = bool(was_private[0]) if was_private else is_private
+
+    if deleted or was_private != is_private:
+        # Every tag it has changes, so we need them all.
+        tags = state.attrs.tags.load_history()
+    else:
+        # If the tags weren't loaded they can't have changed.
+        tags = state.attrs.tags.history
+    old = [t for t in list(tags.unchanged) + list(tags.deleted) if t]
+    new = [] if deleted else [
+        t for t in list(tags.unchanged) + list(tags.added) if t]
+    return (was_private, old), (is_private, new)
+
+
+def _flushed_bmarks(session):
+    """The (bookmark, is deleted) of the bookmarks about to be flushed"""
+    found = [(obj, False) for obj in session.new if isinstance(obj, Bmark)]
+    found.extend(
+        (obj, False) for obj in session.dirty if isinstance(obj, Bmark))
+    found.extend(
+        (obj, True) for obj in session.deleted if isinstance(obj, Bmark))
+    return found
+
+
+def record_user_tag_changes(session, flush_context, instances):
+    """Collect the changes to user_tags from the bookmarks being flushed
+
+    New tags don't have an id until they're flushed, so the changes are
+    written by write_user_tag_changes.
+
+    """
+    changes = session.info['user_tag_changes'] = defaultdict(
+        lambda: [0, 0, None])
+    for bmark, deleted in _flushed_bmarks(session):
+        (was_private, old), (is_private, new) = bmark_tag_changes(
+            bmark, deleted)
+        for tag in old:
+            change = changes[(bmark.username, tag)]
+            change[0] -= 1
+            change[1] -= 0 if was_private else 1
+        for tag in new:
+            change = changes[(bmark.username, tag)]
+            change[0] += 1
+            change[1] += 0 if is_private else 1
+            if tag not in old:
+                change[2] = datetime.utcnow()
+
+
+def write_user_tag_changes(session, flush_context):
+    """Write the changes record_user_tag_changes found into user_tags"""
+    changes = session.info.pop('user_tag_changes', None)
+    if changes:
+        UserTagMgr.update_counts(
+            session.connection(),
+            dict(((username, tag.tid), tuple(change))
+                 for (username, tag), change in changes.items()))
+
+event.listen(DBSession, 'before_flush', record_user_tag_changes)
+event.listen(DBSession, 'after_flush', write_user_tag_changes)
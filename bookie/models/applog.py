@@ -55,4 +55,4 @@ class AppLog(Base):
     status = Column(Unicode(10), nullable=False)
     message = Column(Unicode(255), nullable=False)
     payload = Column(UnicodeText)
-    tstamp = Column(DateTime, default=datetime.utcnow)
+    tstamp = Column(DateTime, default=datetime.utcnow, index=True)
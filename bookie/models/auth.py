@@ -7,15 +7,20 @@ but it's absolutely independent of TurboGears.
 """
 
 import bcrypt
+import cPickle as pickle
 import hashlib
 import logging
 import random
+import transaction
+import weakref
 
 from datetime import (
     datetime,
     timedelta,
 )
 
+from sqlalchemy import event
+from sqlalchemy import inspect
 from sqlalchemy import Column
 from sqlalchemy import DateTime
 from sqlalchemy import ForeignKey
@@ -26,6 +31,7 @@ from sqlalchemy import Boolean
 from sqlalchemy.orm import relation
 from sqlalchemy.orm import synonym
 
+from bookie.lib.utils import LRUCache
 from bookie.models import Base
 from bookie.models import DBSession
 from bookie.models.social import BaseConnection
@@ -35,6 +41,15 @@ GROUPS = ['admin', 'user']
 ACTIVATION_AGE = timedelta(days=3)
 NON_ACTIVATION_AGE = timedelta(days=30)
 
+# Users looked up to authenticate a request are cached for USER_CACHE_TTL
+# seconds, see UserMgr.get_cached.
+USER_CACHE_SIZE = 1000
+USER_CACHE_TTL = 30
+USER_CACHE = LRUCache(USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+# The cache keys of the users each open transaction has changed, dropped
+# from the cache once it commits.
+PENDING_UNCACHE = weakref.WeakKeyDictionary()
+
 
 def get_random_word(wordLen):
     word = ''
@@ -104,7 +119,7 @@ class Activation(Base):
     __tablename__ = u'activations'
 
     id = Column(Integer, ForeignKey('users.id'), primary_key=True)
-    code = Column(Unicode(60))
+    code = Column(Unicode(60), index=True)
     valid_until = Column(
         DateTime,
         default=lambda: datetime.utcnow + ACTIVATION_AGE)
@@ -199,6 +214,41 @@ class UserMgr(object):
 
         return None
 
+    @staticmethod
+    def get_cached(user_id=None, username=None, api_key=None):
+        """Get the user like get does, from the cache of recent users
+
+        The extension's ping, bookmark and sync calls look up their user over
+        and over, so those are kept for USER_CACHE_TTL seconds. The user comes
+        back merged into the session without a query, and any change to it
+        drops it from the cache once it's committed.
+
+        Only this process's cache is cleared, the others hold onto the user
+        until it expires. Anything changing an account or checking admin
+        rights has to use get.
+
+        """
+        if username is not None:
+            key = ('username', username)
+        elif user_id is not None:
+            key = ('id', user_id)
+        elif api_key is not None:
+            key = ('api_key', api_key)
+        else:
+            return None
+
+        cached = USER_CACHE.get(key)
+        if cached is not None:
+            return DBSession.merge(pickle.loads(cached), load=False)
+
+        user = UserMgr.get(user_id=user_id, username=username, api_key=api_key)
+        # Only what's in the db is cached, not changes waiting on a flush.
+        if user is not None and not inspect(user).modified:
+            cached = pickle.dumps(user, pickle.HIGHEST_PROTOCOL)
+            for key in _user_keys(user):
+                USER_CACHE.set(key, cached)
+        return user
+
     @staticmethod
     def auth_groupfinder(userid, request):
         """Pyramid wants to know what groups a user is in
@@ -266,7 +316,7 @@ class User(Base):
     is_admin = Column(Boolean, default=False)
     last_login = Column(DateTime)
     signup = Column(DateTime, default=datetime.utcnow)
-    api_key = Column(Unicode(12))
+    api_key = Column(Unicode(12), index=True)
     invite_ct = Column(Integer, default=0)
     invited_by = Column('invited_by', Unicode(255))
     BaseConnection = relation(BaseConnection,
@@ -377,3 +427,41 @@ class User(Base):
         m = hashlib.sha256()
         m.update(get_random_word(12))
         return unicode(m.hexdigest()[:12])
+
+
+def _user_keys(user):
+    """The cache keys of user, along with any it had before it changed"""
+    state = inspect(user)
+    keys = set()
+    if state.identity:
+        keys.add(('id', state.identity[0]))
+    for field in ('username', 'api_key'):
+        values = list(state.attrs[field].history.deleted or ())
+        values.append(state.dict.get(field))
+        keys.update((field, value) for value in values if value is not None)
+    return keys
+
+
+def _uncache_users(committed, keys):
+    """After commit hook dropping the changed users from the cache"""
+    for key in keys:
+        USER_CACHE.pop(key)
+
+
+def uncache_changed_users(session, flush_context):
+    """Drop the users changed in this flush from the cache on commit"""
+    keys = set()
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, User):
+            keys.update(_user_keys(obj))
+    if not keys:
+        return
+
+    txn = transaction.get()
+    pending = PENDING_UNCACHE.get(txn)
+    if pending is None:
+        pending = PENDING_UNCACHE[txn] = set()
+        txn.addAfterCommitHook(_uncache_users, (pending,))
+    pending.update(keys)
+
+event.listen(DBSession, 'after_flush', uncache_changed_users)
@@ -3,11 +3,33 @@
 This is going to be dependant on the db model found so we'll setup a factory
 and API as we did in the importer
 
+The fulltext.engine setting picks the backend. whoosh keeps an index on disk
+that's written to in the background. database uses the fulltext support of
+the database itself, SQLite FTS5 or a PostgreSQL tsvector table, and indexes
+bookmarks in the same transaction that writes them.
+
 """
 import logging
 import os
-
+import re
+import shutil
+import tempfile
+import threading
+
+from datetime import datetime
+from glob import glob
+from sqlalchemy import Column
+from sqlalchemy import Integer
+from sqlalchemy import MetaData
+from sqlalchemy import Table
+from sqlalchemy import UnicodeText
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlalchemy.orm import joinedload
+from sqlalchemy.sql import func
+from sqlalchemy.sql import literal_column
+from sqlalchemy.sql import or_
+from sqlalchemy.sql import select
+from zope.sqlalchemy import mark_changed
 
 from whoosh import qparser
 from whoosh.fields import (
@@ -15,6 +37,7 @@ from whoosh.fields import (
     ID,
     KEYWORD,
     SchemaClass,
+    STORED,
     TEXT,
 )
 from whoosh.analysis import StemmingAnalyzer
@@ -27,13 +50,25 @@ from whoosh.query import (
     Term,
 )
 
+from bookie.models import _chunks
 from bookie.models import Bmark
+from bookie.models import BULK_BIND_LIMIT
+from bookie.models import DBSession
+from bookie.models import Hashed
+from bookie.models import Readable
 
 
 LOG = logging.getLogger(__name__)
 INDEX_NAME = None
 INDEX_TYPE = None
 WIX = None
+# The real directory WIX was opened from. Once the index has been rebuilt
+# INDEX_NAME is a symlink to the current build.
+WIX_PATH = None
+REINDEX_CHUNK_SIZE = 5000
+# Each thread keeps its searcher open between requests, see get_searcher.
+SEARCHERS = threading.local()
+DATABASE_INDEX = 'database'
 
 
 def _reset_index():
@@ -44,9 +79,12 @@ def _reset_index():
 def set_index(index_type, index_path):
     global INDEX_NAME
     global INDEX_TYPE
-    global WIX
 
     INDEX_TYPE = index_type
+    if indexed_in_database():
+        DatabaseFulltext().setup()
+        return
+
     INDEX_NAME = index_path
 
     cur_path = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
@@ -54,19 +92,62 @@ def set_index(index_type, index_path):
 
     if not os.path.exists(INDEX_NAME):
         os.mkdir(INDEX_NAME)
-        WIX = create_in(INDEX_NAME, BmarkSchema)
+        create_in(INDEX_NAME, BmarkSchema)
+
+    get_index()
+
+
+def indexed_in_database():
+    """Is the fulltext index kept in the database itself"""
+    return INDEX_TYPE == DATABASE_INDEX
+
+
+def get_index():
+    """Get the index, reopening it if a rebuild has been swapped in"""
+    global WIX
+    global WIX_PATH
+
+    path = os.path.realpath(INDEX_NAME)
+    if path != WIX_PATH:
+        WIX = open_dir(path)
+        WIX_PATH = path
+    return WIX
+
+
+def get_searcher():
+    """Get a searcher on the latest version of the index
+
+    Opening a searcher means opening the reader for every segment, so we
+    keep one per thread and only refresh it when the index has a new
+    generation. Whoosh searchers aren't safe to share between threads.
+
+    Don't close the searcher, it's reused by the next call in this thread.
+
+    """
+    ix = get_index()
+    searcher = getattr(SEARCHERS, 'searcher', None)
+    if searcher is None or SEARCHERS.index is not ix:
+        # A rebuilt index has been swapped in, start over on it.
+        if searcher is not None:
+            searcher.close()
+        searcher = ix.searcher()
     else:
-        WIX = open_dir(INDEX_NAME)
+        searcher = searcher.refresh()
+
+    SEARCHERS.index = ix
+    SEARCHERS.searcher = searcher
+    return searcher
 
 
 class BmarkSchema(SchemaClass):
     bid = ID(unique=True, stored=True)
-    description = TEXT
+    description = TEXT(stored=True)
     extended = TEXT
-    tags = KEYWORD
+    tags = KEYWORD(stored=True)
     readable = TEXT(analyzer=StemmingAnalyzer())
-    username = ID
-    is_private = BOOLEAN
+    username = ID(stored=True)
+    is_private = BOOLEAN(stored=True)
+    url = STORED
 
 
 def get_fulltext_handler(engine):
@@ -74,80 +155,579 @@ def get_fulltext_handler(engine):
     global INDEX_TYPE
     if INDEX_TYPE == 'whoosh':
         return WhooshFulltext()
+    elif indexed_in_database():
+        return DatabaseFulltext()
 
 
 def get_writer():
-    global WIX
-    writer = AsyncWriter(WIX)
+    writer = AsyncWriter(get_index())
     return writer
 
 
+def _document(bid, description, extended, tag_str, username, is_private,
+              url, readable):
+    """The fields we store in the index for a bookmark"""
+    return dict(
+        bid=unicode(bid),
+        description=description if description else u"",
+        extended=extended if extended else u"",
+        tags=tag_str if tag_str else u"",
+        readable=readable if readable else u"",
+        username=username,
+        is_private=is_private,
+        url=url,
+    )
+
+
+def index_bookmarks(bids):
+    """Write a batch of bookmarks to the index with one writer and one commit
+
+    :param bids: the bookmarks to index, read from the db in bulk along with
+        their readable content
+
+    Returns the bids we couldn't find to index. Those bookmarks have been
+    deleted so their documents are removed from the index.
+
+    """
+    if indexed_in_database():
+        return DatabaseFulltext().index_bookmarks(bids)
+
+    bids = sorted(bids)
+    found = {}
+    for chunk in _chunks(bids, BULK_BIND_LIMIT):
+        # Only the clean text of the page is indexed, not the html.
+        qry = Bmark.query.options(
+            joinedload('hashed'),
+            joinedload('readable').defer('content')).\
+            filter(Bmark.bid.in_(chunk))
+        for b in qry:
+            found[b.bid] = b
+    missing = [bid for bid in bids if bid not in found]
+
+    # An index built before a field was added to the schema won't take it
+    # until the index is rebuilt.
+    schema = get_index().schema
+    writer = get_writer()
+    try:
+        for bid, b in sorted(found.items()):
+            if b.readable and b.readable.clean_content:
+                content = b.readable.clean_content
+            else:
+                content = u""
+
+            doc = _document(
+                b.bid, b.description, b.extended, b.tag_str, b.username,
+                b.is_private, b.hashed.url, content)
+            writer.update_document(
+                **dict((k, v) for k, v in doc.items() if k in schema))
+        for bid in missing:
+            writer.delete_by_term('bid', unicode(bid))
+        writer.commit()
+    except Exception:
+        writer.cancel()
+        raise
+
+    return missing
+
+
+def indexed_bids():
+    """All of the bids stored in the index, read in one pass, sorted"""
+    if indexed_in_database():
+        return DatabaseFulltext().indexed_bids()
+
+    with get_index().searcher() as search:
+        return sorted(
+            int(doc['bid']) for doc in search.reader().all_stored_fields())
+
+
+def reconcile_index(chunk_size=REINDEX_CHUNK_SIZE):
+    """Diff the bookmarks in the db against the documents in the index
+
+    The bids in the db are walked in order a chunk at a time and merged
+    against the sorted bids in the index.
+
+    Returns (bids missing from the index, bids only in the index).
+
+    """
+    indexed = indexed_bids()
+    missing = []
+    stale = []
+    pos = 0
+    last = None
+    while True:
+        qry = DBSession.query(Bmark.bid).order_by(Bmark.bid)
+        if last is not None:
+            qry = qry.filter(Bmark.bid > last)
+        chunk = [bid for (bid,) in qry.limit(chunk_size)]
+        if not chunk:
+            break
+
+        for bid in chunk:
+            while pos < len(indexed) and indexed[pos] < bid:
+                stale.append(indexed[pos])
+                pos += 1
+            if pos < len(indexed) and indexed[pos] == bid:
+                pos += 1
+            else:
+                missing.append(bid)
+        last = chunk[-1]
+
+    stale.extend(indexed[pos:])
+    return missing, stale
+
+
+def iter_documents(chunk_size=REINDEX_CHUNK_SIZE):
+    """Stream the index documents for every bookmark
+
+    The bookmarks are read in ranges of chunk_size ids so no one query has to
+    walk the whole table, and the rows are streamed with yield_per. Only the
+    columns we index are loaded, no tags or other relations.
+
+    Yields a list of documents per range.
+
+    """
+    low, high = DBSession.query(func.min(Bmark.bid), func.max(Bmark.bid)).\
+        one()
+    if low is None:
+        return
+
+    for start in xrange(low, high + 1, chunk_size):
+        qry = DBSession.query(
+            Bmark.bid,
+            Bmark.description,
+            Bmark.extended,
+            Bmark.tag_str,
+            Bmark.username,
+            Bmark.is_private,
+            Hashed.url,
+            Readable.clean_content).\
+            join(Hashed, Hashed.hash_id == Bmark.hash_id).\
+            outerjoin(Readable, Readable.bid == Bmark.bid).\
+            filter(Bmark.bid >= start).\
+            filter(Bmark.bid < start + chunk_size).\
+            order_by(Bmark.bid).\
+            yield_per(BULK_BIND_LIMIT)
+        yield [_document(*row) for row in qry]
+
+
+def rebuild_index(procs=1, limitmb=128, chunk_size=REINDEX_CHUNK_SIZE,
+                  progress=None):
+    """Build a whole new index of every bookmark and swap it in
+
+    :param procs: the number of processes to write the index with. With more
+        than one each process writes its own segments.
+    :param limitmb: the memory each writer can use before it has to flush
+    :param chunk_size: how many bookmark ids to read from the db at a time
+    :param progress: called with (done, total) after each chunk
+
+    The live index keeps serving searches until the new one is complete.
+    Updates made while the rebuild is running go to the old index, so the
+    caller should reindex anything changed since the returned start time.
+
+    The database index is rebuilt in the current transaction instead, procs
+    and limitmb don't apply.
+
+    """
+    if indexed_in_database():
+        return DatabaseFulltext().rebuild(chunk_size, progress)
+
+    started = datetime.utcnow()
+    total = Bmark.query.count()
+
+    live = INDEX_NAME.rstrip(os.sep)
+    build_dir = tempfile.mkdtemp(
+        prefix=os.path.basename(live) + '.build-',
+        dir=os.path.dirname(live))
+    os.chmod(build_dir, 0755)
+    ix = create_in(build_dir, BmarkSchema)
+
+    if procs > 1:
+        writer = ix.writer(procs=procs, multisegment=True, limitmb=limitmb)
+    else:
+        writer = ix.writer(limitmb=limitmb)
+
+    done = 0
+    try:
+        for docs in iter_documents(chunk_size):
+            for doc in docs:
+                writer.add_document(**doc)
+            done += len(docs)
+            if progress:
+                progress(done, total)
+        writer.commit()
+    except Exception:
+        writer.cancel()
+        shutil.rmtree(build_dir, ignore_errors=True)
+        raise
+
+    swap_index(build_dir)
+    return started
+
+
+def swap_index(build_dir):
+    """Make build_dir the live index
+
+    INDEX_NAME becomes a symlink to the build, replaced with a rename so
+    searches never see a missing or half built index. The very first swap has
+    to move the original index directory out of the way first.
+
+    The index that was live is kept until the next swap in case a search is
+    still reading it, anything older is removed.
+
+    """
+    live = INDEX_NAME.rstrip(os.sep)
+    replaced = os.path.realpath(live)
+
+    if not os.path.islink(live):
+        replaced = tempfile.mkdtemp(
+            prefix=os.path.basename(live) + '.build-',
+            dir=os.path.dirname(live))
+        os.rmdir(replaced)
+        os.rename(live, replaced)
+
+    link = live + '.swap'
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.path.basename(build_dir), link)
+    os.rename(link, live)
+    LOG.info('Swapped in fulltext index ' + build_dir)
+
+    keep = (os.path.realpath(build_dir), replaced)
+    for old in glob(live + '.build-*'):
+        if os.path.realpath(old) not in keep:
+            shutil.rmtree(old, ignore_errors=True)
+
+    get_index()
+
+
 class WhooshFulltext(object):
     """Implement the fulltext api using whoosh as a storage backend
 
     """
-    global WIX
 
     def doc_count(self):
-        with WIX.searcher() as search:
-            return search.doc_count()
+        return get_searcher().doc_count()
 
     def findByID(self, bid):
         """Find the item in the fulltext index by id"""
-        with WIX.searcher() as search:
-            found = search.documents(bid=unicode(bid))
-            res = [b for b in found]
-        if res:
-            return res[0]
-        else:
-            return None
+        return get_searcher().document(bid=unicode(bid))
 
     def search(self, phrase, content=False, username=None, ct=10, page=0,
-               requested_by=None):
-        """Implement the search, returning a list of bookmarks"""
-        page = int(page) + 1
+               requested_by=None, with_readable=False, stored=False):
+        """Implement the search, returning a list of bookmarks
 
-        with WIX.searcher() as search:
-            fields = ['description', 'extended', 'tags']
+        The bookmarks come back in score order with their tags and hashed
+        loaded, and the readable too if with_readable.
 
-            if content:
-                fields.append('readable')
-
-            parser = qparser.MultifieldParser(fields,
-                                              schema=WIX.schema,
-                                              group=qparser.OrGroup)
-            qry = parser.parse(phrase)
-
-            if username:
-                if requested_by and username == requested_by:
-                    qry = And([
-                        qry,
-                        Or([
-                            Term('is_private', 'f'),
-                            And([
-                                Term('username', username),
-                                Term('is_private', 't')
-                            ])
-                        ])
+        :param stored: skip the database and return a dict of the fields
+            stored in the index for each result.
+
+        """
+        page = int(page) + 1
+
+        search = get_searcher()
+        fields = ['description', 'extended', 'tags']
+
+        if content:
+            fields.append('readable')
+
+        parser = qparser.MultifieldParser(fields,
+                                          schema=search.schema,
+                                          group=qparser.OrGroup)
+        qry = parser.parse(phrase)
+
+        # Which bookmarks we can see is a filter so it doesn't add to the
+        # score and throw off the ranking.
+        if username:
+            if requested_by and username == requested_by:
+                allow = Or([
+                    Term('is_private', 'f'),
+                    And([
+                        Term('username', username),
+                        Term('is_private', 't')
                     ])
-                else:
-                    qry = And([qry, Term('username', username),
-                              Term('is_private', 'f')])
+                ])
             else:
-                qry = And([qry, Term('is_private', 'f')])
+                allow = And([Term('username', username),
+                             Term('is_private', 'f')])
+        else:
+            allow = Term('is_private', 'f')
 
-            try:
-                res = search.search_page(qry, page, pagelen=int(ct))
-            except ValueError, exc:
-                raise(exc)
+        try:
+            res = search.search_page(qry, page, pagelen=int(ct),
+                                     filter=allow)
+        except ValueError, exc:
+            raise(exc)
+
+        if stored:
+            return [hit.fields() for hit in res]
+
+        return load_bookmarks(
+            [int(hit['bid']) for hit in res], with_readable)
 
-            if res:
-                qry = Bmark.query.filter(
-                    Bmark.bid.in_([r['bid'] for r in res])
-                )
 
-                qry = qry.options(joinedload('hashed'))
+def load_bookmarks(bids, with_readable=False):
+    """Load the bookmarks for search results in one query, in bids order
 
-                return qry.all()
+    The tags and hashed are loaded with them, and the readable if
+    with_readable.
+
+    """
+    if not bids:
+        return []
+
+    options = [joinedload('hashed'), joinedload('tags')]
+    if with_readable:
+        options.append(joinedload('readable'))
+    qry = Bmark.query.options(*options).filter(Bmark.bid.in_(bids))
+
+    found = dict((b.bid, b) for b in qry)
+    return [found[bid] for bid in bids if bid in found]
+
+
+def stored_fields(bids):
+    """The fields whoosh stores for bookmarks, loaded from the db"""
+    if not bids:
+        return []
+
+    qry = DBSession.query(
+        Bmark.bid,
+        Bmark.description,
+        Bmark.tag_str,
+        Bmark.username,
+        Bmark.is_private,
+        Hashed.url).\
+        join(Hashed, Hashed.hash_id == Bmark.hash_id).\
+        filter(Bmark.bid.in_(bids))
+
+    found = {}
+    for row in qry:
+        found[row.bid] = dict(
+            bid=unicode(row.bid),
+            description=row.description,
+            tags=row.tag_str,
+            username=row.username,
+            is_private=row.is_private,
+            url=row.url,
+        )
+    return [found[bid] for bid in bids if bid in found]
+
+
+SQLITE_FTS = Table(
+    'bmarks_fts', MetaData(),
+    Column('rowid', Integer, key='bid'),
+    Column('description', UnicodeText),
+    Column('extended', UnicodeText),
+    Column('tags', UnicodeText),
+    Column('readable', UnicodeText),
+)
+
+PGSQL_FTS = Table(
+    'bmarks_fts', MetaData(),
+    Column('bid', Integer, primary_key=True),
+    Column('fields', TSVECTOR),
+    Column('readable', TSVECTOR),
+)
+
+FTS_TABLES = {
+    'sqlite': SQLITE_FTS,
+    'postgresql': PGSQL_FTS,
+}
+
+class DatabaseFulltext(object):
+    """Implement the fulltext api using the fulltext support in the database
+
+    The bookmarks are indexed into a bmarks_fts table keyed by bid. There's
+    no index lock, writes to it are part of the transaction writing the
+    bookmark.
+
+    """
+
+    def __init__(self, bind=None):
+        if bind is None:
+            bind = DBSession.bind
+        self.dialect = bind.dialect.name
+        if self.dialect not in FTS_TABLES:
+            raise ValueError(
+                'The database fulltext engine needs sqlite or postgresql, '
+                'not ' + self.dialect)
+        self.table = FTS_TABLES[self.dialect]
+
+    def setup(self):
+        """Make sure we have the fulltext table
+
+        It's created by a migration in dbversions, along with the rest of the
+        schema.
+
+        """
+        if not DBSession.bind.has_table(self.table.name):
+            raise ValueError(
+                'The database fulltext engine needs the {0} table, run the '
+                'migrations to create it'.format(self.table.name))
+
+    def _documents(self):
+        """Select the indexed values of bookmarks for this database"""
+        source = Bmark.__table__.outerjoin(
+            Readable.__table__, Readable.bid == Bmark.bid)
+
+        if self.dialect == 'sqlite':
+            columns = [
+                Bmark.bid,
+                Bmark.description,
+                Bmark.extended,
+                Bmark.tag_str,
+                Readable.clean_content,
+            ]
+        else:
+            def vector(column, weight=None):
+                vec = func.to_tsvector('english', func.coalesce(column, u''))
+                if weight:
+                    vec = func.setweight(vec, weight)
+                return vec
+
+            fields = vector(Bmark.description, 'A').\
+                op('||')(vector(Bmark.tag_str, 'B')).\
+                op('||')(vector(Bmark.extended, 'C'))
+            columns = [Bmark.bid, fields, vector(Readable.clean_content)]
+
+        return select(columns).select_from(source)
+
+    def _insert(self, where):
+        """Index the bookmarks matching where with an INSERT ... SELECT"""
+        return self.table.insert().from_select(
+            list(self.table.c), self._documents().where(where))
+
+    def index(self, connection, bids):
+        """(Re)index the bookmarks with the given bids
+
+        :param connection: the connection of the transaction writing the
+            bookmarks, so the index changes along with them.
+
+        """
+        for chunk in _chunks(sorted(bids), BULK_BIND_LIMIT):
+            connection.execute(
+                self.table.delete().where(self.table.c.bid.in_(chunk)))
+            connection.execute(self._insert(Bmark.bid.in_(chunk)))
+
+    def delete(self, connection, bids):
+        """Remove the bookmarks with the given bids from the index"""
+        for chunk in _chunks(sorted(bids), BULK_BIND_LIMIT):
+            connection.execute(
+                self.table.delete().where(self.table.c.bid.in_(chunk)))
+
+    def index_bookmarks(self, bids):
+        """Index the bookmarks from what's stored in the db
+
+        Returns the bids that no longer exist, which are removed from the
+        index.
+
+        """
+        bids = sorted(bids)
+        found = set()
+        for chunk in _chunks(bids, BULK_BIND_LIMIT):
+            found.update(bid for (bid,) in DBSession.query(Bmark.bid).
+                         filter(Bmark.bid.in_(chunk)))
+        missing = [bid for bid in bids if bid not in found]
+
+        connection = DBSession.connection()
+        self.index(connection, found)
+        self.delete(connection, missing)
+        mark_changed(DBSession())
+        return missing
+
+    def indexed_bids(self):
+        """All of the bids in the index, sorted"""
+        return [bid for (bid,) in DBSession.query(self.table.c.bid).
+                order_by(self.table.c.bid)]
+
+    def rebuild(self, chunk_size=REINDEX_CHUNK_SIZE, progress=None):
+        """Reindex every bookmark in the current transaction"""
+        started = datetime.utcnow()
+        total = Bmark.query.count()
+        low, high = DBSession.query(
+            func.min(Bmark.bid), func.max(Bmark.bid)).one()
+
+        connection = DBSession.connection()
+        connection.execute(self.table.delete())
+
+        done = 0
+        if low is not None:
+            for start in xrange(low, high + 1, chunk_size):
+                res = connection.execute(self._insert(
+                    Bmark.bid.between(start, start + chunk_size - 1)))
+                done += res.rowcount
+                if progress:
+                    progress(done, total)
+
+        mark_changed(DBSession())
+        return started
+
+    def doc_count(self):
+        return DBSession.query(func.count(self.table.c.bid)).scalar()
+
+    def findByID(self, bid):
+        """Find the item in the fulltext index by id"""
+        found = DBSession.query(self.table.c.bid).\
+            filter(self.table.c.bid == bid).first()
+        if found:
+            res = stored_fields([int(bid)])
+            if res:
+                return res[0]
+        return None
+
+    def search(self, phrase, content=False, username=None, ct=10, page=0,
+               requested_by=None, with_readable=False, stored=False):
+        """Implement the search, returning a list of bookmarks
+
+        Works like WhooshFulltext.search, any of the words in the phrase can
+        match.
+
+        """
+        page = int(page)
+        ct = int(ct)
+        if page < 0:
+            raise ValueError('page {0} out of range'.format(page))
+
+        words = re.findall(r'\w+', phrase, re.UNICODE)
+        if not words:
+            return []
+
+        fts = self.table
+        if self.dialect == 'sqlite':
+            match = u' OR '.join(u'"{0}"'.format(w) for w in words)
+            if not content:
+                match = u'{description extended tags} : (' + match + u')'
+            table = literal_column(fts.name)
+            where = table.op('MATCH')(match)
+            # bm25 scores go down as the match gets better.
+            rank = func.bm25(table)
+        else:
+            terms = func.to_tsquery('english', u' | '.join(words))
+            where = fts.c.fields.op('@@')(terms)
+            rank = func.ts_rank(fts.c.fields, terms)
+            if content:
+                where = or_(where, fts.c.readable.op('@@')(terms))
+                rank = rank + func.ts_rank(fts.c.readable, terms)
+            rank = rank.desc()
+
+        qry = DBSession.query(Bmark.bid).\
+            join(fts, fts.c.bid == Bmark.bid).\
+            filter(where)
+
+        if username:
+            if requested_by and username == requested_by:
+                qry = qry.filter(or_(
+                    Bmark.is_private == False,  # noqa
+                    Bmark.username == username))
             else:
-                return []
+                qry = qry.filter(Bmark.username == username).\
+                    filter(Bmark.is_private == False)  # noqa
+        else:
+            qry = qry.filter(Bmark.is_private == False)  # noqa
+
+        qry = qry.order_by(rank).offset(page * ct).limit(ct)
+        bids = [bid for (bid,) in qry]
+
+        if stored:
+            return stored_fields(bids)
+        return load_bookmarks(bids, with_readable)
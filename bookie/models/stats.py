@@ -27,6 +27,7 @@ from datetime import (
 
 from sqlalchemy import Column
 from sqlalchemy import DateTime
+from sqlalchemy import Index
 from sqlalchemy import Integer
 from sqlalchemy import Unicode
 
@@ -154,6 +155,9 @@ class StatBookmark(Base):
 
     """
     __tablename__ = 'stats_bookmarks'
+    __table_args__ = (
+        Index('ix_stats_bookmarks_attrib_tstamp', 'attrib', 'tstamp'),
+    )
 
     id = Column(Integer, autoincrement=True, primary_key=True)
     tstamp = Column(DateTime, default=datetime.utcnow)
@@ -0,0 +1,327 @@
+"""Keep the tag names in memory for completing tags as people type
+
+Each user gets an index of the tags on their bookmarks, one of just their
+public bookmarks for everyone else, and there's one of the public tags of all
+users. An index is built with one query the first time it's needed. After that
+it's kept up to date as bookmarks change in this process, and reloaded every
+INDEX_TTL seconds to catch up with changes made by other processes. The reload
+happens in a background thread, requests keep using the old index until the
+new one is ready.
+
+How often each pair of tags is used on the same bookmark is counted as well,
+the first time related tags are needed from an index.
+
+"""
+import logging
+import threading
+import time
+import transaction
+import weakref
+
+from bisect import bisect_left
+from collections import defaultdict
+from collections import OrderedDict
+from heapq import nsmallest
+from sqlalchemy import event
+from sqlalchemy.orm import aliased
+from sqlalchemy.sql import and_
+from sqlalchemy.sql import func
+
+from bookie.models import _flushed_bmarks
+from bookie.models import Bmark
+from bookie.models import bmark_tag_changes
+from bookie.models import bmarks_tags
+from bookie.models import DBSession
+from bookie.models import Tag
+
+LOG = logging.getLogger(__name__)
+
+# Seconds before an index is reloaded from the db.
+INDEX_TTL = 300
+# How many indexes to hold onto, the least recently used go first.
+MAX_INDEXES = 1000
+
+INDEXES = OrderedDict()
+LOCK = threading.Lock()
+# The tag count changes each open transaction has flushed, applied to the
+# indexes once it commits.
+PENDING_CHANGES = weakref.WeakKeyDictionary()
+
+
+class TagPrefixIndex(object):
+    """Sorted tag names and how many bookmarks have each of them
+
+    pairs holds how many bookmarks have both of two tags, as a dict of
+    name: {other name: count}. It's None until it's loaded by get_index.
+
+    """
+
+    def __init__(self, counts):
+        self.counts = dict(counts)
+        self.names = sorted(self.counts)
+        self.pairs = None
+        self.built = time.time()
+        # While a fresh copy is loading, the thread loading it and the
+        # changes committed in the meantime to replay on the copy.
+        self.refresher = None
+        self.missed = None
+
+    def expired(self):
+        return time.time() - self.built > INDEX_TTL
+
+    def apply(self, name, other, change):
+        """Apply a change to the count of name, or of name and other"""
+        if other is None:
+            self.update(name, change)
+        else:
+            self.update_pair(name, other, change)
+        if self.missed is not None:
+            self.missed.append((name, other, change))
+
+    def update(self, name, change):
+        """Add change to the number of bookmarks tagged with name"""
+        count = self.counts.get(name, 0) + change
+        if count > 0:
+            if name not in self.counts:
+                self.names.insert(bisect_left(self.names, name), name)
+            self.counts[name] = count
+        elif name in self.counts:
+            del self.counts[name]
+            del self.names[bisect_left(self.names, name)]
+
+    def load_pairs(self, pairs):
+        """Hold onto the (name, other name, count) of each pair of tags"""
+        self.pairs = defaultdict(dict)
+        for name, other, count in pairs:
+            self.pairs[name][other] = count
+
+    def update_pair(self, name, other, change):
+        """Add change to the number of bookmarks with both name and other"""
+        if self.pairs is None:
+            return
+        count = self.pairs[name].get(other, 0) + change
+        if count > 0:
+            self.pairs[name][other] = count
+        else:
+            self.pairs[name].pop(other, None)
+
+    def complete(self, prefix, limit):
+        """The limit most used tag names that start with prefix"""
+        start = bisect_left(self.names, prefix)
+        end = bisect_left(self.names, prefix + u'\uffff')
+        counts = self.counts
+        return nsmallest(
+            limit,
+            self.names[start:end],
+            key=lambda name: (-counts.get(name, 0), name))
+
+    def related(self, names, limit, prefix=u''):
+        """The tags used most along with any of names
+
+        :param prefix: only the related tags that start with prefix
+
+        Returns a list of (name, count) where count is how many times the tag
+        is used with one of names.
+
+        """
+        found = defaultdict(int)
+        for name in names:
+            for other, count in self.pairs.get(name, {}).items():
+                if other.startswith(prefix) and other not in names:
+                    found[other] += count
+        return nsmallest(
+            limit,
+            found.items(),
+            key=lambda (name, count): (-count, name))
+
+
+def _load_counts(username, private):
+    """Count the bookmarks of each tag in the db"""
+    qry = DBSession.query(Tag.name, func.count(bmarks_tags.c.bmark_id)).\
+        join(bmarks_tags, bmarks_tags.c.tag_id == Tag.tid).\
+        join(Bmark, Bmark.bid == bmarks_tags.c.bmark_id)
+    if username:
+        qry = qry.filter(Bmark.username == username)
+    if not private:
+        qry = qry.filter(Bmark.is_private == False)   # noqa
+    return qry.group_by(Tag.name).all()
+
+
+def _load_pairs(username, private):
+    """Count the bookmarks of each pair of tags in the db"""
+    tagged = bmarks_tags.alias()
+    other_tagged = bmarks_tags.alias()
+    other = aliased(Tag)
+    qry = DBSession.query(
+        Tag.name, other.name, func.count(tagged.c.bmark_id)).\
+        select_from(tagged).\
+        join(other_tagged, and_(
+            other_tagged.c.bmark_id == tagged.c.bmark_id,
+            other_tagged.c.tag_id != tagged.c.tag_id)).\
+        join(Tag, Tag.tid == tagged.c.tag_id).\
+        join(other, other.tid == other_tagged.c.tag_id).\
+        join(Bmark, Bmark.bid == tagged.c.bmark_id)
+    if username:
+        qry = qry.filter(Bmark.username == username)
+    if not private:
+        qry = qry.filter(Bmark.is_private == False)   # noqa
+    return qry.group_by(Tag.name, other.name).all()
+
+
+def get_index(username=None, private=False, pairs=False):
+    """The index of the tags of username's bookmarks
+
+    :param username: the user to complete for, None for all users
+    :param private: include the tags of private bookmarks
+    :param pairs: make sure the pairs of tags are loaded
+
+    """
+    key = (username, bool(username and private))
+    with LOCK:
+        index = INDEXES.get(key)
+        if index is not None:
+            # Keep it from being pushed out as the least recently used.
+            INDEXES[key] = INDEXES.pop(key)
+            if index.expired() and index.refresher is None:
+                index.missed = []
+                index.refresher = threading.Thread(
+                    target=_refresh, args=(key, index))
+                index.refresher.daemon = True
+                index.refresher.start()
+
+    if index is None:
+        LOG.debug('Building tag index: ' + str(key))
+        index = TagPrefixIndex(_load_counts(*key))
+        with LOCK:
+            INDEXES.pop(key, None)
+            INDEXES[key] = index
+            while len(INDEXES) > MAX_INDEXES:
+                INDEXES.popitem(last=False)
+
+    if pairs and index.pairs is None:
+        LOG.debug('Loading tag pairs: ' + str(key))
+        found = _load_pairs(*key)
+        with LOCK:
+            if index.pairs is None:
+                index.load_pairs(found)
+    return index
+
+
+def _refresh(key, stale):
+    """Load a fresh copy of the stale index and swap it in
+
+    This runs in its own thread, with its own session, while the stale index
+    keeps answering. If the load fails the stale index is used for another
+    INDEX_TTL seconds before trying again.
+
+    """
+    LOG.debug('Reloading tag index: ' + str(key))
+    fresh = None
+    try:
+        fresh = TagPrefixIndex(_load_counts(*key))
+        if stale.pairs is not None:
+            fresh.load_pairs(_load_pairs(*key))
+    except Exception, exc:
+        LOG.error('Could not reload tag index: ' + str(key))
+        LOG.exception(exc)
+    finally:
+        transaction.abort()
+        DBSession.remove()
+
+    with LOCK:
+        if fresh is None:
+            stale.built = time.time()
+        else:
+            for name, other, change in stale.missed:
+                fresh.apply(name, other, change)
+            # Unless it was dropped while we were loading.
+            if INDEXES.get(key) is stale:
+                INDEXES[key] = fresh
+        stale.missed = None
+        stale.refresher = None
+
+
+def complete(prefix, limit=5, username=None, private=False, current=None):
+    """The most used tag names starting with prefix, see get_index
+
+    :param current: only complete tags used with one of these tags, the ones
+        used with them most first
+
+    """
+    prefix = prefix.lower()
+    if current:
+        found = related(
+            current, limit=limit, username=username, private=private,
+            prefix=prefix)
+        return [name for name, count in found]
+    return get_index(username, private).complete(prefix, limit)
+
+
+def related(names, limit=10, username=None, private=False, prefix=u''):
+    """The tags used most on the same bookmarks as names, see get_index
+
+    Returns a list of (name, count).
+
+    """
+    names = set(name.lower() for name in names)
+    index = get_index(username, private, pairs=True)
+    return index.related(names, limit, prefix=prefix)
+
+
+def reset_indexes():
+    """Drop every index, they're rebuilt from the db when next used"""
+    with LOCK:
+        INDEXES.clear()
+
+
+def _bmark_changes(bmark, changes, deleted=False):
+    """Add the tag changes made to bmark since the last flush
+
+    changes is a dict of (username, is_private, tag name, other tag name):
+    change. The other name is None for the change in the count of the tag,
+    otherwise it's the change in the count of the pair of tags.
+
+    """
+    # The tags it kept cancel out.
+    for (private, tags), change in zip(
+            bmark_tag_changes(bmark, deleted), (-1, 1)):
+        names = [tag.name for tag in tags]
+        for name in names:
+            changes[(bmark.username, private, name, None)] += change
+            for other in names:
+                if other != name:
+                    changes[(bmark.username, private, name, other)] += change
+
+
+def _apply_changes(committed, changes):
+    """After commit hook updating the indexes we hold with the changes"""
+    if not committed:
+        return
+
+    with LOCK:
+        for (username, is_private, name, other), change in changes.items():
+            if not change:
+                continue
+            keys = [(username, True)]
+            if not is_private:
+                keys.extend([(username, False), (None, False)])
+            for key in keys:
+                if key in INDEXES:
+                    INDEXES[key].apply(name, other, change)
+
+
+def record_tag_changes(session, flush_context, instances):
+    """Collect the tag changes to bookmarks about to be flushed"""
+    bmarks = _flushed_bmarks(session)
+    if not bmarks:
+        return
+
+    txn = transaction.get()
+    changes = PENDING_CHANGES.get(txn)
+    if changes is None:
+        changes = PENDING_CHANGES[txn] = defaultdict(int)
+        txn.addAfterCommitHook(_apply_changes, (changes,))
+    for bmark, deleted in bmarks:
+        _bmark_changes(bmark, changes, deleted)
+
+event.listen(DBSession, 'before_flush', record_tag_changes)
@@ -177,6 +177,14 @@ def build_routes(config):
                      "/api/v1/{username}/tags/complete")
     config.add_route("api_tag_complete",
                      "/api/v1/tags/complete")
+    config.add_route("api_tag_cloud_user",
+                     "/api/v1/{username}/tags/cloud")
+    config.add_route("api_tag_cloud",
+                     "/api/v1/tags/cloud")
+    config.add_route("api_tag_related_user",
+                     "/api/v1/{username}/tags/related")
+    config.add_route("api_tag_related",
+                     "/api/v1/tags/related")
 
     config.add_route("api_social_connections",
                      "/api/v1/{username}/social_connections")
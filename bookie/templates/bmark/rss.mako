@@ -19,6 +19,9 @@
 		<title>Bookie: ${rss_title()}</title>
 		<link>${request.route_url('home')}</link>
 		<atom:link href="${request.current_route_url()}" rel="self" type="application/rss+xml" />
+		% if next_cursor:
+		<atom:link href="${request.current_route_url(_query=dict(request.GET, cursor=next_cursor))}" rel="next" type="application/rss+xml" />
+		% endif
 		<description>bookmark your web</description>
 		% for bmark in bmarks:
 		<item>
@@ -8,9 +8,18 @@
         % if username:
             <a href="${request.route_url('user_tag_bmarks', tags=[tag.name],
                         username=username)}">${tag.name}</a>
+            (${tag.public_count if public else tag.count})
         % else:
             <a href="${request.route_url('tag_bmarks', tags=[tag.name])}">${tag.name}</a>
         % endif
     </div>
 % endfor
 </div>
+<div class="paging">
+    % if page > 0:
+        <a href="${request.current_route_url(_query={'page': page - 1, 'count': count})}">Previous</a>
+    % endif
+    % if (page + 1) * count < tag_count:
+        <a href="${request.current_route_url(_query={'page': page + 1, 'count': count})}">Next</a>
+    % endif
+</div>
@@ -6,6 +6,7 @@ import shutil
 import transaction
 import unittest
 
+from glob import glob
 from logging.config import fileConfig
 from pyramid import testing
 
@@ -16,9 +17,11 @@ from bookie.models import Bmark
 from bookie.models import Hashed
 from bookie.models import Readable
 from bookie.models import Tag
+from bookie.models import UserTag
 from bookie.models.applog import AppLog
 from bookie.models.auth import Activation
 from bookie.models.auth import User
+from bookie.models.auth import USER_CACHE
 from bookie.models.queue import ImportQueue
 from bookie.models.social import (
     BaseConnection,
@@ -26,6 +29,7 @@ from bookie.models.social import (
 )
 from bookie.models.stats import StatBookmark
 from bookie.models.fulltext import _reset_index
+from bookie.models.tagindex import reset_indexes
 
 global_config = {}
 
@@ -51,12 +55,16 @@ BOOKIE_TEST_INI = test_ini
 print "\nUSING TEST INI: ", BOOKIE_TEST_INI
 
 # clean up whoosh index between test runs
+# a rebuilt index is a symlink to its build directory
 whoosh_idx = settings['fulltext.index']
-try:
-    # if this is a sqlite db then try to take care of the db file
-    shutil.rmtree(whoosh_idx)
-except:
-    pass
+for path in [whoosh_idx] + glob(whoosh_idx + '.build-*'):
+    try:
+        if os.path.islink(path):
+            os.remove(path)
+        else:
+            shutil.rmtree(path)
+    except:
+        pass
 
 
 def gen_random_word(wordLen):
@@ -73,6 +81,8 @@ class TestDBBase(unittest.TestCase):
         initialize_sql(settings)
         testing.setUp()
         self.trans = transaction.begin()
+        reset_indexes()
+        USER_CACHE.clear()
 
     def tearDown(self):
         """Tear down each test"""
@@ -118,6 +128,7 @@ class TestViewBase(unittest.TestCase):
 def empty_db():
     """On teardown, remove all the db stuff"""
     DBSession.execute(bmarks_tags.delete())
+    UserTag.query.delete()
     Readable.query.delete()
     Bmark.query.delete()
     StatBookmark.query.delete()
@@ -140,3 +151,5 @@ def empty_db():
 
     # Clear the fulltext index as well.
     _reset_index()
+    reset_indexes()
+    USER_CACHE.clear()
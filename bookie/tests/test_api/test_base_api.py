@@ -15,6 +15,7 @@ from bookie.models import (
     Readable,
 )
 from bookie.models.auth import Activation
+from bookie.models.auth import User
 from bookie.tests import BOOKIE_TEST_INI
 from bookie.tests import empty_db
 from bookie.tests import factory
@@ -680,6 +681,35 @@ class BookieAPITest(unittest.TestCase):
         # self.assertTrue('here dude' in bmark[u'readable']['content'],
         #     "There should be content: " + str(bmark))
 
+    def test_bookmark_recent_cursor(self):
+        """Following next_cursor should page through the bookmarks"""
+        self._get_good_request(content=True, second_bmark=True)
+        res = self.testapp.get(
+            '/api/v1/admin/bmarks?count=1&api_key=' + API_KEY,
+            status=200)
+        first = json.loads(res.body)
+        self.assertEqual(BMARKUS_HASH, first['bmarks'][0][u'hash_id'])
+        self.assertTrue(
+            first['next_cursor'],
+            "A full page should have a next cursor: " + res.body)
+
+        res = self.testapp.get(
+            '/api/v1/admin/bmarks',
+            params={
+                'count': 1,
+                'cursor': first['next_cursor'],
+                'api_key': API_KEY,
+            },
+            status=200)
+        second = json.loads(res.body)
+        self.assertEqual(GOOGLE_HASH, second['bmarks'][0][u'hash_id'])
+        self._check_cors_headers(res)
+
+        res = self.testapp.get(
+            '/api/v1/admin/bmarks?cursor=junk&api_key=' + API_KEY,
+            status=400)
+        self.assertTrue('error' in json.loads(res.body))
+
     def test_bookmark_sync(self):
         """Test that we can get the sync list from the server"""
         self._get_good_request(content=True, second_bmark=True)
@@ -882,6 +912,97 @@ class BookieAPITest(unittest.TestCase):
             "Should not have python as a tag completion: " + res.body)
         self._check_cors_headers(res)
 
+    def test_bookmark_tag_cloud(self):
+        """The tag cloud has the most used tags of public bookmarks"""
+        self._get_good_request(second_bmark=True)
+
+        res = self.testapp.get(
+            '/api/v1/admin/tags/cloud',
+            params={'api_key': API_KEY},
+            status=200)
+        cloud = json.loads(res.body)
+        self.assertEqual(
+            [u'bookmarks', u'python', u'search'],
+            sorted(tag['name'] for tag in cloud['tags']),
+            "All of the tags should be in the cloud: " + res.body)
+        self.assertEqual(0, cloud['page'])
+        self._check_cors_headers(res)
+
+        res = self.testapp.get(
+            '/api/v1/tags/cloud',
+            params={'count': 1, 'page': 1},
+            status=200)
+        cloud = json.loads(res.body)
+        self.assertEqual(1, cloud['count'], "One tag to a page: " + res.body)
+
+    def test_bookmark_tag_cloud_last_used(self):
+        """Only the owner sees when their tags were last used"""
+        self._get_good_request(is_private=True)
+
+        res = self.testapp.get(
+            '/api/v1/admin/tags/cloud',
+            params={'api_key': API_KEY},
+            status=200)
+        tags = json.loads(res.body)['tags']
+        self.assertTrue(
+            all(tag['last_used'] for tag in tags),
+            "The owner gets when each tag was used: " + res.body)
+
+        self._get_good_request(url=u'http://bmark.us')
+        for url in ('/api/v1/admin/tags/cloud', '/api/v1/tags/cloud'):
+            res = self.testapp.get(url, status=200)
+            tags = json.loads(res.body)['tags']
+            self.assertEqual(
+                [u'python', u'search'],
+                sorted(tag['name'] for tag in tags),
+                "Only the public tags are in the cloud: " + res.body)
+            self.assertEqual(
+                [u'', u''],
+                [tag['last_used'] for tag in tags],
+                "The private bookmark's use isn't given away: " + res.body)
+
+    def test_bookmark_tag_related(self):
+        """Related tags are the ones used on the same bookmarks"""
+        self._get_good_request(second_bmark=True)
+
+        res = self.testapp.get(
+            '/api/v1/admin/tags/related',
+            params={
+                'tags': u'python',
+                'api_key': API_KEY},
+            status=200)
+        related = json.loads(res.body)
+        self.assertEqual(
+            [{u'name': u'search', u'count': 1}],
+            related['tags'],
+            "Only search is used with python: " + res.body)
+        self._check_cors_headers(res)
+
+    def test_bookmark_tag_related_accounts_for_privacy(self):
+        """Only the owner gets related tags from private bookmarks"""
+        self._get_good_request(is_private=True)
+
+        res = self.testapp.get(
+            '/api/v1/admin/tags/related',
+            params={
+                'tags': u'python',
+                'api_key': API_KEY},
+            status=200)
+        self.assertEqual(
+            [u'search'],
+            [tag['name'] for tag in json.loads(res.body)['tags']],
+            "The owner sees their private tags: " + res.body)
+
+        for url in ('/api/v1/admin/tags/related', '/api/v1/tags/related'):
+            res = self.testapp.get(
+                url,
+                params={'tags': u'python'},
+                status=200)
+            self.assertEqual(
+                [],
+                json.loads(res.body)['tags'],
+                "Anon users only see public tags: " + res.body)
+
     def test_bookmark_tag_complete_same_user_accounts_for_privacy(self):
         """Test that same user gets back tag completion from their
         private bookmarks"""
@@ -1043,6 +1164,27 @@ class BookieAPITest(unittest.TestCase):
         self.testapp.get(u'/api/v1/admin/stats/bmarkcount',
                          status=403)
 
+    def test_account_calls_skip_user_cache(self):
+        """Account calls don't trust a user another process has changed"""
+        self.testapp.get(
+            u'/api/v1/admin/ping?api_key=' + API_KEY, status=200)
+
+        # Another process resets the api key, our cache doesn't hear of it.
+        admin = DBSession.query(User).filter(User.username == u'admin')
+        admin.update({'api_key': u'changed'}, synchronize_session=False)
+        transaction.commit()
+        try:
+            # The extension's calls live with it until the cache expires.
+            self.testapp.get(
+                u'/api/v1/admin/ping?api_key=' + API_KEY, status=200)
+            self.testapp.get(
+                u'/api/v1/admin/account?api_key=' + API_KEY, status=403)
+            self.testapp.get(
+                u'/api/v1/a/users/list?api_key=' + API_KEY, status=403)
+        finally:
+            admin.update({'api_key': API_KEY}, synchronize_session=False)
+            transaction.commit()
+
     def test_account_information(self):
         """Test getting a user's account information"""
         res = self.testapp.get(u'/api/v1/admin/account?api_key=' + API_KEY,
@@ -1,4 +1,7 @@
 """Test the Auth model setup"""
+import transaction
+
+from mock import patch
 from unittest import TestCase
 from pyramid import testing
 
@@ -15,6 +18,7 @@ from bookie.models.auth import UserMgr
 from bookie.tests import empty_db
 from bookie.tests import gen_random_word
 from bookie.tests import TestDBBase
+from bookie.tests.factory import make_user
 
 
 class TestPassword(TestCase):
@@ -276,3 +280,54 @@ class TestAuthMgr(TestCase):
             user,
             None,
             "Should not find a non-existant user: " + str(user))
+
+
+class TestUserCache(TestDBBase):
+    """Users looked up for requests are cached until they change"""
+
+    def tearDown(self):
+        """Tear down each test"""
+        empty_db()
+
+    def test_cached_lookups(self):
+        """The user is found by id, username and api key from the cache"""
+        user = make_user()
+        user.api_key = User.gen_api_key()
+        username, api_key = user.username, user.api_key
+        transaction.commit()
+
+        transaction.begin()
+        user_id = UserMgr.get_cached(username=username).id
+        DBSession.expunge_all()
+
+        with patch.object(UserMgr, 'get') as get:
+            for user in (UserMgr.get_cached(user_id=user_id),
+                         UserMgr.get_cached(username=username),
+                         UserMgr.get_cached(api_key=api_key)):
+                self.assertEqual(username, user.username)
+                self.assertTrue(
+                    user in DBSession,
+                    "The cached user should be part of the session")
+            self.assertFalse(get.called, "The db shouldn't be asked")
+
+    def test_changes_uncached(self):
+        """Changing the user drops it from the cache once committed"""
+        user = make_user()
+        user.api_key = User.gen_api_key()
+        username, api_key = user.username, user.api_key
+        transaction.commit()
+
+        transaction.begin()
+        user = UserMgr.get_cached(api_key=api_key)
+        user.api_key = User.gen_api_key()
+        new_key = user.api_key
+        transaction.commit()
+
+        transaction.begin()
+        self.assertEqual(
+            None,
+            UserMgr.get_cached(api_key=api_key),
+            "The old api key should no longer find the user")
+        self.assertEqual(
+            new_key, UserMgr.get_cached(username=username).api_key)
+        transaction.commit()
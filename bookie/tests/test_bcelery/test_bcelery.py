@@ -6,6 +6,7 @@ import transaction
 from bookie.bcelery import tasks
 from bookie.models import Bmark
 from bookie.models import DBSession
+from bookie.models import Readable
 from bookie.models import Tag
 from bookie.models import stats
 from bookie.models.auth import User
@@ -147,3 +148,172 @@ class BCeleryTaskTest(TestDBBase):
             len(activations),
             'We should have a total of 2 activations: ' + str(len(activations))
         )
+
+    def test_fulltext_index_batch(self):
+        """Queued fulltext updates are coalesced and written in one batch"""
+        from bookie.models.fulltext import get_fulltext_handler
+        queue = tasks.FulltextQueue()
+        queue.pop(1000)
+
+        bmarks = Bmark.query.filter(Bmark.username == self.username).all()
+        bids = [b.bid for b in bmarks]
+        fresh = gen_random_word(12)
+        bmarks[0].readable = Readable()
+        bmarks[0].readable.clean_content = fresh
+        transaction.commit()
+
+        tasks.fulltext_index_bookmark(bids[0], gen_random_word(12))
+        tasks.fulltext_index_bookmarks(bids)
+
+        added, waiting = queue.push([])
+        self.assertEqual(
+            len(bids),
+            waiting,
+            'Each bookmark should be queued once: ' + str(waiting))
+
+        tasks.fulltext_index_batch()
+        self.assertEqual([], queue.pop(1000), 'The queue should be drained')
+
+        searcher = get_fulltext_handler(None)
+        for bid in bids:
+            self.assertTrue(
+                searcher.findByID(bid),
+                'Bookmark should be indexed: ' + str(bid))
+
+        found = searcher.search(fresh, content=True)
+        self.assertEqual(
+            [bids[0]],
+            [b.bid for b in found],
+            'The stored content should be indexed: ' + str(found))
+
+    @patch('bookie.bcelery.tasks.index_bookmarks')
+    def test_fulltext_index_batch_failure(self, mock_index):
+        """A batch that fails goes back on the queue to try again"""
+        queue = tasks.FulltextQueue()
+        queue.pop(1000)
+        bids = [b.bid for b in Bmark.query.all()]
+        queue.push(bids)
+
+        mock_index.side_effect = ValueError('The db went away')
+        retry = ValueError('retry')
+        with patch.object(
+                tasks.fulltext_index_batch, 'retry', return_value=retry):
+            self.assertRaises(ValueError, tasks.fulltext_index_batch)
+        self.assertEqual(
+            sorted(bids),
+            sorted(queue.pop(1000)),
+            'The bookmarks should be back on the queue')
+
+    def test_index_after_commit(self):
+        """A transaction sends its changed bookmarks to be indexed once"""
+        with patch.object(tasks.fulltext_index_bookmarks, 'delay') as delay:
+            transaction.begin()
+            bmarks = Bmark.query.filter(
+                Bmark.username == self.username).all()
+            bids = sorted(b.bid for b in bmarks)
+            for b in bmarks:
+                b.description = gen_random_word(10)
+            DBSession.flush()
+            bmarks[0].tags[u'again'] = Tag(u'again')
+            DBSession.flush()
+            self.assertFalse(delay.called, 'Nothing is sent before commit')
+            transaction.commit()
+            delay.assert_called_once_with(bids)
+
+            delay.reset_mock()
+            transaction.begin()
+            Bmark.query.get(bids[0]).description = gen_random_word(10)
+            DBSession.flush()
+            transaction.abort()
+            self.assertFalse(delay.called, 'An abort sends nothing')
+
+    def test_missing_fulltext_index(self):
+        """Gaps in the fulltext index are filled and deleted docs removed"""
+        from bookie.models.fulltext import get_fulltext_handler
+        from bookie.models.fulltext import get_writer
+        from bookie.models.fulltext import index_bookmarks
+        from bookie.models.fulltext import reconcile_index
+
+        bids = sorted(b.bid for b in Bmark.query.all())
+        deleted = bids[-1] + 1000
+        index_bookmarks(bids[1:])
+        writer = get_writer()
+        writer.add_document(bid=unicode(deleted), username=self.username)
+        writer.commit()
+
+        missing, stale = reconcile_index(chunk_size=2)
+        self.assertEqual(
+            [bids[0]],
+            missing,
+            'Only the unindexed bookmark is missing: ' + str(missing))
+        self.assertTrue(
+            deleted in stale,
+            'The deleted bookmark should be stale: ' + str(stale))
+
+        tasks.missing_fulltext_index(sync=True)
+        searcher = get_fulltext_handler(None)
+        for bid in bids:
+            self.assertTrue(
+                searcher.findByID(bid),
+                'Bookmark should be indexed: ' + str(bid))
+        self.assertEqual(
+            None,
+            searcher.findByID(deleted),
+            'The deleted bookmark should be gone from the index')
+        self.assertEqual(([], []), reconcile_index())
+
+    @patch('bookie.bcelery.tasks.FETCH_MAX_BATCHES', 1)
+    @patch('bookie.bcelery.tasks.FETCH_BATCH_SIZE', 2)
+    @patch('bookie.bcelery.tasks.ContentFetcher.fetch')
+    def test_fetch_unfetched_runs(self, mock_fetch):
+        """A run fetches a few batches and the next picks up from there"""
+        mock_fetch.side_effect = lambda urls: [None] * len(urls)
+        bids = sorted(bmark.bid for bmark in Bmark.query.all())
+        run = tasks.FetchRun()
+        run.save(None)
+
+        self.assertTrue(run.acquire())
+        tasks.fetch_unfetched_bmark_content()
+        self.assertEqual(
+            0,
+            mock_fetch.call_count,
+            'Nothing is fetched while another run is going')
+        run.release()
+
+        with patch.object(
+                tasks.fetch_unfetched_bmark_content, 'delay') as mock_delay:
+            tasks.fetch_unfetched_bmark_content()
+            self.assertEqual(1, mock_fetch.call_count)
+            self.assertEqual(bids[1], run.last_bid())
+            self.assertTrue(
+                mock_delay.called, 'The rest is left for another task')
+
+            mock_delay.reset_mock()
+            tasks.fetch_unfetched_bmark_content()
+            self.assertEqual(2, mock_fetch.call_count)
+            self.assertEqual(0, run.last_bid())
+            self.assertFalse(mock_delay.called, 'Everything was fetched')
+
+    def test_fetch_shared_content(self):
+        """A url we've fetched for one user is shared with the next"""
+        first, second = Bmark.query.filter(
+            Bmark.hash_id == Bmark.query.filter(
+                Bmark.username == self.new_username).one().hash_id).\
+            order_by(Bmark.bid).all()
+        first.readable = Readable()
+        first.readable.content = u'<p>Already fetched</p>'
+        first.readable.content_type = u'text/html'
+        first.readable.status_code = 200
+        first.readable.etag = u'"v1"'
+        second_bid = second.bid
+        transaction.commit()
+
+        tasks.fetch_bmark_content(second_bid)
+
+        readable = Bmark.query.get(second_bid).readable
+        self.assertEqual(
+            u'<p>Already fetched</p>',
+            readable.content,
+            'The page should be shared: ' + str(readable.content))
+        self.assertEqual(200, readable.status_code)
+        self.assertEqual(u'"v1"', readable.etag)
@@ -1,5 +1,5 @@
 """Test the basics including the bmark and tags"""
-
+from datetime import datetime
 
 from bookie.models import (
     DBSession,
@@ -81,3 +81,24 @@ class TestBmark(TestDBBase):
         username = None
         res = b.has_access(username)
         self.assertEqual(False, res)
+
+    def test_todict(self):
+        """A bookmark turns into a dict of its columns for json"""
+        b = Bmark(
+            url=u'http://bookie.io/',
+            username=u'admin',
+            desc=u'Bookie',
+        )
+        b.stored = datetime(2014, 8, 2, 9, 5, 1, 500)
+        DBSession.add(b)
+        DBSession.flush()
+        # Expired columns are loaded back up for the dict.
+        DBSession.expire(b, ['description'])
+
+        bmark = dict(b)
+        self.assertEqual(
+            set(col.name for col in Bmark.__table__.columns),
+            set(bmark))
+        self.assertEqual(u'Bookie', bmark['description'])
+        self.assertEqual('2014-08-02 09:05:01', bmark['stored'])
+        self.assertEqual('', bmark['updated'])
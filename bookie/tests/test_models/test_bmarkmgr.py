@@ -1,11 +1,18 @@
 """Test the basics including the bmark and tags"""
 
+from datetime import datetime
+from datetime import timedelta
+from mock import patch
 from random import randint
 
 from bookie.models import (
     Bmark,
     BmarkMgr,
+    BmarkTools,
     DBSession,
+    HashedMgr,
+    Readable,
+    ReadableMgr,
     TagMgr,
 )
 from bookie.models.auth import User
@@ -372,3 +379,167 @@ class TestBmarkMgrStats(TestDBBase):
             'There should be ' + str(bookmark_count_public) +
             ' bookmarks present: ' + str(len(res))
         )
+
+    def test_find_bookmarks_cursor(self):
+        """Paging with a cursor walks every bookmark exactly once"""
+        bookmark_count = 7
+        user = User()
+        user.username = gen_random_word(19)
+        DBSession.add(user)
+
+        stored = datetime(2014, 1, 1)
+        for i in range(bookmark_count):
+            b = Bmark(
+                url=gen_random_word(12),
+                username=user.username,
+                tags=u'cursor',
+            )
+            # Give a few of them the same stored time to check the tie break.
+            b.stored = stored - timedelta(days=i // 2)
+            DBSession.add(b)
+
+        DBSession.flush()
+        first = BmarkMgr.find(limit=3, username=user.username,
+                              requested_by=user.username)
+
+        seen = [b.bid for b in first]
+        cursor = BmarkTools.encode_cursor(first[-1])
+        while cursor:
+            res = BmarkMgr.find(limit=3, username=user.username,
+                                requested_by=user.username, cursor=cursor)
+            seen.extend([b.bid for b in res])
+            cursor = BmarkTools.encode_cursor(res[-1]) if res else None
+
+        self.assertEqual(bookmark_count, len(seen))
+        self.assertEqual(bookmark_count, len(set(seen)))
+
+        # The tag filtered query seeks the same way.
+        paged = BmarkMgr.find(limit=4, username=user.username,
+                              requested_by=user.username, tags=[u'cursor'],
+                              cursor=BmarkTools.encode_cursor(first[-1]))
+        self.assertEqual(
+            [b.bid for b in paged],
+            seen[3:7],
+            'The tag query should pick up after the cursor')
+
+    def test_find_bookmarks_bad_cursor(self):
+        """A cursor we didn't generate is a ValueError"""
+        self.assertRaises(ValueError, BmarkMgr.find, cursor=u'not a cursor')
+
+    def test_bulk_store(self):
+        """bulk_store writes the hashes, bookmarks and tags in one go"""
+        user = User()
+        user.username = gen_random_word(10)
+        DBSession.add(user)
+
+        # An existing url_hash should be reused, not inserted again.
+        other = Bmark(url=u'http://bookie.io/', username=u'admin')
+        DBSession.add(other)
+        DBSession.flush()
+
+        stored = datetime(2014, 1, 1)
+        rows = [
+            (u'http://bookie.io/', u'bookie', u'', u'Python web python',
+             stored, False),
+            (u'http://pypi.python.org/', u'pypi', u'ext', u'python',
+             None, True),
+        ]
+        bids = BmarkMgr.bulk_store(rows, user.username, inserted_by=u'test')
+        self.assertEqual(2, len(bids), 'We should get a bid per row')
+
+        first = Bmark.query.get(bids[0])
+        self.assertEqual(other.hash_id, first.hash_id)
+        self.assertEqual(stored, first.stored)
+        self.assertEqual(u'test', first.inserted_by)
+        self.assertEqual(
+            set([u'python', u'web']),
+            set(first.tags),
+            'Tags should be lowercased and deduped: ' + str(first.tags.keys()))
+        self.assertEqual(u'python web', first.tag_str)
+
+        second = Bmark.query.get(bids[1])
+        self.assertEqual(u'http://pypi.python.org/', second.hashed.url)
+        self.assertTrue(second.is_private, 'Privacy should be kept')
+        self.assertTrue(second.stored, 'Missing dates should default to now')
+        self.assertEqual(
+            first.tags[u'python'].tid,
+            second.tags[u'python'].tid,
+            'Both bookmarks should share the python tag')
+
+    def test_get_by_url(self):
+        """Urls are found by their hash, the url guards against collisions"""
+        url = u'http://bookie.io/'
+        bmark = Bmark(url=url, username=u'admin')
+        DBSession.add(bmark)
+        DBSession.flush()
+
+        self.assertEqual(bmark.hashed, HashedMgr.get_by_url(url))
+        self.assertEqual(bmark, BmarkMgr.get_by_url(url, username=u'admin'))
+        self.assertFalse(HashedMgr.get_by_url(u'http://pypi.python.org/'))
+
+        # Another url that happens to hash the same isn't a match.
+        with patch.object(HashedMgr, 'hash_url') as hash_url:
+            hash_url.return_value = bmark.hash_id
+            other = u'http://collides.com/'
+            self.assertFalse(HashedMgr.get_by_url(other))
+            self.assertEqual(None, BmarkMgr.get_by_url(other))
+
+    def test_user_dump(self):
+        """The dump pages through the bookmarks newest first"""
+        user = User()
+        user.username = gen_random_word(10)
+        DBSession.add(user)
+
+        for day in range(5):
+            bmark = Bmark(
+                url=u'http://bookie.io/{0}'.format(day),
+                username=user.username,
+                tags=u'python',
+                is_private=day == 2,
+            )
+            bmark.stored = datetime(2014, 1, day + 1)
+            DBSession.add(bmark)
+        DBSession.flush()
+
+        dump = BmarkMgr.user_dump(
+            user.username, user.username, chunk_size=2)
+        self.assertEqual(
+            [4, 3, 2, 1, 0],
+            [b.stored.day - 1 for b in dump],
+            "All of the bookmarks should come out newest first")
+
+        dump = list(BmarkMgr.user_dump(
+            user.username, u'admin', chunk_size=2))
+        self.assertEqual(
+            [4, 3, 1, 0],
+            [b.stored.day - 1 for b in dump],
+            "Other users only get the public bookmarks")
+        self.assertEqual([u'python'], dump[0].tags.keys())
+
+    def test_fetched_by_hash(self):
+        """Each url gets the newest page fetched for any of its bookmarks"""
+        url = u'http://bookie.io/shared'
+        for day, (username, status) in enumerate(
+                [(u'admin', 200), (u'first', 200), (u'second', 200),
+                 (u'third', 404)]):
+            bmark = Bmark(url=url, username=username)
+            bmark.readable = Readable()
+            bmark.readable.content = username
+            bmark.readable.status_code = status
+            bmark.readable.imported = datetime(2014, 1, day + 1)
+            DBSession.add(bmark)
+            DBSession.flush()
+        other = Bmark(url=u'http://bookie.io/other', username=u'admin')
+        DBSession.add(other)
+        DBSession.flush()
+
+        found = ReadableMgr.fetched_by_hash(
+            [HashedMgr.hash_url(url), other.hash_id])
+        self.assertEqual(
+            [HashedMgr.hash_url(url)],
+            found.keys(),
+            "Only the url with a page is found: " + str(found))
+        self.assertEqual(
+            u'second',
+            found.values()[0].content,
+            "The newest page that was read is shared")
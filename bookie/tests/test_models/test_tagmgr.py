@@ -1,17 +1,27 @@
 """Test the basics including the bmark and tags"""
+import transaction
+
+from mock import patch
 
 from bookie.models import (
+    Bmark,
     DBSession,
+    BmarkMgr,
+    Readable,
     Tag,
     TagMgr,
+    UserTagMgr,
 )
+from bookie.models import tagindex
 from bookie.models.auth import User
 
+from bookie.tests import empty_db
 from bookie.tests import gen_random_word
 from bookie.tests import TestDBBase
 from bookie.tests.factory import (
     make_tag,
     make_bookmark,
+    random_url,
 )
 
 
@@ -60,7 +70,7 @@ class TestTagMgrStats(TestDBBase):
         suggestions = TagMgr.complete(test_str, username=user.username,
                                       requested_by=user.username)
         self.assertTrue(
-            tags[0] in suggestions,
+            tags[0].name in suggestions,
             "The sample tag was found in the completion set")
 
     def test_basic_complete_same_user_accounts_for_privacy(self):
@@ -94,7 +104,7 @@ class TestTagMgrStats(TestDBBase):
         suggestions = TagMgr.complete(test_str, username=user.username,
                                       requested_by=user.username)
         self.assertTrue(
-            tags[0] in suggestions,
+            tags[0].name in suggestions,
             "The sample tag was found in the completion set")
 
     def test_basic_complete_diff_user(self):
@@ -129,13 +139,13 @@ class TestTagMgrStats(TestDBBase):
         suggestions = TagMgr.complete(test_str, username=user.username,
                                       requested_by=gen_random_word(10))
         self.assertTrue(
-            tags[0] in suggestions,
+            tags[0].name in suggestions,
             "The sample tag was found in the completion set")
 
         # Also check when username is None.
         suggestions = TagMgr.complete(test_str, username=None)
         self.assertTrue(
-            tags[0] in suggestions,
+            tags[0].name in suggestions,
             "The sample tag was found in the completion set")
 
     def test_basic_complete_diff_user_accounts_for_privacy(self):
@@ -169,13 +179,13 @@ class TestTagMgrStats(TestDBBase):
         suggestions = TagMgr.complete(test_str, username=user.username,
                                       requested_by=gen_random_word(10))
         self.assertTrue(
-            tags[0] not in suggestions,
+            tags[0].name not in suggestions,
             "The sample tag was not found in the completion set")
 
         # Also check when username is None.
         suggestions = TagMgr.complete(test_str, username=None)
         self.assertTrue(
-            tags[0] not in suggestions,
+            tags[0].name not in suggestions,
             "The sample tag was not found in the completion set")
 
     def test_case_insensitive(self):
@@ -209,5 +219,231 @@ class TestTagMgrStats(TestDBBase):
         suggestions = TagMgr.complete(test_str, username=user.username,
                                       requested_by=user.username)
         self.assertTrue(
-            tags[0] in suggestions,
+            tags[0].name in suggestions,
             "The sample tag was found in the completion set")
+
+    def test_resolve_creates_missing(self):
+        """Resolve should load existing tags and insert the missing ones."""
+        existing = make_tag(u'existing')
+        DBSession.add(existing)
+        DBSession.flush()
+
+        tag_map = TagMgr.resolve([u'Existing', u'brand', u'new', u''])
+        self.assertEqual(
+            set([u'existing', u'brand', u'new']),
+            set(tag_map.keys()),
+            "We should get back a tag for each name: " + str(tag_map.keys()))
+        self.assertEqual(existing.tid, tag_map[u'existing'].tid)
+        self.assertEqual(3, TagMgr.count())
+
+
+class TestTagIndex(TestDBBase):
+    """Tags are completed from an index kept in memory"""
+
+    def tearDown(self):
+        """clear out all the testing DB data"""
+        empty_db()
+
+    def test_complete_most_used(self):
+        """The most used tags come first"""
+        for tags in [u'python pylons', u'python pyramid', u'pyramid python',
+                     u'pytest']:
+            DBSession.add(Bmark(random_url(), username=u'admin', tags=tags))
+        transaction.commit()
+
+        suggestions = TagMgr.complete(
+            u'py', limit=3, username=u'admin', requested_by=u'admin')
+        self.assertEqual(
+            [u'python', u'pyramid', u'pylons'],
+            suggestions,
+            "The tags should be ranked by use: " + str(suggestions))
+
+    def test_index_kept_up_to_date(self):
+        """Committed changes are applied to the index we already have"""
+        public = tagindex.get_index()
+        self.assertEqual([], TagMgr.complete(u'ru'))
+
+        DBSession.add(Bmark(
+            random_url(), username=u'admin', tags=u'ruby', is_private=True))
+        transaction.commit()
+        self.assertEqual(
+            [u'ruby'],
+            TagMgr.complete(u'ru', username=u'admin', requested_by=u'admin'))
+        self.assertEqual([], TagMgr.complete(u'ru'))
+
+        bmark = Bmark.query.one()
+        bmark.is_private = False
+        transaction.commit()
+        self.assertEqual([u'ruby'], TagMgr.complete(u'ru'))
+        self.assertTrue(
+            public is tagindex.get_index(),
+            "The index should be updated, not rebuilt")
+
+        bmark = Bmark.query.one()
+        bmark.tags[u'rust'] = Tag(u'rust')
+        DBSession.flush()
+        transaction.abort()
+        self.assertEqual([u'ruby'], TagMgr.complete(u'ru'))
+
+        DBSession.delete(Bmark.query.one())
+        transaction.commit()
+        self.assertEqual([], TagMgr.complete(u'ru'))
+        self.assertEqual(
+            [],
+            TagMgr.complete(u'ru', username=u'admin', requested_by=u'admin'))
+
+    def test_expired_index_reloaded(self):
+        """An expired index keeps answering while it's reloaded"""
+        DBSession.add(Bmark(random_url(), username=u'admin', tags=u'ruby'))
+        transaction.commit()
+        stale = tagindex.get_index()
+        # Another process took rust off its bookmark.
+        stale.update(u'rust', 1)
+        stale.built -= tagindex.INDEX_TTL + 1
+
+        self.assertTrue(
+            stale is tagindex.get_index(),
+            "The stale index answers until the new one is loaded")
+        refresher = stale.refresher
+        if refresher is not None:
+            refresher.join()
+
+        self.assertFalse(stale is tagindex.get_index())
+        self.assertEqual(
+            [u'ruby'],
+            TagMgr.complete(u'ru'),
+            "The reloaded index has what's in the db")
+
+    def test_reload_keeps_changes(self):
+        """Changes committed during a reload are kept on the new index"""
+        stale = tagindex.get_index()
+        stale.missed = []
+        DBSession.add(Bmark(random_url(), username=u'admin', tags=u'rust'))
+        transaction.commit()
+
+        # The reload didn't see the bookmark committed while it ran.
+        with patch.object(
+                tagindex, '_load_counts', return_value=[(u'ruby', 1)]):
+            tagindex._refresh((None, False), stale)
+        self.assertEqual([u'ruby', u'rust'], TagMgr.complete(u'ru'))
+
+    def test_related(self):
+        """Tags used on the same bookmarks are related, drilling down"""
+        for tags in [u'python pyramid', u'python pyramid web', u'python web',
+                     u'ruby web']:
+            DBSession.add(Bmark(random_url(), username=u'admin', tags=tags))
+        transaction.commit()
+
+        related = TagMgr.related(
+            [u'python'], username=u'admin', requested_by=u'admin')
+        self.assertEqual(
+            [(u'pyramid', 2), (u'web', 2)],
+            related,
+            "The tags used with python: " + str(related))
+        self.assertEqual(
+            [u'python', u'pyramid'],
+            TagMgr.complete(u'py', current=[u'web']),
+            "Only the tags used with web are completed")
+
+        DBSession.add(Bmark(
+            random_url(), username=u'admin', tags=u'pytest web'))
+        transaction.commit()
+        self.assertEqual(
+            [u'python', u'pyramid', u'pytest'],
+            TagMgr.complete(u'py', current=[u'web']),
+            "The new bookmark is added to the pairs")
+        self.assertEqual(
+            [(u'python', 4), (u'pytest', 1), (u'ruby', 1)],
+            TagMgr.related([u'web', u'pyramid'], username=u'admin',
+                           requested_by=u'admin'))
+
+
+class TestUserTags(TestDBBase):
+    """The tag counts of each user are kept as bookmarks change"""
+
+    def _counts(self, public=False):
+        return dict(
+            (ut.name, ut.count if not public else ut.public_count)
+            for ut in UserTagMgr.find(u'admin', public=public))
+
+    def test_counts_follow_bookmarks(self):
+        """Adding, editing and deleting bookmarks updates the counts"""
+        first = Bmark(random_url(), username=u'admin', tags=u'python web')
+        DBSession.add(first)
+        DBSession.flush()
+        second = Bmark(random_url(), username=u'admin', tags=u'python',
+                       is_private=True)
+        DBSession.add(second)
+        DBSession.flush()
+        self.assertEqual({u'python': 2, u'web': 1}, self._counts())
+        self.assertEqual(
+            {u'python': 1, u'web': 1}, self._counts(public=True))
+
+        second.is_private = False
+        del first.tags[u'web']
+        first.tags[u'pyramid'] = Tag(u'pyramid')
+        DBSession.flush()
+        self.assertEqual({u'python': 2, u'pyramid': 1}, self._counts())
+        self.assertEqual(
+            {u'python': 2, u'pyramid': 1}, self._counts(public=True))
+
+        DBSession.delete(first)
+        DBSession.flush()
+        self.assertEqual({u'python': 1}, self._counts())
+        self.assertEqual(1, UserTagMgr.count(u'admin'))
+
+    def test_bulk_store_counts(self):
+        """Bookmarks stored in bulk are counted too"""
+        DBSession.add(Bmark(random_url(), username=u'admin', tags=u'python'))
+        DBSession.flush()
+        BmarkMgr.bulk_store([
+            (random_url(), u'one', u'', u'python web', None, False),
+            (random_url(), u'two', u'', u'web', None, True),
+        ], u'admin')
+        self.assertEqual({u'python': 2, u'web': 2}, self._counts())
+        self.assertEqual(
+            {u'python': 2, u'web': 1}, self._counts(public=True))
+
+        cloud = UserTagMgr.cloud(username=u'admin', public=False)
+        self.assertEqual(
+            [(u'python', 2), (u'web', 2)],
+            [(name, count) for name, count, last_used in cloud])
+        self.assertEqual(
+            [u'python', u'web'],
+            [name for name, count, last_used in
+             UserTagMgr.cloud(limit=1, page=0) +
+             UserTagMgr.cloud(limit=1, page=1)],
+            "The cloud should page by the most used")
+
+        BmarkMgr.delete_all_bookmarks(u'admin')
+        self.assertEqual({}, self._counts())
+
+
+class TestTagSuggestions(TestDBBase):
+    """Tags are suggested from the content of the bookmarked page"""
+
+    def test_suggestions_stored(self):
+        """The content is only worked through once"""
+        bmark = Bmark(random_url(), username=u'admin', tags=u'network')
+        bmark.readable = Readable(
+            content=u'<p>The network simulator is new.</p>',
+            clean_content=(
+                u'The network simulator is new. The network simulator runs '
+                u'NS 2014 tests. Network users like the simulator.'))
+        DBSession.add(bmark)
+        DBSession.flush()
+
+        url = bmark.hashed.url
+        self.assertEqual(
+            [u'simulator', u'users', u'tests'],
+            TagMgr.suggestions(url=url),
+            "The tags it has already aren't suggested")
+        self.assertEqual(
+            u'network simulator users tests',
+            bmark.readable.tag_suggestions)
+
+        with patch('bookie.models.suggest_content_tags') as suggest:
+            self.assertEqual(
+                [u'simulator', u'users', u'tests'],
+                TagMgr.suggestions(url=url))
+            self.assertFalse(suggest.called)
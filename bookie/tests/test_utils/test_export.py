@@ -2,9 +2,12 @@
 import json
 import logging
 import random
+import zlib
 
 import urllib
 
+from webob import Request
+
 from bookie.tests import TestViewBase
 
 
@@ -176,3 +179,43 @@ class TestExport(TestViewBase):
             sorted_bmarks,
             msg="Bookmarks should be sorted in descending order"
         )
+
+    def test_export_gzip(self):
+        """The export is gzipped for clients that accept it"""
+        self._get_good_request()
+
+        # webtest would gunzip the body for us, go straight to the app.
+        req = Request.blank(
+            '/api/v1/admin/bmarks/export?api_key={0}'.format(self.api_key),
+            headers={'Accept-Encoding': 'gzip, deflate'})
+        res = req.get_response(self.app.app)
+
+        self.assertEqual(200, res.status_int)
+        self.assertEqual('gzip', res.content_encoding)
+        data = json.loads(zlib.decompress(res.body, 16 + zlib.MAX_WBITS))
+        self.assertEqual(
+            1,
+            data['count'],
+            "Should be one result: " + str(data['count']))
+        self.assertEqual(
+            u'http://google.com',
+            data['bmarks'][0]['hashed']['url'])
+
+    def test_export_view_netscape(self):
+        """The html export is a Netscape bookmarks file"""
+        self._get_good_request()
+        self._get_good_request_wo_tags()
+
+        self._login_admin()
+        res = self.app.get('/admin/export?api_key=' + self.api_key, status=200)
+
+        self.assertEqual('text/html', res.content_type)
+        self.assertIn('bookie_export.html', res.headers['Content-Disposition'])
+        self.assertTrue(
+            res.body.startswith('<!DOCTYPE NETSCAPE-Bookmark-file-1>'),
+            "Should be a Netscape bookmarks file: " + res.body)
+        self.assertIn('TAGS="python,search"', res.body)
+        self.assertIn('>This is my google desc</A>', res.body)
+        self.assertIn(
+            '<DD>And some extended notes about it in full form', res.body)
+        self.assertTrue(res.body.endswith('</DL><p>\n'))
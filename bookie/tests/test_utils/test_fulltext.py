@@ -1,14 +1,23 @@
 """Test the fulltext implementation"""
 import json
+import os
+import shutil
+import tempfile
+import threading
 import transaction
 
+from glob import glob
+
 from pyramid import testing
 from unittest import TestCase
 
+from bookie.models import BmarkMgr
 from bookie.models import DBSession
+from bookie.models import fulltext
 from bookie.models.fulltext import WhooshFulltext
 from bookie.models.fulltext import get_fulltext_handler
 from bookie.tests import empty_db
+from bookie.tests import factory
 
 API_KEY = None
 
@@ -126,6 +135,162 @@ class TestFulltext(TestCase):
             'icon' in search_res.body,
             "We should find the new tag icon on the page: " + search_res.body)
 
+    def test_rebuild_index(self):
+        """A rebuild is built to the side and swapped in when complete"""
+        self._get_good_request()
+
+        live = fulltext.INDEX_NAME
+        tmp = tempfile.mkdtemp()
+        index_path = os.path.join(tmp, 'idx')
+        try:
+            fulltext.set_index('whoosh', index_path)
+            handler = get_fulltext_handler("")
+            self.assertEqual(0, handler.doc_count())
+
+            progress = []
+            fulltext.rebuild_index(
+                chunk_size=1,
+                progress=lambda done, total: progress.append((done, total)))
+
+            self.assertTrue(
+                os.path.islink(index_path),
+                "The index should now point at the new build")
+            self.assertEqual(1, handler.doc_count())
+            self.assertEqual((1, 1), progress[-1])
+
+            # We keep the build we replaced around, but no more than that.
+            fulltext.rebuild_index()
+            fulltext.rebuild_index()
+            builds = glob(index_path + '.build-*')
+            self.assertEqual(
+                2,
+                len(builds),
+                "We should have the live and last build: " + str(builds))
+            self.assertEqual(1, handler.doc_count())
+        finally:
+            fulltext.set_index('whoosh', live)
+            shutil.rmtree(tmp)
+
+    def test_searcher_reused(self):
+        """The searcher is kept per thread and refreshed on index changes"""
+        self._get_good_request()
+        searcher = fulltext.get_searcher()
+        self.assertTrue(
+            searcher is fulltext.get_searcher(),
+            "An unchanged index should reuse the searcher")
+
+        fulltext.index_bookmarks(fulltext.indexed_bids())
+        refreshed = fulltext.get_searcher()
+        self.assertFalse(
+            searcher is refreshed,
+            "A new index generation should refresh the searcher")
+        self.assertTrue(refreshed.up_to_date())
+
+        other = []
+        thread = threading.Thread(
+            target=lambda: other.append(fulltext.get_searcher()))
+        thread.start()
+        thread.join()
+        self.assertFalse(
+            refreshed is other[0],
+            "Each thread should get its own searcher")
+
+    def test_search_order(self):
+        """Results come back in score order, or from the stored fields"""
+        weak = factory.make_bookmark()
+        weak.description = u"pony"
+        strong = factory.make_bookmark()
+        strong.description = u"pony"
+        strong.extended = u"pony pony"
+        bids = [weak.bid, strong.bid]
+        url = strong.hashed.url
+        transaction.commit()
+        fulltext.index_bookmarks(bids)
+
+        handler = get_fulltext_handler("")
+        res = handler.search(u"pony", with_readable=True)
+        self.assertEqual(
+            bids[::-1],
+            [b.bid for b in res],
+            "The best match should be first: " + str(res))
+        self.assertTrue(
+            'bookmarks' in res[0].tags,
+            "The tags should be loaded: " + str(res[0].tags))
+
+        res = handler.search(u"pony", stored=True)
+        self.assertEqual(
+            [unicode(bid) for bid in bids[::-1]],
+            [doc['bid'] for doc in res])
+        self.assertEqual(url, res[0]['url'])
+        self.assertEqual(u"pony", res[0]['description'])
+        self.assertEqual(u"admin", res[0]['username'])
+
+    def test_database_engine(self):
+        """The database engine indexes bookmarks as they're written"""
+        live = fulltext.INDEX_NAME
+        fulltext.set_index('database', None)
+        try:
+            handler = get_fulltext_handler("")
+            self.assertTrue(
+                isinstance(handler, fulltext.DatabaseFulltext),
+                "Should get the database fulltext: " + str(handler))
+
+            bmark = factory.make_bookmark()
+            bmark.description = u"pony"
+            other = factory.make_bookmark()
+            other.description = u"unicorn"
+            other.extended = u"pony pony"
+            private = factory.make_bookmark(is_private=True)
+            private.description = u"pony"
+            bids = [other.bid, bmark.bid]
+            private_bid = private.bid
+            transaction.commit()
+
+            self.assertEqual(3, handler.doc_count())
+            res = handler.search(u"ponies")
+            self.assertEqual(
+                bids,
+                [b.bid for b in res],
+                "The best public match should be first: " + str(res))
+            res = handler.search(
+                u"pony", username=u"admin", requested_by=u"admin")
+            self.assertTrue(
+                private_bid in [b.bid for b in res],
+                "We should find our private bookmark: " + str(res))
+            self.assertEqual(
+                u"pony",
+                handler.search(u"pony", stored=True)[-1]['description'])
+            self.assertEqual([], handler.search(u"pony", page=1))
+
+            bmark = DBSession.merge(bmark)
+            bmark.description = u"horse"
+            DBSession.delete(DBSession.merge(other))
+            transaction.commit()
+            self.assertEqual(
+                [], handler.search(u"pony"), "The edits should be indexed")
+            self.assertEqual(None, handler.findByID(bids[0]))
+            self.assertEqual(
+                unicode(bids[1]), handler.findByID(bids[1])['bid'])
+
+            DBSession.execute('DELETE FROM bmarks_fts')
+            fulltext.rebuild_index()
+            self.assertEqual(2, handler.doc_count())
+            self.assertEqual(([], []), fulltext.reconcile_index())
+            transaction.commit()
+
+            BmarkMgr.delete_all_bookmarks(u'admin')
+            transaction.commit()
+            self.assertEqual(
+                0,
+                handler.doc_count(),
+                "Bulk deletes should be removed from the index")
+            self.assertEqual([], handler.indexed_bids())
+        finally:
+            transaction.abort()
+            DBSession.execute('DELETE FROM bmarks_fts')
+            transaction.commit()
+            fulltext.set_index('whoosh', live)
+
     def test_ajax_search(self):
         """Verify that we can get a json MorJSON response when ajax search"""
         # first let's add a bookmark we can search on
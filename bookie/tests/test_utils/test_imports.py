@@ -13,6 +13,7 @@ from bookie.models.queue import ImportQueue
 from bookie.models.queue import ImportQueueMgr
 from bookie.lib.urlhash import generate_hash
 
+from bookie.lib import importer
 from bookie.lib.importer import Importer
 from bookie.lib.importer import DelImporter
 from bookie.lib.importer import DelXMLImporter
@@ -302,6 +303,30 @@ class ImportDeliciousTest(TestImports):
         # now let's do some db sanity checks
         self._delicious_data_test()
 
+    def test_import_unclosed_links(self):
+        """A long run of unclosed <DT> links all get imported"""
+        links = [
+            u'<DT><A HREF="http://bookie.io/{0}" ADD_DATE="1298664780" '
+            u'TAGS="bulk">Link &amp; {0}</A>'.format(i)
+            for i in range(300)
+        ]
+        del_file = StringIO.StringIO(
+            u'<!DOCTYPE NETSCAPE-Bookmark-file-1>\n<DL><p>\n' +
+            u'\n'.join(links) + u'\n</DL><p>')
+        imp = Importer(del_file, username=u"admin")
+        imp.process()
+
+        res = Bmark.query.all()
+        self.assertEqual(
+            len(res),
+            300,
+            "We should have 300 results, we got: " + str(len(res)))
+        self.assertEqual(
+            u'Link & 7',
+            Bmark.query.filter(
+                Bmark.hash_id == generate_hash('http://bookie.io/7')).one().
+            description)
+
     def test_dupe_imports(self):
         """If we import twice, we shouldn't end up with duplicate bmarks"""
         good_file = self._get_del_file()
@@ -349,6 +374,17 @@ class ImportDeliciousXMLTest(TestImports):
 
         bad_file.close()
 
+    def test_comment_and_doctype(self):
+        """Comments and a doctype can come before the posts"""
+        good_file = StringIO.StringIO(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<!-- generated by delicious\n  on some day -->\n'
+            '<!DOCTYPE posts [\n<!ELEMENT posts (post*)>\n]>\n'
+            '<posts user="admin"></posts>')
+        self.assertTrue(
+            DelXMLImporter.can_handle(good_file),
+            "DelXMLImporter should handle this file")
+
     def test_import_process(self):
         """Verify importer inserts the correct records"""
         good_file = self._get_del_file()
@@ -410,6 +446,22 @@ class ImportGoogleTest(TestImports):
         # now let's do some db sanity checks
         self._google_data_test()
 
+    def test_heading_past_the_start(self):
+        """A heading anywhere in the file makes it a google file"""
+        links = ''.join(
+            '<DT><A HREF="http://bookie.io/{0}">Bookie {0}</A>\n'.format(i)
+            for i in range(1000))
+        html = ('<!DOCTYPE NETSCAPE-Bookmark-file-1>\n<DL><p>\n' + links +
+                '<DT><H3>python</H3>\n<DL><p>\n' + links + '</DL><p>\n')
+        good_file = StringIO.StringIO(html)
+
+        self.assertTrue(
+            GBookmarkImporter.can_handle(good_file),
+            "GBookmarkImporter should handle this file")
+        self.assertTrue(
+            not DelImporter.can_handle(good_file),
+            "DelImporter cannot handle this file")
+
     def test_bookmarklet_file(self):
         """Verify we can import a file with a bookmarklet in it."""
         loc = os.path.dirname(__file__)
@@ -512,6 +564,26 @@ class ImportFirefoxTest(TestImports):
         # now let's do some db sanity checks
         self._firefox_data_test()
 
+    def test_read_in_chunks(self):
+        """The json is parsed the same no matter where the reads split it"""
+        good_file = self._get_file()
+        expected = [
+            child['id'] for child, parents in
+            importer._iter_json_children(good_file)]
+
+        read_size = importer.READ_SIZE
+        importer.READ_SIZE = 7
+        try:
+            good_file.seek(0)
+            found = [
+                child['id'] for child, parents in
+                importer._iter_json_children(good_file)]
+        finally:
+            importer.READ_SIZE = read_size
+
+        self.assertTrue(expected, 'We should find some children')
+        self.assertEqual(expected, found)
+
     def test_nested_folder(self):
         """Verify if bookmarks in nested folders are imported"""
         good_file = self._get_file()
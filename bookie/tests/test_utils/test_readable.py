@@ -1,12 +1,20 @@
 """Test the fulltext implementation"""
 import logging
 import os
+import socket
+import threading
+import time
 import transaction
 import urllib
 
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
 from pyramid import testing
+from SocketServer import ThreadingMixIn
 from unittest import TestCase
 
+from bookie.lib.readable import clean_text
+from bookie.lib.readable import ContentFetcher
 from bookie.lib.readable import ReadContent
 from bookie.lib.readable import ReadUrl
 
@@ -62,6 +70,20 @@ class TestReadable(TestCase):
         self.assertTrue(
             'Bookie' in read.content,
             u"The word Bookie is in the content: " + unicode(read.content))
+        self.assertTrue(
+            'Bookie' in read.clean_content,
+            u"The clean content has the text: " + read.clean_content)
+        self.assertTrue(
+            '<' not in read.clean_content,
+            u"The clean content has no html: " + read.clean_content)
+
+    def test_clean_text(self):
+        """Only the text people read ends up in the clean content"""
+        html = (u'<div><!-- note --><p>Caf\xe9 <b>time</b></p>'
+                u'<script>var x;</script>open<style>p {}</style></div>')
+        self.assertEqual(u'Caf\xe9  time open', clean_text(html))
+        self.assertEqual(u'', clean_text(u''))
+        self.assertEqual(u'', clean_text(u'  '))
 
     def test_non_net_url(self):
         """I might be bookmarking something internal bookie can't access"""
@@ -191,3 +213,190 @@ class TestReadableFulltext(TestCase):
         self.assertTrue(
             'username' in schema,
             "We should find username in schema: " + str(schema))
+
+
+class FetchHandler(BaseHTTPRequestHandler):
+    """Serve test pages, keeping track of how busy the server gets"""
+    protocol_version = 'HTTP/1.1'
+    page = ('<html><head><title>Bookie</title></head><body><div><p>'
+            'Bookie is a bookmark manager. ' * 20 + '</p></div></body></html>')
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.active += 1
+            server.most_active = max(server.most_active, server.active)
+            server.clients.add(self.client_address)
+        try:
+            if self.path.startswith('/slow'):
+                time.sleep(2)
+            else:
+                time.sleep(0.1)
+
+            etag = None
+            content_type = 'text/html; charset=utf-8'
+            if self.path.startswith('/missing'):
+                self.send_response(404)
+                body = 'missing'
+            elif self.path.startswith('/etag'):
+                etag = '"v1"'
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    body = ''
+                else:
+                    self.send_response(200)
+                    body = self.page
+            elif self.path.startswith('/big'):
+                self.send_response(200)
+                body = self.page * 100
+            elif self.path.startswith('/pdf'):
+                # Claims to be html but it's really a pdf.
+                self.send_response(200)
+                body = '%PDF-1.4\n' + 'x' * 100000
+            elif self.path.startswith('/gzip'):
+                # Says it's gzipped but it isn't.
+                self.send_response(200)
+                self.send_header('Content-Encoding', 'gzip')
+                body = self.page
+            elif self.path.startswith('/vague'):
+                self.send_response(200)
+                content_type = 'application/octet-stream'
+                body = self.page
+            else:
+                self.send_response(200)
+                body = self.page
+            if etag:
+                self.send_header('ETag', etag)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except socket.error:
+            pass
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+class FetchServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TestContentFetcher(TestCase):
+    """Fetch many urls at once against a local server"""
+
+    def setUp(self):
+        self.server = FetchServer(('127.0.0.1', 0), FetchHandler)
+        self.server.lock = threading.Lock()
+        self.server.active = 0
+        self.server.most_active = 0
+        self.server.clients = set()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{0}'.format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_fetch(self):
+        """Urls come back in order, no more than per_host at a time"""
+        urls = [self.url + '/page/' + str(i) for i in range(8)]
+        fetcher = ContentFetcher(workers=6, per_host=2, timeout=5)
+
+        reads = fetcher.fetch(urls)
+        self.assertEqual(len(urls), len(reads))
+        for read in reads:
+            self.assertEqual(200, read.status, read.status_message)
+            self.assertTrue(
+                'bookmark manager' in read.content,
+                "We should have read the page: " + str(read.content))
+
+        self.assertEqual(
+            2,
+            self.server.most_active,
+            "Only two requests at a time: " + str(self.server.most_active))
+        self.assertTrue(
+            len(self.server.clients) < len(urls),
+            "Connections should be reused: " + str(self.server.clients))
+
+        reads = fetcher.fetch([self.url + '/missing', urls[0]])
+        self.assertEqual([404, 200], [read.status for read in reads])
+
+    def test_session_pools(self):
+        """The connection pools are sized for the fetcher"""
+        fetcher = ContentFetcher(workers=12, per_host=4)
+        adapter = fetcher.session.get_adapter(self.url)
+        self.assertEqual(12, adapter._pool_connections)
+        self.assertEqual(4, adapter._pool_maxsize)
+
+        reads = fetcher.fetch([self.url + '/page/' + str(i)
+                               for i in range(8)])
+        self.assertEqual([200] * 8, [read.status for read in reads])
+        self.assertEqual(
+            4,
+            self.server.most_active,
+            "Four requests at a time: " + str(self.server.most_active))
+
+    def test_timeout(self):
+        """A slow site gives up after the timeout"""
+        fetcher = ContentFetcher(timeout=0.5)
+        started = time.time()
+        read = fetcher.fetch([self.url + '/slow'])[0]
+        self.assertEqual(902, read.status)
+        self.assertTrue(
+            time.time() - started < 2,
+            "We shouldn't wait on the slow site")
+
+    def test_broken_body(self):
+        """A body we can't decode is an error, not an exception"""
+        read = ReadUrl.parse(self.url + '/gzip')
+        self.assertEqual(903, read.status, read.status_message)
+
+    def test_conditional_fetch(self):
+        """We don't parse a page again if it hasn't changed"""
+        read = ReadUrl.parse(self.url + '/etag')
+        self.assertEqual(200, read.status)
+        self.assertEqual('"v1"', read.etag)
+
+        again = ReadUrl.parse(self.url + '/etag', etag=read.etag)
+        self.assertTrue(again.is_unchanged(), "The server said it's the same")
+        self.assertEqual(None, again.content)
+
+        read = ReadUrl.parse(self.url + '/page')
+        again = ReadUrl.parse(self.url + '/page', digest=read.digest)
+        self.assertTrue(
+            again.is_unchanged(),
+            "The page has the same digest: " + str(again.status))
+        self.assertEqual(None, again.content)
+
+    def test_content_sniffing(self):
+        """Only html is read, no matter what the headers say"""
+        read = ReadUrl.parse(self.url + '/pdf')
+        self.assertEqual(200, read.status)
+        self.assertEqual('application/pdf', read.content_type)
+        self.assertEqual(None, read.content)
+
+        read = ReadUrl.parse(self.url + '/vague')
+        self.assertEqual('text/html', read.content_type)
+        self.assertTrue(
+            'bookmark manager' in read.content,
+            "We should have read the page: " + str(read.content))
+
+    def test_max_bytes(self):
+        """Big pages are cut off but still parsed"""
+        read = ReadUrl.parse(self.url + '/big', max_bytes=2048)
+        self.assertEqual(200, read.status)
+        self.assertTrue(read.truncated, "The page should be cut off")
+        self.assertTrue(
+            'bookmark manager' in read.content,
+            "We should have read the page: " + str(read.content))
+
+        # The cut off connection doesn't break the next request.
+        read = ReadUrl.parse(self.url + '/page')
+        self.assertEqual(200, read.status)
+        self.assertFalse(read.truncated, "The page is small enough")
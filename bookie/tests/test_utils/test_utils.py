@@ -1,11 +1,17 @@
+from mock import patch
 from unittest import TestCase
 
+from bookie.lib import utils
+from bookie.lib.utils import suggest_content_tags
 from bookie.lib.utils import suggest_tags
 
 
 class TestSuggestTags(TestCase):
     """Verify we can suggest tags for content."""
 
+    def setUp(self):
+        utils.SUGGEST_CACHE.clear()
+
     def test_avoids_bombing_on_none(self):
         """It should not bomb when passed None"""
         test_value = None
@@ -31,3 +37,22 @@ class TestSuggestTags(TestCase):
         self.assertEqual(
             set([u'cars', u'autonomous']),
             suggest_tags(test_value))
+
+    def test_caches_suggestions(self):
+        """The nouns of a string are only pulled out once"""
+        with patch.object(utils, '_suggest_tags') as nouns:
+            nouns.return_value = set([u'cars'])
+            tags = suggest_tags('autonomous cars')
+            tags.add(u'extra')
+            self.assertEqual(set([u'cars']), suggest_tags('autonomous cars'))
+            self.assertEqual(1, nouns.call_count)
+
+    def test_content_tags(self):
+        """The most used terms of the content come first"""
+        content = (
+            u'The network simulator is new. The network simulator runs '
+            u'NS 2014 tests. Network users like the simulator.')
+        self.assertEqual(
+            [u'network', u'simulator', u'users', u'tests'],
+            suggest_content_tags(content))
+        self.assertEqual([], suggest_content_tags(None))
@@ -10,6 +10,7 @@ from bookie.models import (
     Bmark,
     BmarkMgr,
 )
+from bookie.models.auth import User
 from bookie.tests import TestViewBase
 from bookie.tests.factory import make_bookmark
 
@@ -87,6 +88,56 @@ class BookieViewsTest(TestViewBase):
             msg="Changes link should appear: " + res.body)
 
 
+class TestTagList(TestViewBase):
+    """The tag list only shows the owner their private bookmarks"""
+
+    def setUp(self):
+        super(TestTagList, self).setUp()
+        DBSession.add_all([
+            Bmark(u'http://bmark.us', username=u'admin', tags=u'python'),
+        ])
+        DBSession.flush()
+        DBSession.add_all([
+            Bmark(u'http://google.com', username=u'admin',
+                  tags=u'python secret', is_private=True),
+        ])
+        other = User()
+        other.username = u'other'
+        other.email = u'other@bmark.us'
+        other.password = u'other'
+        other.activated = True
+        DBSession.add(other)
+        transaction.commit()
+
+    def test_other_user(self):
+        """Someone else only gets the counts of the public bookmarks"""
+        self.app.post(
+            '/login',
+            params={
+                "login": u"other",
+                "password": u"other",
+                "form.submitted": u"Log In",
+            },
+            status=302)
+        res = self.app.get('/admin/tags', status=200)
+        self.assertIn('python</a>\n            (1)', res.body)
+        self.assertNotIn('secret', res.body)
+        self.assertNotIn('(2)', res.body)
+
+    def test_anonymous(self):
+        """An anonymous visitor only gets the public counts as well"""
+        res = self.app.get('/admin/tags', status=200)
+        self.assertIn('python</a>\n            (1)', res.body)
+        self.assertNotIn('secret', res.body)
+
+    def test_owner(self):
+        """The owner sees the counts of all of their bookmarks"""
+        self._login_admin()
+        res = self.app.get('/admin/tags', status=200)
+        self.assertIn('python</a>\n            (2)', res.body)
+        self.assertIn('secret</a>\n            (1)', res.body)
+
+
 class TestNewBookmark(TestViewBase):
     """Test the new bookmark real views"""
 
@@ -301,6 +352,15 @@ class TestRSSFeeds(TestViewBase):
             body_str in res.body,
             msg="Request should contain rss url: " + res.body)
 
+    def test_rss_bad_cursor(self):
+        """A cursor we can't read is a bad request, not an error"""
+        for url in ('/rss', '/admin/rss'):
+            res = self.app.get(
+                url, params={'cursor': 'junk'}, status=400)
+            self.assertTrue(
+                'invalid cursor' in res.body,
+                msg="The feed should say what's wrong: " + res.body)
+
     def test_rss_is_parseable(self):
         """The rss feed should be a parseable feed."""
         [make_bookmark() for i in range(10)]
@@ -2,6 +2,7 @@
 import logging
 
 from datetime import datetime
+from itertools import chain
 from pyramid.settings import asbool
 from pyramid.view import view_config
 from sqlalchemy.exc import IntegrityError
@@ -12,6 +13,8 @@ from bookie.bcelery import tasks
 from bookie.lib.access import api_auth
 from bookie.lib.applog import AuthLog
 from bookie.lib.applog import BmarkLog
+from bookie.lib.exporter import json_export
+from bookie.lib.exporter import stream_response
 from bookie.lib.message import ReactivateMsg
 from bookie.lib.message import ActivationMsg
 from bookie.lib.readable import ReadContent
@@ -19,14 +22,15 @@ from bookie.lib.tagcommands import Commander
 from bookie.lib.utils import suggest_tags
 
 from bookie.models import (
-    bmarks_tags,
     Bmark,
     BmarkMgr,
+    BmarkTools,
     DBSession,
     Hashed,
     NoResultFound,
     Readable,
     TagMgr,
+    UserTagMgr,
 )
 from bookie.models.applog import AppLogMgr
 from bookie.models.auth import ActivationMgr
@@ -40,6 +44,7 @@ from bookie.models.fulltext import get_fulltext_handler
 
 LOG = logging.getLogger(__name__)
 RESULTS_MAX = 10
+TAGS_MAX = 50
 HARD_MAX = 100
 
 
@@ -62,6 +67,18 @@ def _api_response(request, data):
     return data
 
 
+def _bmark_dict(bmark):
+    """The json for a bookmark in a list, with its tags, url and clicks"""
+    bmark_dict = dict(bmark)
+    bmark_dict['tags'] = [dict(tag) for tag in bmark.tags.itervalues()]
+
+    # we should have the hashed information, we need the url and clicks as
+    # total clicks to send back
+    bmark_dict['url'] = bmark.hashed.url
+    bmark_dict['total_clicks'] = bmark.hashed.clicks
+    return bmark_dict
+
+
 @view_config(route_name="api_user_stats", renderer="jsonp")
 def user_stats(request):
     """Return all the user stats"""
@@ -90,7 +107,7 @@ def bookmark_stats(request):
 
 
 @view_config(route_name="api_ping", renderer="jsonp")
-@api_auth('api_key', UserMgr.get)
+@api_auth('api_key', UserMgr.get_cached)
 def ping(request):
     """Verify that you've setup your api correctly and verified
 
@@ -136,7 +153,7 @@ def ping_missing_api(request):
 
 
 @view_config(route_name="api_bmark_hash", renderer="jsonp")
-@api_auth('api_key', UserMgr.get, anon=True)
+@api_auth('api_key', UserMgr.get_cached, anon=True)
 def bmark_get(request):
     """Return a bookmark requested via hash_id
 
@@ -181,7 +198,7 @@ def bmark_get(request):
         return _api_response(request, ret)
     else:
         return_obj = dict(bookmark)
-        return_obj['tags'] = [dict(tag[1]) for tag in bookmark.tags.items()]
+        return_obj['tags'] = [dict(tag) for tag in bookmark.tags.itervalues()]
 
         if 'with_content' in params and params['with_content'] != 'false':
             if bookmark.readable:
@@ -227,7 +244,7 @@ def _update_mark(mark, params):
 
 @view_config(route_name="api_bmark_add", renderer="jsonp")
 @view_config(route_name="api_bmark_update", renderer="jsonp")
-@api_auth('api_key', UserMgr.get)
+@api_auth('api_key', UserMgr.get_cached)
 def bmark_add(request):
     """Add a new bookmark to the system"""
     rdict = request.matchdict
@@ -322,6 +339,7 @@ def bmark_add(request):
 
             mark.readable = Readable()
             mark.readable.content = parsed.content
+            mark.readable.clean_content = parsed.clean_content
             mark.readable.content_type = parsed.content_type
             mark.readable.status_code = parsed.status
             mark.readable.status_message = parsed.status_message
@@ -341,7 +359,7 @@ def bmark_add(request):
 
 
 @view_config(route_name="api_bmark_remove", renderer="jsonp")
-@api_auth('api_key', UserMgr.get)
+@api_auth('api_key', UserMgr.get_cached)
 def bmark_remove(request):
     """Remove this bookmark from the system"""
     rdict = request.matchdict
@@ -376,6 +394,8 @@ def bmark_recent(request, with_content=False):
     # check if we have a page count submitted
     page = int(params.get('page', '0'))
     count = int(params.get('count', RESULTS_MAX))
+    # a cursor from a previous response wins over the page number
+    cursor = params.get('cursor', None)
     if not with_content:
         with_content = asbool(params.get('with_content', False))
 
@@ -398,8 +418,12 @@ def bmark_recent(request, with_content=False):
         else:
             order_by = Hashed.clicks.desc()
 
+        # cursors only track the stored ordering, fall back to the page
+        cursor = None
+
     else:
-        order_by = Bmark.stored.desc()
+        # let the manager apply its default, stable, stored ordering
+        order_by = None
 
     # thou shalt not have more then the HARD MAX
     # @todo move this to the .ini as a setting
@@ -421,27 +445,33 @@ def bmark_recent(request, with_content=False):
     # if we allow showing of content the query hangs and fails on the
     # postgres side. Need to check the query and figure out what's up.
     # see bug #142
-    recent_list = BmarkMgr.find(
-        limit=count,
-        order_by=order_by,
-        page=page,
-        tags=tags,
-        username=username,
-        with_tags=True,
-        with_content=with_content,
-        requested_by=requested_by,
-    )
+    try:
+        recent_list = BmarkMgr.find(
+            limit=count,
+            order_by=order_by,
+            page=page,
+            tags=tags,
+            username=username,
+            with_tags=True,
+            with_content=with_content,
+            requested_by=requested_by,
+            cursor=cursor,
+        )
+    except ValueError:
+        request.response.status_int = 400
+        return _api_response(request, {
+            'error': 'Bad Request: invalid cursor',
+        })
+
+    # Hand back a cursor for the next page as long as this one was full.
+    next_cursor = None
+    if order_by is None and recent_list and len(recent_list) == count:
+        next_cursor = BmarkTools.encode_cursor(recent_list[-1])
 
     result_set = []
 
     for res in recent_list:
-        return_obj = dict(res)
-        return_obj['tags'] = [dict(tag[1]) for tag in res.tags.items()]
-
-        # we should have the hashed information, we need the url and clicks as
-        # total clicks to send back
-        return_obj['url'] = res.hashed.url
-        return_obj['total_clicks'] = res.hashed.clicks
+        return_obj = _bmark_dict(res)
 
         if with_content:
             return_obj['readable'] = dict(res.readable) if res.readable else {}
@@ -453,6 +483,8 @@ def bmark_recent(request, with_content=False):
         'max_count': RESULTS_MAX,
         'count': len(recent_list),
         'page': page,
+        'cursor': cursor,
+        'next_cursor': next_cursor,
         'tag_filter': tags,
     })
 
@@ -489,6 +521,9 @@ def user_bmark_count(request):
 def bmark_export(request):
     """Export via the api call to json dump
 
+    The json is streamed out as the bookmarks are read, gzipped if the
+    client accepts it.
+
     """
     username = request.user.username
 
@@ -496,20 +531,21 @@ def bmark_export(request):
     # log that the user exported this
     BmarkLog.export(username, username)
 
-    def build_bmark(bmark):
-        d = dict(bmark)
-        d['hashed'] = dict(bmark.hashed)
-        return _api_response(request, d)
+    pieces = json_export(bmark_list, datetime.utcnow())
+    content_type = 'application/json'
 
-    return _api_response(request, {
-        'bmarks': [build_bmark(bmark) for bmark in bmark_list],
-        'count': len(bmark_list),
-        'date': str(datetime.utcnow())
-    })
+    callback = request.GET.get('callback', None)
+    if callback:
+        pieces = chain([callback + u'('], pieces, [u');'])
+        content_type = 'application/javascript'
+
+    # Still send the CORS headers every api response gets.
+    _api_response(request, None)
+    return stream_response(request, pieces, content_type)
 
 
 @view_config(route_name="api_extension_sync", renderer="jsonp")
-@api_auth('api_key', UserMgr.get)
+@api_auth('api_key', UserMgr.get_cached)
 def extension_sync(request):
     """Return a list of the bookmarks we know of in the system
 
@@ -575,17 +611,7 @@ def search_results(request):
         ret = {'error': "Bad Request: Page number out of bound"}
         return _api_response(request, ret)
 
-    constructed_results = []
-    for res in res_list:
-        return_obj = dict(res)
-        return_obj['tags'] = [dict(tag[1]) for tag in res.tags.items()]
-
-        # the hashed object is there as well, we need to pull the url and
-        # clicks from it as total_clicks
-        return_obj['url'] = res.hashed.url
-        return_obj['total_clicks'] = res.hashed.clicks
-
-        constructed_results.append(return_obj)
+    constructed_results = [_bmark_dict(res) for res in res_list]
 
     return _api_response(request, {
         'search_results': constructed_results,
@@ -599,7 +625,7 @@ def search_results(request):
 
 @view_config(route_name="api_tag_complete", renderer="jsonp")
 @view_config(route_name="api_tag_complete_user", renderer="jsonp")
-@api_auth('api_key', UserMgr.get, anon=True)
+@api_auth('api_key', UserMgr.get_cached, anon=True)
 def tag_complete(request):
     """Complete a tag based on the given text
 
@@ -644,7 +670,95 @@ def tag_complete(request):
 
     return _api_response(request, {
         'current': ",".join(current_tags),
-        'tags': [t.name for t in tags]
+        'tags': tags
+    })
+
+
+@view_config(route_name="api_tag_cloud", renderer="jsonp")
+@view_config(route_name="api_tag_cloud_user", renderer="jsonp")
+@api_auth('api_key', UserMgr.get, anon=True)
+def tag_cloud(request):
+    """The most used tags with how many bookmarks have them
+
+    :@param page: GET page of the cloud, the most used tags are on page 0
+    :@param count: GET how many tags to a page
+
+    Only the owner of the bookmarks gets the counts of their private ones.
+
+    """
+    rdict = request.matchdict
+    params = request.params
+
+    page = int(params.get('page', '0'))
+    count = min(int(params.get('count', TAGS_MAX)), HARD_MAX)
+
+    username = rdict.get('username', None)
+    if username:
+        username = username.lower()
+
+    if request.user:
+        requested_by = request.user.username
+    else:
+        requested_by = None
+
+    cloud = UserTagMgr.cloud(username=username,
+                             page=page,
+                             limit=count,
+                             public=username is None or
+                             username != requested_by)
+
+    tags = []
+    for name, total, last_used in cloud:
+        tags.append({
+            'name': name,
+            'count': total,
+            'last_used': (last_used.strftime("%Y-%m-%d %H:%M:%S")
+                          if last_used else ""),
+        })
+
+    return _api_response(request, {
+        'tags': tags,
+        'count': len(cloud),
+        'max_count': count,
+        'page': page,
+        'username': username,
+    })
+
+
+@view_config(route_name="api_tag_related", renderer="jsonp")
+@view_config(route_name="api_tag_related_user", renderer="jsonp")
+@api_auth('api_key', UserMgr.get, anon=True)
+def tag_related(request):
+    """Find the tags used most on the same bookmarks as the given tags
+
+    :@param tags: GET string of tags to find related tags for python+database
+
+    Only the owner of the bookmarks gets the counts of their private ones.
+
+    """
+    rdict = request.matchdict
+    params = request.GET
+
+    username = rdict.get('username', None)
+    if username:
+        username = username.lower()
+
+    if request.user:
+        requested_by = request.user.username
+    else:
+        requested_by = None
+
+    tags = params.get('tags', u'').split()
+    if tags:
+        related = TagMgr.related(tags,
+                                 username=username,
+                                 requested_by=requested_by)
+    else:
+        related = []
+
+    return _api_response(request, {
+        'related_to': tags,
+        'tags': [dict(name=name, count=count) for name, count in related]
     })
 
 
@@ -1216,15 +1330,8 @@ def del_user(request):
         })
 
     try:
-        # First delete all the tag references for this user's bookmarks.
-        res = DBSession.query(Bmark.bid).filter(Bmark.username == u.username)
-        bids = [b[0] for b in res]
-
-        qry = bmarks_tags.delete(bmarks_tags.c.bmark_id.in_(bids))
-        qry.execute()
-
-        # Delete all of the bmarks for this year.
-        Bmark.query.filter(Bmark.username == u.username).delete()
+        # Delete all of the bmarks and their tag references first.
+        BmarkMgr.delete_all_bookmarks(u.username)
         DBSession.delete(u)
         return _api_response(request, {
             'success': True,
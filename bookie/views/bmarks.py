@@ -1,6 +1,7 @@
 """Controllers related to viewing lists of bookmarks"""
 import logging
 
+from pyramid.httpexceptions import HTTPBadRequest
 from pyramid.httpexceptions import HTTPFound
 from pyramid.httpexceptions import HTTPNotFound
 from pyramid.view import view_config
@@ -10,11 +11,11 @@ from bookie.lib.access import ReqAuthorize
 from bookie.lib.utils import (
     suggest_tags,
     url_fix)
-from bookie.lib.urlhash import generate_hash
 from bookie.models import (
     Bmark,
     BmarkMgr,
     DBSession,
+    HashedMgr,
     InvalidBookmark,
     NoResultFound,
     TagMgr,
@@ -96,6 +97,9 @@ def recent_rss(request):
         username = username.lower()
 
     ret = api.bmark_recent(request, with_content=True)
+    if 'error' in ret:
+        # There's no feed to render for a cursor we can't read.
+        return HTTPBadRequest(ret['error'])
     ret['username'] = username
     ret['tags'] = tags
     return ret
@@ -145,7 +149,7 @@ def edit(request):
         else:
             # Hash the url and make sure that it doesn't exist
             if url != u"":
-                new_url_hash = generate_hash(url)
+                new_url_hash = HashedMgr.hash_url(url)
 
                 test_exists = BmarkMgr.get_by_hash(
                     new_url_hash,
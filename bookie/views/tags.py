@@ -3,6 +3,7 @@ import logging
 from pyramid.view import view_config
 
 from bookie.models import TagMgr
+from bookie.models import UserTagMgr
 from bookie.views import bmarks
 
 LOG = logging.getLogger(__name__)
@@ -12,18 +13,33 @@ RESULTS_MAX = 50
 @view_config(route_name="tag_list", renderer="/tag/list.mako")
 @view_config(route_name="user_tag_list", renderer="/tag/list.mako")
 def tag_list(request):
-    """Display a list of your tags"""
+    """Display a list of your tags, a page at a time"""
     rdict = request.matchdict
+    params = request.params
     username = rdict.get("username", None)
     if username:
         username = username.lower()
 
-    tags_found = TagMgr.find(username=username)
+    page = int(params.get('page', 0))
+    count = int(params.get('count', RESULTS_MAX))
+
+    # Only you get to see the tags of your private bookmarks.
+    public = not request.user or request.user.username != username
+    if username:
+        tags_found = UserTagMgr.find(
+            username, page=page, limit=count, public=public)
+        tag_count = UserTagMgr.count(username, public=public)
+    else:
+        tags_found = TagMgr.find(page=page, limit=count)
+        tag_count = TagMgr.count()
 
     return {
         'tag_list': tags_found,
-        'tag_count': len(tags_found),
+        'tag_count': tag_count,
         'username': username,
+        'public': public,
+        'page': page,
+        'count': count,
     }
 
 
@@ -9,6 +9,8 @@ from pyramid.view import view_config
 
 from bookie.lib.access import ReqAuthorize
 from bookie.lib.applog import BmarkLog
+from bookie.lib.exporter import netscape_export
+from bookie.lib.exporter import stream_response
 from bookie.lib.importer import store_import_file
 
 from bookie.bcelery import tasks
@@ -178,9 +180,14 @@ class ImportViews(BookieView):
                 'username': username,
             }
 
-    @view_config(route_name="user_export", renderer="/utils/export.mako")
+    @view_config(route_name="user_export")
     def export(self):
-        """Handle exporting a user's bookmarks to file"""
+        """Handle exporting a user's bookmarks to file
+
+        The file is streamed out as the bookmarks are read, gzipped if the
+        client accepts it.
+
+        """
         mdict = self.matchdict
         username = mdict.get('username')
 
@@ -193,15 +200,10 @@ class ImportViews(BookieView):
             bmark_list = BmarkMgr.user_dump(username, current_user)
             BmarkLog.export(username, current_user)
 
-            self.request.response_content_type = 'text/html'
-
-            headers = [('Content-Disposition',
-                        'attachment; filename="bookie_export.html"')]
-            setattr(self.request, 'response_headerlist', headers)
-
-            return {
-                'bmark_list': bmark_list,
-            }
+            self.request.response.content_disposition = \
+                'attachment; filename="bookie_export.html"'
+            return stream_response(
+                self.request, netscape_export(bmark_list), 'text/html')
 
     @view_config(route_name="redirect", renderer="/utils/redirect.mako")
     @view_config(route_name="user_redirect", renderer="/utils/redirect.mako")
@@ -0,0 +1,44 @@
+"""adding user_tags with the tag counts of each user
+
+Revision ID: 1f3c7d2e8b5a
+Revises: 4b2f7c1e9a3d
+Create Date: 2014-08-09 10:21:47.208314
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1f3c7d2e8b5a'
+down_revision = '4b2f7c1e9a3d'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('user_tags',
+        sa.Column('username', sa.Unicode(length=255), nullable=False),
+        sa.Column('tid', sa.Integer(), nullable=False),
+        sa.Column('count', sa.Integer(), nullable=False),
+        sa.Column('public_count', sa.Integer(), nullable=False),
+        sa.Column('last_used', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['username'], ['users.username'], ),
+        sa.ForeignKeyConstraint(['tid'], ['tags.tid'], ),
+        sa.PrimaryKeyConstraint('username', 'tid')
+    )
+
+    # Count up the tags of the bookmarks we already have.
+    op.execute("""
+        INSERT INTO user_tags (username, tid, count, public_count, last_used)
+        SELECT bmarks.username,
+               bmark_tags.tag_id,
+               COUNT(*),
+               SUM(CASE WHEN bmarks.is_private THEN 0 ELSE 1 END),
+               MAX(bmarks.stored)
+        FROM bmark_tags
+        JOIN bmarks ON bmarks.bid = bmark_tags.bmark_id
+        GROUP BY bmarks.username, bmark_tags.tag_id
+    """)
+
+
+def downgrade():
+    op.drop_table('user_tags')
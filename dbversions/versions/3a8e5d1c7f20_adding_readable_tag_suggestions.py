@@ -0,0 +1,22 @@
+"""adding the tag suggestions of the readable content
+
+Revision ID: 3a8e5d1c7f20
+Revises: 1f3c7d2e8b5a
+Create Date: 2014-08-12 19:44:03.731956
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3a8e5d1c7f20'
+down_revision = '1f3c7d2e8b5a'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('bmark_readable', sa.Column('tag_suggestions', sa.UnicodeText(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('bmark_readable', 'tag_suggestions')
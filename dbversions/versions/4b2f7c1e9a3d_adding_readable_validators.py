@@ -0,0 +1,26 @@
+"""adding readable etag, last_modified and content_digest
+
+Revision ID: 4b2f7c1e9a3d
+Revises: dbc7a0f1182
+Create Date: 2014-08-02 14:12:31.518203
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4b2f7c1e9a3d'
+down_revision = 'dbc7a0f1182'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('bmark_readable', sa.Column('etag', sa.Unicode(length=255), nullable=True))
+    op.add_column('bmark_readable', sa.Column('last_modified', sa.Unicode(length=255), nullable=True))
+    op.add_column('bmark_readable', sa.Column('content_digest', sa.Unicode(length=40), nullable=True))
+
+
+def downgrade():
+    op.drop_column('bmark_readable', 'content_digest')
+    op.drop_column('bmark_readable', 'last_modified')
+    op.drop_column('bmark_readable', 'etag')
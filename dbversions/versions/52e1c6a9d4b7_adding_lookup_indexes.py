@@ -0,0 +1,39 @@
+"""adding indexes for the columns we look things up by
+
+Revision ID: 52e1c6a9d4b7
+Revises: 3a8e5d1c7f20
+Create Date: 2014-08-14 21:05:38.190562
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '52e1c6a9d4b7'
+down_revision = '3a8e5d1c7f20'
+
+from alembic import op
+
+
+def upgrade():
+    op.create_index('ix_users_api_key', 'users', ['api_key'])
+    op.create_index('ix_activations_code', 'activations', ['code'])
+    op.create_index('ix_bmarks_hash_id', 'bmarks', ['hash_id'])
+    op.create_index(
+        'ix_bmarks_username_stored', 'bmarks', ['username', 'stored', 'bid'])
+    op.create_index('ix_bmarks_stored', 'bmarks', ['stored', 'bid'])
+    op.create_index('ix_bmark_tags_tag_id', 'bmark_tags', ['tag_id', 'bmark_id'])
+    op.create_index(
+        'ix_stats_bookmarks_attrib_tstamp',
+        'stats_bookmarks',
+        ['attrib', 'tstamp'])
+    op.create_index('ix_logging_tstamp', 'logging', ['tstamp'])
+
+
+def downgrade():
+    op.drop_index('ix_logging_tstamp', 'logging')
+    op.drop_index('ix_stats_bookmarks_attrib_tstamp', 'stats_bookmarks')
+    op.drop_index('ix_bmark_tags_tag_id', 'bmark_tags')
+    op.drop_index('ix_bmarks_stored', 'bmarks')
+    op.drop_index('ix_bmarks_username_stored', 'bmarks')
+    op.drop_index('ix_bmarks_hash_id', 'bmarks')
+    op.drop_index('ix_activations_code', 'activations')
+    op.drop_index('ix_users_api_key', 'users')
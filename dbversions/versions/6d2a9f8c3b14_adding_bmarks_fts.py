@@ -0,0 +1,43 @@
+"""adding bmarks_fts for the database fulltext engine
+
+Revision ID: 6d2a9f8c3b14
+Revises: 52e1c6a9d4b7
+Create Date: 2014-08-16 11:42:09.531877
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6d2a9f8c3b14'
+down_revision = '52e1c6a9d4b7'
+
+from alembic import op
+
+
+def upgrade():
+    # The fulltext support differs for each database, there's no table for
+    # the ones it doesn't work with.
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute("""
+            CREATE VIRTUAL TABLE bmarks_fts USING fts5(
+                description, extended, tags, readable,
+                tokenize='porter unicode61')
+        """)
+    elif dialect == 'postgresql':
+        op.execute("""
+            CREATE TABLE bmarks_fts (
+                bid INTEGER PRIMARY KEY
+                    REFERENCES bmarks (bid) ON DELETE CASCADE,
+                fields TSVECTOR,
+                readable TSVECTOR)
+        """)
+        op.execute(
+            "CREATE INDEX bmarks_fts_fields ON bmarks_fts USING gin (fields)")
+        op.execute(
+            "CREATE INDEX bmarks_fts_readable ON bmarks_fts "
+            "USING gin (readable)")
+
+
+def downgrade():
+    if op.get_bind().dialect.name in ('sqlite', 'postgresql'):
+        op.execute('DROP TABLE bmarks_fts')
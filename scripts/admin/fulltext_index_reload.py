@@ -2,11 +2,58 @@
 """Force the system to refresh the fulltext index.
 
 This is useful because we've had lockup issues with Whoosh and in case we need
-to reset, this will force it through celery.
+to reset, this will rebuild it from scratch.
+
+    fulltext_index_reload.py --ini bookie.ini --procs 4
+
+The new index is built next to the live one, which keeps serving searches
+until it's swapped in. Unlike the celery task this can write the index with
+several processes.
 
 """
 import argparse
+import os
+import sys
+import transaction
+
+from multiprocessing import cpu_count
+
+
+def parse_args():
+    """Handle building the argparse options for the script"""
+    desc = "Rebuild the fulltext index of every bookmark."
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument(
+        '--ini',
+        dest='ini',
+        default='bookie.ini',
+        help='The ini file for this Bookie instance, relative to the root.')
+    parser.add_argument(
+        '--procs',
+        dest='procs',
+        type=int,
+        default=cpu_count(),
+        help='How many processes to write the index with.')
+    return parser.parse_args()
+
+
+def show_progress(done, total):
+    """Keep the user up to date as each chunk of bookmarks is indexed"""
+    percent = 100 * done / total if total else 100
+    sys.stdout.write('\rIndexed {0} of {1} bookmarks ({2}%)'.format(
+        done, total, percent))
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    os.environ['BOOKIE_INI'] = args.ini
 
-from ConfigParser import ConfigParser
+    # The tasks module sets up the db and index from the BOOKIE_INI.
+    from bookie.bcelery import tasks
 
-# TODO
+    transaction.begin()
+    tasks.rebuild_fulltext_index(procs=args.procs, progress=show_progress)
+    transaction.commit()
+    print "\nDone, the new index is live."